@@ -0,0 +1,203 @@
+import os
+import random
+import threading
+import time
+
+# Author: Peter Van Eenoo
+# CSS 532 IoT - class project
+# March 2021
+
+# the hardware backends the subsystems talk to. Each backend has a gpio object with the parts of the
+# RPi.GPIO interface we use, plus openADC() for the soil probe's ADS1015 channel and openBME280() for
+# the weather sensor, so the same lights, water, soil and weather code runs on:
+#   real - the Raspberry Pi's GPIO and i2c chips
+#   stub - no hardware, pins do nothing and the sensors return fixed values
+#   sim  - no hardware, every bus transaction takes --sim-latency and readings have --sim-noise added
+# pick one with --backend or the IOT_BACKEND environment variable, real is the default
+
+DEFAULT_BACKEND = os.environ.get('IOT_BACKEND', 'real')
+SIM_LATENCY = 0.002 # seconds per simulated i2c transaction, about what a 100kHz bus takes
+SIM_NOISE = 0.002   # standard deviation of simulated readings as a fraction of their value, ~3% soil humidity
+
+# readings returned by the stub backend
+STUB_VALUE = 55
+STUB_ADC_VALUE = 21491 # raw ADS1015 reading that comes out at about 55% with the soil probe's calibration
+
+# name -> class, the registry --backend picks from
+BACKENDS = {}
+
+def registerBackend(name, backendClass):
+    BACKENDS[name] = backendClass
+
+# the backend selected for this process, guarded by mutex
+mutex = threading.Lock()
+current = None
+
+# create the named backend and make it the one getBackend() returns, options go to its constructor
+def selectBackend(name, **options):
+    global current
+    if name not in BACKENDS:
+        raise ValueError("unknown hardware backend {}, choose from {}".format(name, ', '.join(BACKENDS)))
+    mutex.acquire()
+    current = BACKENDS[name](**options)
+    mutex.release()
+    return current
+
+# the selected backend, or DEFAULT_BACKEND if nothing has been selected yet
+def getBackend():
+    global current
+    mutex.acquire()
+    if current is None:
+        current = BACKENDS[DEFAULT_BACKEND]()
+    mutex.release()
+    return current
+
+## real hardware ##
+
+class realBackend:
+    def __init__(self, **options):
+        import RPi.GPIO as GPIO    # Import Raspberry Pi GPIO library
+        self.name = 'real'
+        self.gpio = GPIO
+        self.i2c = None
+        self.i2cMutex = threading.Lock()
+
+    # the soil ADC and the BME280 share the one i2c bus, they can be opened from different threads
+    def getI2C(self):
+        self.i2cMutex.acquire()
+        try:
+            if self.i2c is None:
+                import board
+                import busio
+                self.i2c = busio.I2C(board.SCL, board.SDA)
+            return self.i2c
+        finally:
+            self.i2cMutex.release()
+
+    # single-ended input on one of the ADS1015's channels, dataRate in samples/s or None for the chip's default
+    def openADC(self, channel=0, dataRate=None):
+        import adafruit_ads1x15.ads1015 as ADS
+        from adafruit_ads1x15.analog_in import AnalogIn
+        ads = ADS.ADS1015(self.getI2C())
+        if dataRate is not None:
+            ads.data_rate = dataRate
+        return AnalogIn(ads, [ADS.P0, ADS.P1, ADS.P2, ADS.P3][channel])
+
+    def openBME280(self):
+        import adafruit_bme280
+        return adafruit_bme280.Adafruit_BME280_I2C(self.getI2C())
+
+registerBackend('real', realBackend)
+
+## stubs ##
+
+# stands in for RPi.GPIO, pins keep their last output but nothing is connected
+class stubGPIO:
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self):
+        self.pins = {}
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, initial=LOW):
+        self.pins[pin] = initial
+
+    def output(self, pin, state):
+        self.pins[pin] = state
+
+    def input(self, pin):
+        return self.pins.get(pin, self.LOW)
+
+class stubADC:
+    def __init__(self, value):
+        self.value = value
+
+class stubBME280:
+    def __init__(self, value):
+        self.temperature = value
+        self.relative_humidity = value
+        self.pressure = value
+        self.sea_level_pressure = 1013.25
+
+class stubBackend:
+    def __init__(self, **options):
+        self.name = 'stub'
+        self.gpio = stubGPIO()
+
+    def openADC(self, channel=0, dataRate=None):
+        return stubADC(STUB_ADC_VALUE)
+
+    def openBME280(self):
+        return stubBME280(STUB_VALUE)
+
+registerBackend('stub', stubBackend)
+
+## simulation ##
+
+class simADC:
+    def __init__(self, sim, value):
+        self.sim = sim
+        self.base = value
+
+    @property
+    def value(self):
+        self.sim.transaction()
+        return int(self.sim.noisy(self.base))
+
+# like the driver, each property read is its own trip over the bus
+class simBME280:
+    def __init__(self, sim):
+        self.sim = sim
+        self.sea_level_pressure = 1013.25
+
+    @property
+    def temperature(self):
+        self.sim.transaction()
+        return self.sim.noisy(21.0)
+
+    @property
+    def relative_humidity(self):
+        self.sim.transaction()
+        return min(100.0, self.sim.noisy(45.0))
+
+    @property
+    def pressure(self):
+        self.sim.transaction()
+        return self.sim.noisy(1009.0)
+
+class simBackend:
+    def __init__(self, latency=SIM_LATENCY, noise=SIM_NOISE, seed=None, **options):
+        self.name = 'sim'
+        self.latency = latency
+        self.noise = noise
+        self.rng = random.Random(seed)
+        self.transactions = 0
+        self.gpio = stubGPIO() # the GPIO pins are memory mapped so they don't cost a bus transaction
+
+    # pretend to wait on the bus
+    def transaction(self):
+        self.transactions += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def noisy(self, value):
+        if not self.noise:
+            return value
+        return self.rng.gauss(value, abs(value) * self.noise)
+
+    def openADC(self, channel=0, dataRate=None):
+        self.transaction() # the driver writes the ADC's config register
+        return simADC(self, STUB_ADC_VALUE)
+
+    # the driver checks the chip id, resets it and reads the calibration tables before it's usable
+    def openBME280(self):
+        for i in range(4):
+            self.transaction()
+        return simBME280(self)
+
+registerBackend('sim', simBackend)
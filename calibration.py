@@ -0,0 +1,192 @@
+import threading
+import json
+import os
+import math
+from array import array
+
+# Author: Peter Van Eenoo
+# CSS 532 IoT - class project
+# March 2021
+
+# every probe and sensor unit reads a little differently, so each device keeps its own calibration in a
+# JSON file of profiles, by default the profile named after the device's client id is used:
+#   {"gateway": {"soil": {"type": "linear", "points": [[20845, 100], [22280, 0]]},
+#                "seaLevelPressure": 1016.7}}
+# curves map a raw reading to a value, linear through 2 points or a piecewise linear table of points.
+# They are compiled when they are loaded so a conversion is one multiply-add, a table looks up its line first
+
+CURVES = ['soil'] # the sensors that take a curve
+SEA_LEVEL = 'seaLevelPressure'
+DEFAULT_PROFILE = 'default' # used when the file has no profile for this device
+LUT_STEP = 16 # raw units between table entries, the ADS1015 driver's raw values are 12 bits shifted up by 4
+MAX_LUT = 4096 # most table entries, a wider table gets a coarser step
+
+# a straight line through 2 points, readings outside of them are held at the end values
+class linearCurve:
+    def __init__(self, points):
+        (x0, y0), (x1, y1) = points
+        if x0 == x1:
+            raise ValueError("linear calibration points need different raw values")
+        self.slope = (y1 - y0) / (x1 - x0)
+        self.offset = y0 - self.slope * x0
+        self.low = min(y0, y1)
+        self.high = max(y0, y1)
+
+    def convert(self, raw):
+        return min(self.high, max(self.low, raw * self.slope + self.offset))
+
+# straight lines between the points, readings outside of the points are held at the end values.
+# Each line is compiled to a multiply-add, and a lookup table of which line starts every step raw units
+# finds a reading's line without searching, so a conversion is as exact as the line's formula
+class tableCurve:
+    def __init__(self, points, step=LUT_STEP):
+        points = sorted(points)
+        if any(points[i][0] == points[i + 1][0] for i in range(len(points) - 1)):
+            raise ValueError("table calibration points need different raw values")
+        self.xs = array('d', [x for x, y in points])
+        self.slopes = array('d')
+        self.offsets = array('d')
+        for (x0, y0), (x1, y1) in zip(points, points[1:]):
+            slope = (y1 - y0) / (x1 - x0)
+            self.slopes.append(slope)
+            self.offsets.append(y0 - slope * x0)
+        self.start = points[0][0]
+        self.end = points[-1][0]
+        self.step = max(step, (self.end - self.start) / (MAX_LUT - 1))
+        size = int(math.ceil((self.end - self.start) / self.step)) + 1
+        self.lut = array('i', [0] * size) # the line at the start of each step
+        segment = 0
+        for i in range(size):
+            x = min(self.start + i * self.step, self.end)
+            while segment < len(self.slopes) - 1 and self.xs[segment + 1] <= x:
+                segment += 1
+            self.lut[i] = segment
+        self.last = size - 1
+
+    def convert(self, raw):
+        raw = min(self.end, max(self.start, raw))
+        segment = self.lut[min(self.last, int((raw - self.start) / self.step))]
+        while raw > self.xs[segment + 1]: # a point inside this step starts another line
+            segment += 1
+        return raw * self.slopes[segment] + self.offsets[segment]
+
+# build a curve from its JSON spec, raises ValueError if the spec is bad
+def compileCurve(spec):
+    try:
+        kind = spec.get('type', 'linear')
+        points = [(float(x), float(y)) for x, y in spec['points']]
+    except (AttributeError, KeyError, TypeError, ValueError):
+        raise ValueError("a calibration curve needs a list of [raw, value] points")
+    if kind == 'linear':
+        if len(points) != 2:
+            raise ValueError("a linear calibration takes exactly 2 points")
+        return linearCurve(points)
+    if kind == 'table':
+        if len(points) < 2:
+            raise ValueError("a table calibration takes at least 2 points")
+        return tableCurve(points)
+    raise ValueError("unknown calibration type {}, choose from linear, table".format(kind))
+
+# this class holds one device's calibration. It's loaded once at startup, changes are compiled, saved
+# back to the file and handed to the listeners so the sensors pick them up without a restart
+class calibrationStore:
+    def __init__(self, path=None, profile=DEFAULT_PROFILE):
+        self.path = path # None keeps changes in memory only
+        self.profile = profile
+        # everything below is guarded by mutex
+        self.mutex = threading.Lock()
+        self.profiles = {} # the whole file, so saving keeps the other devices' profiles
+        self.spec = {}     # this device's profile as it's saved
+        self.curves = {}   # curve name -> compiled curve
+        self.listeners = []
+        if path and os.path.exists(path):
+            self.load()
+
+    # raises ValueError if the file or this device's profile is bad
+    def load(self):
+        try:
+            with open(self.path) as f:
+                profiles = json.load(f)
+        except (OSError, ValueError) as e:
+            raise ValueError("can't read calibration file {}: {}".format(self.path, e))
+        if not isinstance(profiles, dict):
+            raise ValueError("calibration file {} must hold an object of profiles".format(self.path))
+        # a device without its own profile starts from the default one, its changes are saved as its own
+        spec = profiles.get(self.profile, profiles.get(DEFAULT_PROFILE, {}))
+        curves = {}
+        for name in CURVES:
+            if name in spec:
+                curves[name] = compileCurve(spec[name])
+        if SEA_LEVEL in spec:
+            checkSeaLevel(spec[SEA_LEVEL])
+        self.mutex.acquire()
+        self.profiles = profiles
+        self.spec = dict(spec)
+        self.curves = curves
+        self.mutex.release()
+
+    # listener(name, value) is called with a curve name and its compiled curve, or SEA_LEVEL and the pressure
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    # the compiled curve or None if this device doesn't calibrate that sensor
+    def getCurve(self, name):
+        return self.curves.get(name)
+
+    def getSeaLevelPressure(self):
+        return self.spec.get(SEA_LEVEL)
+
+    def getProfile(self):
+        self.mutex.acquire()
+        spec = dict(self.spec)
+        self.mutex.release()
+        return spec
+
+    def getProfileName(self):
+        return self.profile
+
+    # raises ValueError and changes nothing if the curve is bad
+    def setCurve(self, name, spec):
+        if name not in CURVES:
+            raise ValueError("unknown calibration curve {}, choose from {}".format(name, ', '.join(CURVES)))
+        curve = compileCurve(spec)
+        self.mutex.acquire()
+        self.spec[name] = {'type': spec.get('type', 'linear'), 'points': [list(p) for p in spec['points']]}
+        self.curves[name] = curve
+        self.mutex.release()
+        self.notify(name, curve)
+        self.save()
+        return curve
+
+    # hPa, it drifts with the weather so it's refreshed from a nearby station now and then
+    def setSeaLevelPressure(self, value):
+        checkSeaLevel(value)
+        self.mutex.acquire()
+        self.spec[SEA_LEVEL] = value
+        self.mutex.release()
+        self.notify(SEA_LEVEL, value)
+        self.save()
+        return value
+
+    def notify(self, name, value):
+        for listener in self.listeners:
+            listener(name, value)
+
+    # write the file whole through a temporary file so a power cut can't leave half of it
+    # raises OSError if it can't be written, the change is still in use until the next restart
+    def save(self):
+        if not self.path:
+            return
+        self.mutex.acquire()
+        try:
+            self.profiles[self.profile] = self.spec
+            temp = self.path + '.tmp'
+            with open(temp, 'w') as f:
+                json.dump(self.profiles, f, indent=2)
+            os.replace(temp, self.path)
+        finally:
+            self.mutex.release()
+
+def checkSeaLevel(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+        raise ValueError("sea level pressure must be a positive number of hPa")
@@ -0,0 +1,220 @@
+import json
+import struct
+
+# Author: Peter Van Eenoo
+# CSS 532 IoT - class project
+# March 2021
+
+# payload encodings shared by the gateway and the test clients
+#
+# 'json' is what we have always sent. 'compact' is a small MessagePack style binary encoding, the
+# payload starts with the MAGIC byte (never valid at the start of JSON) so the receiver can tell
+# which one it got. On top of that any key or string value found in WORDS is sent as its index
+# instead of the whole string, so {"cumulative total": 12} is 4 bytes instead of 24
+#
+# the gateway answers each request in the encoding it arrived in, so each client picks its own
+
+ENCODINGS = ['json', 'compact']
+
+MAGIC = 0xC1
+WORD_EXT = 0x01 # ext type used for string values that are in WORDS
+
+# both sides must use the same table, only ever add words to the end of it. Only the first 128
+# words can be sent as keys, so keep it under that
+WORDS = ['get', 'set', 'setTime', 'deviceState', 'value', 'status', 'state', 'reading',
+         'temp', 'humidity', 'pressure', 'altitude', 'soil', 'water', 'led', 'info', 'cmd',
+         'on', 'off', 'clear', 'total', 'cumulative', 'time', 'bulk', 'uptime', 'timestamp',
+         'disconnect', 'reboot', 'halt', 'history', 'window', 'age', 'ts', 'min', 'max', 'mean',
+         'count', 'current total', 'cumulative total', 'watering set for', 'watering time',
+         'notifyWait', 'water on', 'water off', 'water interrupted', 'water already off',
+         'ActionDenied', 'busy', 'online', 'disconnecting', 'rebooting', 'halting', 'not sampled',
+         'outbox', 'lanes', 'queue depth', 'max depth', 'publish rate', 'published', 'publishes',
+         'depth', 'completed', 'rejected', 'topic', 'message', 'id', 'routes', 'stored', 'replayed']
+WORD_INDEX = {word: i for i, word in enumerate(WORDS)}
+
+# returns the payload bytes for obj in the requested encoding
+def encode(obj, encoding='json'):
+    if encoding == 'compact':
+        out = bytearray([MAGIC])
+        packValue(obj, out, False)
+        return bytes(out)
+    return json.dumps(obj).encode()
+
+# merges payloads already encoded with encode() into one payload that decodes as a list of them
+def join(parts, encoding='json'):
+    if encoding == 'compact':
+        out = bytearray([MAGIC])
+        packArrayHeader(len(parts), out)
+        for part in parts:
+            out += part[1:]
+        return bytes(out)
+    return b'[' + b','.join(parts) + b']'
+
+# returns (obj, encoding) for a payload in either encoding
+def decode(payload):
+    if payload and payload[0] == MAGIC:
+        obj, end = unpackValue(payload, 1)
+        return obj, 'compact'
+    return json.loads(payload), 'json'
+
+## compact encoder ##
+
+def packArrayHeader(n, out):
+    if n < 16:
+        out.append(0x90 | n)
+    elif n < 0x10000:
+        out += struct.pack('>BH', 0xdc, n)
+    else:
+        out += struct.pack('>BI', 0xdd, n)
+
+def packString(value, out):
+    data = value.encode()
+    n = len(data)
+    if n < 32:
+        out.append(0xa0 | n)
+    elif n < 256:
+        out += struct.pack('>BB', 0xd9, n)
+    elif n < 0x10000:
+        out += struct.pack('>BH', 0xda, n)
+    else:
+        out += struct.pack('>BI', 0xdb, n)
+    out += data
+
+# true if the value survives a round trip through a 32 bit float
+def isFloat32(value):
+    try:
+        return struct.unpack('>f', struct.pack('>f', value))[0] == value
+    except OverflowError:
+        return False
+
+def packValue(value, out, isKey):
+    if value is None:
+        out.append(0xc0)
+    elif value is True:
+        out.append(0xc3)
+    elif value is False:
+        out.append(0xc2)
+    elif isinstance(value, int):
+        if 0 <= value < 128:
+            out.append(value)
+        elif -32 <= value < 0:
+            out.append(value & 0xff)
+        elif -0x80000000 <= value < 0x80000000:
+            out += struct.pack('>Bi', 0xd2, value)
+        else:
+            out += struct.pack('>Bq', 0xd3, value)
+    elif isinstance(value, float):
+        # 32 bits only when it gives back exactly the same value, so nothing is lost next to JSON
+        if isFloat32(value):
+            out += struct.pack('>Bf', 0xca, value)
+        else:
+            out += struct.pack('>Bd', 0xcb, value)
+    elif isinstance(value, str):
+        index = WORD_INDEX.get(value)
+        if index is None or (isKey and index >= 128):
+            packString(value, out)
+        elif isKey:
+            # keys are always strings, so a small int key is a word index
+            out.append(index)
+        else:
+            out += struct.pack('>BbB', 0xd4, WORD_EXT, index)
+    elif isinstance(value, (bytes, bytearray)):
+        if len(value) < 0x10000:
+            out += struct.pack('>BH', 0xc5, len(value))
+        else:
+            out += struct.pack('>BI', 0xc6, len(value))
+        out += value
+    elif isinstance(value, (list, tuple)):
+        packArrayHeader(len(value), out)
+        for item in value:
+            packValue(item, out, False)
+    elif isinstance(value, dict):
+        n = len(value)
+        if n < 16:
+            out.append(0x80 | n)
+        elif n < 0x10000:
+            out += struct.pack('>BH', 0xde, n)
+        else:
+            out += struct.pack('>BI', 0xdf, n)
+        for key, item in value.items():
+            packValue(str(key), out, True)
+            packValue(item, out, False)
+    else:
+        raise TypeError("Can't encode {}".format(type(value)))
+
+## compact decoder ##
+
+# returns (value, offset just past it)
+def unpackValue(data, i):
+    b = data[i]
+    i += 1
+    if b < 0x80:
+        return b, i
+    if b >= 0xe0:
+        return b - 0x100, i
+    if b & 0xf0 == 0x80:
+        return unpackMap(data, i, b & 0x0f)
+    if b & 0xf0 == 0x90:
+        return unpackArray(data, i, b & 0x0f)
+    if b & 0xe0 == 0xa0:
+        n = b & 0x1f
+        return data[i:i + n].decode(), i + n
+    if b == 0xc0:
+        return None, i
+    if b == 0xc2:
+        return False, i
+    if b == 0xc3:
+        return True, i
+    if b == 0xca:
+        return struct.unpack_from('>f', data, i)[0], i + 4
+    if b == 0xcb:
+        return struct.unpack_from('>d', data, i)[0], i + 8
+    if b == 0xd2:
+        return struct.unpack_from('>i', data, i)[0], i + 4
+    if b == 0xd3:
+        return struct.unpack_from('>q', data, i)[0], i + 8
+    if b == 0xd4:
+        if data[i] != WORD_EXT:
+            raise ValueError("Unknown ext type {}".format(data[i]))
+        return WORDS[data[i + 1]], i + 2
+    if b == 0xd9:
+        n = data[i]
+        return data[i + 1:i + 1 + n].decode(), i + 1 + n
+    if b == 0xda:
+        n = struct.unpack_from('>H', data, i)[0]
+        return data[i + 2:i + 2 + n].decode(), i + 2 + n
+    if b == 0xdb:
+        n = struct.unpack_from('>I', data, i)[0]
+        return data[i + 4:i + 4 + n].decode(), i + 4 + n
+    if b == 0xc5:
+        n = struct.unpack_from('>H', data, i)[0]
+        return bytes(data[i + 2:i + 2 + n]), i + 2 + n
+    if b == 0xc6:
+        n = struct.unpack_from('>I', data, i)[0]
+        return bytes(data[i + 4:i + 4 + n]), i + 4 + n
+    if b == 0xdc:
+        return unpackArray(data, i + 2, struct.unpack_from('>H', data, i)[0])
+    if b == 0xdd:
+        return unpackArray(data, i + 4, struct.unpack_from('>I', data, i)[0])
+    if b == 0xde:
+        return unpackMap(data, i + 2, struct.unpack_from('>H', data, i)[0])
+    if b == 0xdf:
+        return unpackMap(data, i + 4, struct.unpack_from('>I', data, i)[0])
+    raise ValueError("Unknown type byte {:#x}".format(b))
+
+def unpackArray(data, i, n):
+    items = []
+    for _ in range(n):
+        item, i = unpackValue(data, i)
+        items.append(item)
+    return items, i
+
+def unpackMap(data, i, n):
+    obj = {}
+    for _ in range(n):
+        key, i = unpackValue(data, i)
+        if isinstance(key, int):
+            key = WORDS[key]
+        value, i = unpackValue(data, i)
+        obj[key] = value
+    return obj, i
@@ -0,0 +1,88 @@
+import threading
+import logging
+import queue
+
+# Author: Peter Van Eenoo
+# CSS 532 IoT - class project
+# March 2021
+
+LANE_DEPTH = 16 # default number of requests a lane will hold before it starts rejecting new ones
+
+# this class runs parsed requests on worker threads so the MQTT event-loop thread never blocks on
+# a sensor. Each subsystem gets its own lane (a bounded queue and its worker threads) so a slow
+# soil reading can't hold up a timestamp or LED request queued behind it
+class requestDispatcher:
+    # lanes maps each lane name to the number of worker threads it gets
+    def __init__(self, lanes, depth=LANE_DEPTH):
+        self.running = True
+        self.lanes = {}
+        self.rejected = {}
+        self.completed = {}
+        self.threads = [] # (lane, thread) pairs
+        self.statsMutex = threading.Lock() # the lanes' workers and submitters all update the counts
+        for lane in lanes:
+            self.lanes[lane] = queue.Queue(maxsize=depth)
+            self.rejected[lane] = 0
+            self.completed[lane] = 0
+            for i in range(lanes[lane]):
+                t = threading.Thread(name='{} lane {}'.format(lane, i), target=self.work, args=(lane,))
+                self.threads.append((lane, t))
+
+    def start(self):
+        for lane, t in self.threads:
+            t.start()
+
+    # tell every worker to finish its current request and exit, queued requests are dropped
+    def terminate(self):
+        self.running = False
+        for q in self.lanes.values():
+            while True:
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    break
+        # each worker exits when it gets a None, this only blocks until a busy worker takes one
+        for lane, t in self.threads:
+            self.lanes[lane].put(None)
+        for lane, t in self.threads:
+            t.join()
+
+    # queue func(*args) on the lane, returns False without blocking if the lane is full or unknown
+    def submit(self, lane, func, *args):
+        if not self.running or lane not in self.lanes:
+            return False
+        try:
+            self.lanes[lane].put_nowait((func, args))
+            return True
+        except queue.Full:
+            self.statsMutex.acquire()
+            self.rejected[lane] += 1
+            self.statsMutex.release()
+            logging.info("Lane '{}' is full, rejected request".format(lane))
+            return False
+
+    # per-lane queue depth, completed and rejected counts
+    def getStats(self):
+        stats = {}
+        self.statsMutex.acquire()
+        for lane in self.lanes:
+            stats[lane] = {'depth': self.lanes[lane].qsize(),
+                           'completed': self.completed[lane],
+                           'rejected': self.rejected[lane]}
+        self.statsMutex.release()
+        return stats
+
+    def work(self, lane):
+        q = self.lanes[lane]
+        while True:
+            job = q.get()
+            if job is None:
+                break
+            func, args = job
+            try:
+                func(*args)
+            except Exception as e:
+                logging.error("Request on lane '{}' failed: {}".format(lane, e))
+            self.statsMutex.acquire()
+            self.completed[lane] += 1
+            self.statsMutex.release()
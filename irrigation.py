@@ -0,0 +1,122 @@
+import threading
+import logging
+import time
+
+# Author: Peter Van Eenoo
+# CSS 532 IoT - class project
+# March 2021
+
+LOW_HUMIDITY = 30.0 # % soil humidity that starts a watering cycle
+HIGH_HUMIDITY = 45.0 # % that ends it, the gap keeps us from flapping around one threshold
+RUN_SECONDS = 10.0 # length of each automatic run
+MIN_INTERVAL = 1800.0 # seconds between automatic runs so the water can soak in before we judge it
+DAILY_BUDGET = 120.0 # seconds of automatic watering allowed per day
+
+# this class waters a zone on its own from the sampled soil humidity, so the cloud doesn't have to
+# poll the soil and send water commands back. Every new soil sample is a decision:
+#   at or above high, the soil is wet enough and any cycle ends
+#   below low, a cycle starts and we water every minInterval seconds until it's back above high
+#   no run is started while the zone is already watering, or once today's budget is spent
+# decisions happen on the sampler thread and only queue runs on the water scheduler, so they never block
+class irrigationController:
+    def __init__(self, getWater, zone=None, low=LOW_HUMIDITY, high=HIGH_HUMIDITY, runSeconds=RUN_SECONDS,
+                 minInterval=MIN_INTERVAL, dailyBudget=DAILY_BUDGET, enabled=True):
+        self.getWater = getWater # returns the waterManager, it may still be starting up
+        self.zone = zone # None is the water scheduler's default zone
+        self.runSeconds = runSeconds
+        self.minInterval = minInterval
+        self.dailyBudget = dailyBudget
+        # everything below is guarded by mutex
+        self.mutex = threading.Lock()
+        self.enabled = enabled
+        self.low = low
+        self.high = high
+        self.cycle = False # true from dropping below low until we are back above high
+        self.lastRun = None # monotonic time of the last automatic run
+        self.day = None # (year, day of the year) the budget was last reset
+        self.usedToday = 0.0
+        self.lastReading = None
+        self.lastDecision = None
+        self.decisions = 0
+        self.runs = 0
+
+    # sampler listener, values has the 'soil' channel
+    def onSample(self, values, ts):
+        self.decide(values['soil'], ts)
+
+    # returns what was decided, it's also kept for getStatus()
+    def decide(self, humidity, now=None):
+        if now is None:
+            now = time.monotonic()
+        self.mutex.acquire()
+        try:
+            decision = self.decideLocked(humidity, now)
+            self.lastReading = humidity
+            self.lastDecision = decision
+            self.decisions += 1
+            return decision
+        finally:
+            self.mutex.release()
+
+    def decideLocked(self, humidity, now):
+        if not self.enabled:
+            return 'disabled'
+        local = time.localtime()
+        today = (local.tm_year, local.tm_yday)
+        if today != self.day:
+            self.day = today
+            self.usedToday = 0.0
+        if humidity >= self.high:
+            self.cycle = False
+            return 'wet'
+        if humidity < self.low:
+            self.cycle = True
+        if not self.cycle:
+            return 'ok'
+        water = self.getWater()
+        if water.isBusy(self.zone):
+            return 'watering'
+        if self.lastRun is not None and now - self.lastRun < self.minInterval:
+            return 'soaking'
+        seconds = min(self.runSeconds, self.dailyBudget - self.usedToday)
+        if seconds <= 0:
+            return 'budget spent'
+        if water.queueRun(self.zone, seconds) is None:
+            return 'queue full'
+        self.usedToday += seconds
+        self.lastRun = now
+        self.runs += 1
+        logging.info("Automatic watering for {:.1f}s at {:.1f}% soil humidity".format(seconds, humidity))
+        return 'water'
+
+    def setEnabled(self, enabled):
+        self.mutex.acquire()
+        self.enabled = enabled
+        if not enabled:
+            self.cycle = False
+        self.mutex.release()
+
+    # returns False and changes nothing unless low is below high
+    def setThresholds(self, low, high):
+        if not low < high:
+            return False
+        self.mutex.acquire()
+        self.low = low
+        self.high = high
+        self.mutex.release()
+        return True
+
+    def getStatus(self):
+        self.mutex.acquire()
+        status = {'enabled': self.enabled,
+                  'low': self.low,
+                  'high': self.high,
+                  'cycle': self.cycle,
+                  'last reading': self.lastReading,
+                  'last decision': self.lastDecision,
+                  'decisions': self.decisions,
+                  'runs': self.runs,
+                  'used today': self.usedToday,
+                  'daily budget': self.dailyBudget}
+        self.mutex.release()
+        return status
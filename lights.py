@@ -1,37 +1,203 @@
-import RPi.GPIO as GPIO    # Import Raspberry Pi GPIO library
-from time import sleep     # Import the sleep function from the time module
+import heapq
 import threading
+import time
+import backend
 
 # Author: Peter Van Eenoo
 # CSS 532 IoT - class project
 # March 2021
 
 LED_PIN = 21  # the choses GPIO 21/physical pin 40, for blinking our LED
-GPIO.setwarnings(False)    # Ignore warning for now
-#GPIO.setmode(GPIO.BOARD)   # Use physical pin numbering
-GPIO.setup(LED_PIN, GPIO.OUT, initial=GPIO.LOW)   # Set pin 40 to be the output pin and set it LOW by default
-BLINK_SPEED = 0.7
-TIMEOUT = 2
+BLINK_SPEED = 0.7 # seconds on and then off for the default blink
+BLINK_RATE = 1 / (2 * BLINK_SPEED) # Hz
+MAX_RATE = 25.0 # fastest blink in Hz, much faster and the engine thread's wake-ups start to cost us
+MAX_PULSES = 20
+PULSE_RATE = 4.0 # Hz of the pulses in a pulse code
+PULSE_GAP = 1.5 # seconds dark between repeats of a pulse code
 
-# this class manages a blinking LED, it can be inturrupted by the user
-class ledManager:
-    def __init__(self, e):
-        self.running = True
-        self.event = e
+## patterns ##
 
-    def terminate(self):
-        self.running = False
+# an LED pattern is a list of (on, seconds) steps. A step of None seconds is held until the pattern
+# changes, otherwise the steps repeat from the start or, if repeat is False, the last one is held
+class ledPattern:
+    def __init__(self, name, steps, repeat=True):
+        self.name = name
+        self.steps = steps
+        self.repeat = repeat
+
+    def isOff(self):
+        return all(not on for on, seconds in self.steps)
+
+def steady(on=True):
+    return ledPattern('steady' if on else 'off', [(on, None)])
+
+# rate in Hz, duty is the fraction of each period the LED is lit
+def blink(rate=BLINK_RATE, duty=0.5):
+    if not 0 < rate <= MAX_RATE:
+        raise ValueError("blink rate must be above 0 and at most {} Hz".format(MAX_RATE))
+    if not 0 <= duty <= 1:
+        raise ValueError("duty cycle must be between 0 and 1")
+    if duty in (0, 1):
+        return steady(duty == 1)
+    period = 1.0 / rate
+    return ledPattern('blink', [(True, period * duty), (False, period * (1 - duty))])
+
+# count quick pulses then a dark gap, used for blink codes like 3 pulses for an error
+def pulses(count, rate=PULSE_RATE, duty=0.5, gap=PULSE_GAP, repeat=True):
+    if not 1 <= count <= MAX_PULSES:
+        raise ValueError("pulse count must be between 1 and {}".format(MAX_PULSES))
+    if not 0 < rate <= MAX_RATE or not 0 < duty < 1:
+        raise ValueError("pulse rate or duty cycle is out of range")
+    period = 1.0 / rate
+    steps = [(True, period * duty), (False, period * (1 - duty))] * count
+    if repeat:
+        steps[-1] = (False, period * (1 - duty) + gap)
+    else:
+        steps[-1] = (False, None)
+    return ledPattern('pulse', steps, repeat)
+
+## engine ##
+
+# one thread drives every LED's pattern from a heap of switching deadlines, it sleeps until the next
+# deadline and is woken early when a pattern changes. A new pattern's first step is written to the
+# pin right away by whoever set it, so the LED reacts immediately instead of on the next wake-up
+class ledEngine:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.schedule = [] # heap of (deadline, sequence, generation, led)
+        self.sequence = 0  # breaks ties in the heap so LEDs are never compared
+        self.leds = []
+        self.thread = None
+
+    def register(self, led):
+        self.cond.acquire()
+        self.leds.append(led)
+        if self.thread is None:
+            self.thread = threading.Thread(name='LED engine', target=self.run)
+            self.thread.start()
+        self.cond.release()
+
+    # the engine thread exits once its last LED is gone
+    def unregister(self, led):
+        self.cond.acquire()
+        if led in self.leds:
+            self.leds.remove(led)
+        led.generation += 1 # drops its scheduled steps
+        thread = self.thread if not self.leds else None
+        if thread:
+            self.thread = None
+        self.cond.notify()
+        self.cond.release()
+        if thread and thread is not threading.current_thread():
+            thread.join()
+
+    # switch the LED to a new pattern, starting from its first step
+    def setPattern(self, led, pattern):
+        self.cond.acquire()
+        led.pattern = pattern
+        led.generation += 1 # anything still scheduled for the old pattern is ignored
+        led.step = 0
+        self.apply(led, time.monotonic())
+        self.cond.notify()
+        self.cond.release()
+
+    # write the LED's current step and schedule the next one, called with cond held
+    def apply(self, led, start):
+        on, seconds = led.pattern.steps[led.step]
+        led.write(on)
+        if seconds is not None:
+            self.sequence += 1
+            heapq.heappush(self.schedule, (start + seconds, self.sequence, led.generation, led))
+
+    def advance(self, led, deadline):
+        led.step += 1
+        if led.step == len(led.pattern.steps):
+            if not led.pattern.repeat:
+                led.step -= 1 # hold the last step
+                return
+            led.step = 0
+        # the next step starts at this step's deadline so the rate doesn't drift, unless we are
+        # already past its end too, then it's better to start fresh from now
+        start = deadline
+        seconds = led.pattern.steps[led.step][1]
+        now = time.monotonic()
+        if seconds is not None and now - deadline > seconds:
+            start = now
+        self.apply(led, start)
 
-    def start(self):
+    def run(self):
+        self.cond.acquire()
+        while self.leds:
+            now = time.monotonic()
+            while self.schedule and self.schedule[0][0] <= now:
+                deadline, sequence, generation, led = heapq.heappop(self.schedule)
+                if generation == led.generation:
+                    self.advance(led, deadline)
+            timeout = self.schedule[0][0] - now if self.schedule else None
+            self.cond.wait(timeout)
+        self.schedule = []
+        self.cond.release()
+
+# the shared engine every ledManager uses unless it's given its own
+ENGINE = None
+engineMutex = threading.Lock()
+
+def getEngine():
+    global ENGINE
+    engineMutex.acquire()
+    if ENGINE is None:
+        ENGINE = ledEngine()
+    engineMutex.release()
+    return ENGINE
+
+# this class manages one LED's pattern, it can be changed by the user at any time
+class ledManager:
+    def __init__(self, pin=LED_PIN, engine=None, shadow=None):
+        self.pin = pin
+        self.engine = engine or getEngine()
+        self.shadow = shadow # the device shadow we report our pattern to
+        self.gpio = backend.getBackend().gpio
+        self.gpio.setwarnings(False)    # Ignore warning for now
+        #self.gpio.setmode(self.gpio.BOARD)   # Use physical pin numbering
+        self.gpio.setup(pin, self.gpio.OUT, initial=self.gpio.LOW)   # Set pin 40 to be the output pin and set it LOW by default
+        self.lit = False
+        # the engine's state for this LED, guarded by the engine's cond
+        self.pattern = steady(False)
+        self.step = 0
+        self.generation = 0
+        self.engine.register(self)
+        self.reportState()
         print("LED system starting")
-        while self.running:
-            self.event.wait(TIMEOUT) # block until main thread gets signal to turn on led
-            while self.event.isSet() and self.running: # if we get terminated while inside this loop 
-                # we can get stuck unless we check both states
-                GPIO.output(LED_PIN, GPIO.HIGH) # Turn on
-                sleep(BLINK_SPEED) 
-                GPIO.output(LED_PIN, GPIO.LOW) # Turn off
-                sleep(BLINK_SPEED) 
-    
-        print("LED system terminating")
 
+    def write(self, on):
+        self.gpio.output(self.pin, self.gpio.HIGH if on else self.gpio.LOW)
+        self.lit = on
+
+    # reported under the engine's lock so two changes can't report in the wrong order
+    def setPattern(self, pattern):
+        self.engine.cond.acquire()
+        self.engine.setPattern(self, pattern)
+        self.reportState()
+        self.engine.cond.release()
+
+    # the pattern, not every blink, blinks would change the shadow many times a second
+    def reportState(self):
+        if self.shadow:
+            pattern = self.pattern
+            self.shadow.report('led', {'status': 'off' if pattern.isOff() else 'on', 'pattern': pattern.name})
+
+    def getPattern(self):
+        return self.pattern
+
+    # true unless the LED has been turned off
+    def isOn(self):
+        return not self.pattern.isOff()
+
+    # true if the LED is lit right now
+    def isLit(self):
+        return self.lit
+
+    def terminate(self):
+        self.setPattern(steady(False))
+        self.engine.unregister(self)
+        print("LED system terminating")
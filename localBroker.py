@@ -0,0 +1,318 @@
+import argparse
+import logging
+import queue
+import socket
+import struct
+import threading
+from concurrent.futures import Future
+
+# Author: Peter Van Eenoo
+# CSS 532 IoT - class project
+# March 2021
+
+# a stand-in for the AWS IoT broker so the gateway and the test clients can run with no
+# network or certificates. The connections here have the same surface as the awscrt connection from
+# mqtt_connection_builder that we use: connect, subscribe with + and # wildcards, publish, disconnect,
+# resubscribe_existing_topics and the interrupted/resumed callbacks
+#
+# "inproc" gives a connection to a broker inside this process. "host:port" connects to a broker
+# running in another process on this machine, start one with:  python3 localBroker.py --port 1884
+#
+# there's no QoS, retained messages or sessions, every message is delivered at most once
+
+PORT = 1884
+OP_SUBSCRIBE = 1
+OP_UNSUBSCRIBE = 2
+OP_PUBLISH = 3
+HEADER = struct.Struct('>BHI') # op, topic length, payload length
+
+# true if an MQTT topic filter matches the topic
+def topicMatches(topicFilter, topic):
+    filterParts = topicFilter.split('/')
+    topicParts = topic.split('/')
+    for i, part in enumerate(filterParts):
+        if part == '#':
+            return True
+        if i >= len(topicParts):
+            return False
+        if part != '+' and part != topicParts[i]:
+            return False
+    return len(filterParts) == len(topicParts)
+
+def doneFuture(result=None):
+    future = Future()
+    future.set_result(result)
+    return future
+
+# matches published messages against subscriptions and delivers them on its own thread, the same way
+# the awscrt event-loop thread calls our callbacks
+class localBroker:
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.subscriptions = [] # (topic filter, owner, callback)
+        self.deliveries = queue.Queue()
+        self.delivered = 0
+        self.thread = threading.Thread(name='Local broker', target=self.deliver, daemon=True)
+        self.thread.start()
+
+    def subscribe(self, topicFilter, owner, callback):
+        self.mutex.acquire()
+        self.subscriptions = [s for s in self.subscriptions if not (s[0] == topicFilter and s[1] is owner)]
+        self.subscriptions.append((topicFilter, owner, callback))
+        self.mutex.release()
+
+    def unsubscribe(self, topicFilter, owner):
+        self.mutex.acquire()
+        self.subscriptions = [s for s in self.subscriptions if not (s[0] == topicFilter and s[1] is owner)]
+        self.mutex.release()
+
+    # drop every subscription belonging to owner
+    def removeOwner(self, owner):
+        self.mutex.acquire()
+        self.subscriptions = [s for s in self.subscriptions if s[1] is not owner]
+        self.mutex.release()
+
+    def publish(self, topic, payload):
+        self.deliveries.put((topic, payload))
+
+    def deliver(self):
+        while True:
+            topic, payload = self.deliveries.get()
+            # the list is replaced rather than changed so we can walk it without the lock
+            for topicFilter, owner, callback in self.subscriptions:
+                if topicMatches(topicFilter, topic):
+                    try:
+                        callback(topic=topic, payload=payload, dup=False, qos=0, retain=False)
+                    except Exception as e:
+                        logging.error("Subscriber callback for {} failed: {}".format(topic, e))
+                    self.delivered += 1
+
+# the shared broker for "inproc" connections
+BROKER = None
+brokerMutex = threading.Lock()
+
+def getBroker():
+    global BROKER
+    brokerMutex.acquire()
+    if BROKER is None:
+        BROKER = localBroker()
+    brokerMutex.release()
+    return BROKER
+
+# behaves like the awscrt mqtt Connection
+class localConnection:
+    def __init__(self, broker, client_id, on_connection_interrupted=None, on_connection_resumed=None):
+        self.broker = broker
+        self.client_id = client_id
+        self.on_connection_interrupted = on_connection_interrupted
+        self.on_connection_resumed = on_connection_resumed
+        self.topics = {} # topic filter -> (qos, callback), kept so we can resubscribe
+        self.connected = False
+        self.packetId = 0
+
+    def nextPacketId(self):
+        self.packetId += 1
+        return self.packetId
+
+    def connect(self):
+        self.connected = True
+        return doneFuture({'session_present': False})
+
+    def disconnect(self):
+        self.connected = False
+        self.broker.removeOwner(self)
+        return doneFuture()
+
+    def subscribe(self, topic, qos, callback=None):
+        self.topics[topic] = (qos, callback)
+        self.broker.subscribe(topic, self, callback)
+        packetId = self.nextPacketId()
+        return doneFuture({'packet_id': packetId, 'topic': topic, 'qos': qos}), packetId
+
+    def unsubscribe(self, topic):
+        self.topics.pop(topic, None)
+        self.broker.unsubscribe(topic, self)
+        packetId = self.nextPacketId()
+        return doneFuture({'packet_id': packetId}), packetId
+
+    def resubscribe_existing_topics(self):
+        for topic, (qos, callback) in self.topics.items():
+            self.broker.subscribe(topic, self, callback)
+        packetId = self.nextPacketId()
+        return doneFuture({'packet_id': packetId,
+                           'topics': [(topic, qos) for topic, (qos, callback) in self.topics.items()]}), packetId
+
+    def publish(self, topic, payload, qos, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if self.connected:
+            self.broker.publish(topic, payload)
+        return doneFuture({'packet_id': 0}), 0
+
+    # simulate the link dropping, messages published while interrupted are lost like on a real link
+    def interrupt(self, error="simulated interruption"):
+        self.connected = False
+        self.broker.removeOwner(self)
+        if self.on_connection_interrupted:
+            self.on_connection_interrupted(connection=self, error=error)
+
+    # simulate the link coming back without a session, so the owner has to resubscribe
+    def resume(self):
+        self.connected = True
+        if self.on_connection_resumed:
+            self.on_connection_resumed(connection=self, return_code=0, session_present=False)
+
+## loopback server and client ##
+
+def sendFrame(sock, sendMutex, op, topic, payload):
+    topicBytes = topic.encode()
+    sendMutex.acquire()
+    try:
+        sock.sendall(HEADER.pack(op, len(topicBytes), len(payload)) + topicBytes + payload)
+    finally:
+        sendMutex.release()
+
+def recvExactly(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return bytes(data)
+
+def recvFrame(sock):
+    op, topicLength, payloadLength = HEADER.unpack(recvExactly(sock, HEADER.size))
+    topic = recvExactly(sock, topicLength).decode()
+    payload = recvExactly(sock, payloadLength)
+    return op, topic, payload
+
+# one remote client on the server side, its subscriptions forward messages back down its socket
+class remoteClient:
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.sendMutex = threading.Lock()
+
+    def forward(self, topic, payload, **kwargs):
+        sendFrame(self.sock, self.sendMutex, OP_PUBLISH, topic, payload)
+
+    def serve(self):
+        try:
+            while True:
+                op, topic, payload = recvFrame(self.sock)
+                if op == OP_SUBSCRIBE:
+                    self.broker.subscribe(topic, self, self.forward)
+                elif op == OP_UNSUBSCRIBE:
+                    self.broker.unsubscribe(topic, self)
+                elif op == OP_PUBLISH:
+                    self.broker.publish(topic, payload)
+        except (ConnectionError, OSError):
+            pass
+        self.broker.removeOwner(self)
+        self.sock.close()
+
+# accepts loopback connections and serves them from a local broker, blocks forever
+def serve(port=PORT, host='127.0.0.1'):
+    broker = getBroker()
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen()
+    logging.info("Local broker listening on {}:{}".format(host, port))
+    while True:
+        sock, address = server.accept()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = remoteClient(broker, sock)
+        threading.Thread(name='Broker client {}'.format(address), target=client.serve, daemon=True).start()
+
+# the client side of a loopback connection, same surface as localConnection
+class loopbackConnection(localConnection):
+    def __init__(self, host, port, client_id, on_connection_interrupted=None, on_connection_resumed=None):
+        localConnection.__init__(self, None, client_id, on_connection_interrupted, on_connection_resumed)
+        self.address = (host, port)
+        self.sock = None
+        self.sendMutex = threading.Lock()
+
+    def connect(self):
+        self.sock = socket.create_connection(self.address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connected = True
+        threading.Thread(name='Loopback reader', target=self.read, daemon=True).start()
+        return doneFuture({'session_present': False})
+
+    def disconnect(self):
+        self.connected = False
+        if self.sock:
+            self.sock.close()
+        return doneFuture()
+
+    # incoming messages are delivered on the reader thread
+    def read(self):
+        try:
+            while True:
+                op, topic, payload = recvFrame(self.sock)
+                for topicFilter, (qos, callback) in list(self.topics.items()):
+                    if callback and topicMatches(topicFilter, topic):
+                        callback(topic=topic, payload=payload, dup=False, qos=0, retain=False)
+        except (ConnectionError, OSError):
+            pass
+        if self.connected:
+            self.connected = False
+            if self.on_connection_interrupted:
+                self.on_connection_interrupted(connection=self, error="loopback connection lost")
+
+    def subscribe(self, topic, qos, callback=None):
+        self.topics[topic] = (qos, callback)
+        sendFrame(self.sock, self.sendMutex, OP_SUBSCRIBE, topic, b'')
+        packetId = self.nextPacketId()
+        return doneFuture({'packet_id': packetId, 'topic': topic, 'qos': qos}), packetId
+
+    def unsubscribe(self, topic):
+        self.topics.pop(topic, None)
+        sendFrame(self.sock, self.sendMutex, OP_UNSUBSCRIBE, topic, b'')
+        packetId = self.nextPacketId()
+        return doneFuture({'packet_id': packetId}), packetId
+
+    def resubscribe_existing_topics(self):
+        for topic in self.topics:
+            sendFrame(self.sock, self.sendMutex, OP_SUBSCRIBE, topic, b'')
+        packetId = self.nextPacketId()
+        return doneFuture({'packet_id': packetId,
+                           'topics': [(topic, qos) for topic, (qos, callback) in self.topics.items()]}), packetId
+
+    def publish(self, topic, payload, qos, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if self.connected:
+            sendFrame(self.sock, self.sendMutex, OP_PUBLISH, topic, payload)
+        return doneFuture({'packet_id': 0}), 0
+
+    # drop the socket, the reader thread notices and calls on_connection_interrupted
+    def interrupt(self, error="simulated interruption"):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    # reconnect without a session, the owner has to resubscribe from on_connection_resumed
+    def resume(self):
+        self.connect()
+        if self.on_connection_resumed:
+            self.on_connection_resumed(connection=self, return_code=0, session_present=False)
+
+# returns a connection for --local-broker, "inproc" or "host:port"
+def buildConnection(address, client_id, on_connection_interrupted=None, on_connection_resumed=None):
+    if address == 'inproc':
+        return localConnection(getBroker(), client_id, on_connection_interrupted, on_connection_resumed)
+    host, _, port = address.rpartition(':')
+    return loopbackConnection(host or '127.0.0.1', int(port or PORT), client_id,
+                              on_connection_interrupted, on_connection_resumed)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local MQTT stand-in for testing without AWS IoT.")
+    parser.add_argument('--port', type=int, default=PORT, help="Port to listen on.")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    serve(args.port, args.host)
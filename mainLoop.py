@@ -8,6 +8,8 @@
 # CSS 532 IoT - class project
 # March 2021
 
+import time
+START_TIME = time.monotonic() # taken before the other imports so the startup timing includes them
 import os
 import argparse
 from awscrt import io, mqtt, auth, http
@@ -15,15 +17,25 @@ from awsiot import mqtt_connection_builder
 import sys
 import threading
 import logging
-import time
-from collections import deque
 from uptime import uptime
 from datetime import timedelta
-import json
 import weatherSensor as ws
 import lights as led
 import soilHumidity as soil
 import waterController as water
+import irrigation
+import calibration
+from publisher import SensorMessage, messagePublisher, BATCH_DELAY, REPLAY_RATE
+from outbox import persistentOutbox, MAX_MESSAGES, EVICT_POLICIES
+from dispatcher import requestDispatcher, LANE_DEPTH
+from sampler import sampleManager, HISTORY_SIZE
+from router import topicRouter, echoFilter
+from observer import observeManager, DEFAULT_PMIN, DEFAULT_PMAX
+from shadow import deviceShadow
+import codec
+import localBroker
+import backend
+from startup import startupTimer, subsystemLoader
 from datetime import datetime
 
 ## logging setup for different test methods
@@ -34,23 +46,12 @@ from datetime import datetime
 #logging.basicConfig(filename='debug.log', level=logging.DEBUG)
 logging.basicConfig(filename='info.log', level=logging.INFO)
 
-
-# this simple class holds a message and a topic string
-# we will then create a deque that holds SensorMessages
-class SensorMessage:
-    def __init__(self, topic, message):
-        self.topic = topic
-        self.message = message
-    def getTopic(self):
-        return self.topic
-
-    def getMessage(self):
-        return self.message
-
 # grab and parse the arguments
 parser = argparse.ArgumentParser(description="Send and receive messages through and MQTT connection.")
-parser.add_argument('--endpoint', required=True, help="Your AWS IoT custom endpoint, not including a port. " +
+parser.add_argument('--endpoint', help="Your AWS IoT custom endpoint, not including a port. " +
         "Ex: \"abcd123456wxyz-ats.iot.us-east-1.amazonaws.com\"")
+parser.add_argument('--local-broker', help="Use the local MQTT stand-in instead of AWS IoT, either \"inproc\" " +
+        "or the host:port of a broker started with localBroker.py.")
 parser.add_argument('--cert', help="File path to your client certificate, in PEM format.")
 parser.add_argument('--key', help="File path to your private key, in PEM format.")
 parser.add_argument('--root-ca', help="File path to root certificate authority, in PEM format. " +
@@ -62,15 +63,83 @@ parser.add_argument('--message', default="Hello World!", help="Message to publis
         "Specify empty string to publish nothing.")
 parser.add_argument('--verbosity', choices=[x.name for x in io.LogLevel], default=io.LogLevel.NoLogs.name,
         help='Logging level')
+parser.add_argument('--backend', choices=list(backend.BACKENDS), default=backend.DEFAULT_BACKEND, help="Hardware " +
+        "to drive: the Pi's GPIO and i2c sensors, stubs that return fixed values, or simulated sensors. " +
+        "Defaults to the IOT_BACKEND environment variable, or real.")
+parser.add_argument('--sim-latency', type=float, default=1000 * backend.SIM_LATENCY, help="Milliseconds each " +
+        "simulated bus transaction takes with --backend sim.")
+parser.add_argument('--sim-noise', type=float, default=backend.SIM_NOISE, help="Standard deviation of the " +
+        "simulated readings as a fraction of their value with --backend sim.")
+parser.add_argument('--weather-ttl', type=float, default=ws.SNAPSHOT_TTL, help="Seconds a BME280 snapshot " +
+        "is shared between weather requests before the sensor is read again.")
+parser.add_argument('--soil-max-age', type=float, default=soil.MAX_AGE, help="Seconds a soil reading is " +
+        "reused before the probe is powered again, 0 reads every time.")
+parser.add_argument('--calibration', help="JSON file of per-device calibration profiles, changes made over MQTT " +
+        "are saved back to it.")
+parser.add_argument('--calibration-profile', help="Calibration profile to use, the client ID by default.")
+parser.add_argument('--soil-samples', type=int, default=soil.BURST_SAMPLES, help="ADC samples taken in each " +
+        "powered soil reading, more than 1 reads a burst at the ADC's fast data rate.")
+parser.add_argument('--soil-reduce', choices=soil.REDUCERS, default='median', help="Reduce a burst of soil " +
+        "samples to their median or trimmed mean.")
+parser.add_argument('--soil-trim', type=float, default=soil.TRIM_FRACTION, help="Fraction of the lowest and of " +
+        "the highest samples the trimmed mean drops.")
+parser.add_argument('--zones', default=','.join('{}:{}'.format(name, pin) for name, pin in water.DEFAULT_ZONES),
+        help="Comma separated name:GPIO pin of each watering zone's valve, the first is the zone the " +
+        "single-valve water commands act on. Ex: \"front:20,back:19,beds:26\"")
+parser.add_argument('--max-valves', type=int, default=water.MAX_CONCURRENT, help="Most zone valves open at " +
+        "once, queued runs wait for a free slot. 1 waters the zones one after the other.")
+parser.add_argument('--sample-weather', type=float, default=0, help="Seconds between background samples " +
+        "of the BME280, 0 disables sampling and reads the sensor on request.")
+parser.add_argument('--sample-soil', type=float, default=0, help="Seconds between background samples " +
+        "of the soil humidity probe, 0 disables sampling and reads the probe on request.")
+parser.add_argument('--auto-water', action='store_true', help="Water on the device when the sampled soil " +
+        "humidity drops too low, needs --sample-soil.")
+parser.add_argument('--auto-low', type=float, default=irrigation.LOW_HUMIDITY, help="Soil humidity %% below which " +
+        "automatic watering starts.")
+parser.add_argument('--auto-high', type=float, default=irrigation.HIGH_HUMIDITY, help="Soil humidity %% at which " +
+        "automatic watering stops.")
+parser.add_argument('--auto-seconds', type=float, default=irrigation.RUN_SECONDS, help="Length of each automatic " +
+        "watering run in seconds.")
+parser.add_argument('--auto-interval', type=float, default=irrigation.MIN_INTERVAL, help="Fewest seconds between " +
+        "automatic runs, for the water to soak in.")
+parser.add_argument('--auto-budget', type=float, default=irrigation.DAILY_BUDGET, help="Most seconds of automatic " +
+        "watering per day.")
+parser.add_argument('--auto-zone', help="Zone watered automatically, the first zone by default.")
+parser.add_argument('--history-size', type=int, default=HISTORY_SIZE, help="Number of samples of history " +
+        "kept for each sampled sensor.")
+parser.add_argument('--encoding', choices=codec.ENCODINGS, default='json', help="Payload encoding for messages " +
+        "we send on our own, replies use the encoding the request arrived in.")
+parser.add_argument('--batch-bytes', type=int, default=0, help="Merge queued messages into batches of up to " +
+        "this many bytes before publishing, 0 disables batching.")
+parser.add_argument('--batch-delay', type=float, default=BATCH_DELAY, help="Longest time in seconds a message " +
+        "waits in a batch before it's published.")
+parser.add_argument('--batch-topic', help="Publish every batch on this topic as a list of topic/message pairs " +
+        "instead of merging messages per topic.")
+parser.add_argument('--outbox-db', help="SQLite file to keep outgoing messages in while the connection is down, " +
+        "they are replayed when it comes back. Without it messages sent while offline are lost.")
+parser.add_argument('--outbox-max', type=int, default=MAX_MESSAGES, help="Most messages kept in the outbox " +
+        "file before the eviction policy drops some.")
+parser.add_argument('--outbox-evict', choices=EVICT_POLICIES, default='oldest', help="Drop the oldest messages, " +
+        "or the lowest priority ones (command and info replies first) when the outbox is full.")
+parser.add_argument('--replay-rate', type=float, default=REPLAY_RATE, help="Messages per second replayed from " +
+        "the outbox after reconnecting.")
+parser.add_argument('--reply-topic', choices=['same', 'split'], default='same', help="Reply on the request's " +
+        "topic, or split replies onto sensors/{thing}/{client}/reply so requests and replies don't share a topic.")
+parser.add_argument('--publish-shadow', action='store_true', help="Publish the device shadow on " +
+        "sensors/shadow/{client} every time an actuator's state changes.")
+parser.add_argument('--lane-depth', type=int, default=LANE_DEPTH, help="Number of requests each subsystem lane " +
+        "will queue before new requests are rejected as busy.")
 
 # Callback when connection is accidentally lost.
 def on_connection_interrupted(connection, error, **kwargs):
     logging.info("Connection interrupted. error: {}".format(error))
+    publisher.setOnline(False)
 
 
 # Callback when an interrupted connection is re-established.
 def on_connection_resumed(connection, return_code, session_present, **kwargs):
     logging.info("Connection resumed. return_code: {} session_present: {}".format(return_code, session_present))
+    publisher.setOnline(True)
 
     if return_code == mqtt.ConnectReturnCode.ACCEPTED and not session_present:
         print("Session did not persist. Resubscribing to existing topics...")
@@ -91,60 +160,169 @@ def on_resubscribe_complete(resubscribe_future):
 
 ## end of Amazon Sample code ##
 
+# "front:20,back:19" -> [('front', 20), ('back', 19)], a bare pin is named after its place in the list
+# raises ValueError on a bad pin or a zone name or pin that's used twice
+def parseZones(zones):
+    parsed = []
+    for i, zone in enumerate(zones.split(',')):
+        name, _, pin = zone.strip().rpartition(':')
+        name = name or 'zone{}'.format(i + 1)
+        try:
+            pin = int(pin)
+        except ValueError:
+            raise ValueError("zone {} needs a GPIO pin number, got '{}'".format(name, pin))
+        if any(name == other for other, otherPin in parsed):
+            raise ValueError("zone {} is given twice".format(name))
+        if any(pin == otherPin for other, otherPin in parsed):
+            raise ValueError("GPIO pin {} is given to more than one zone".format(pin))
+        parsed.append((name, pin))
+    return parsed
+
 ###### Gloabls area for main program and setup #########
 args = parser.parse_args()
+# argparse doesn't check a default against the choices, so a bad IOT_BACKEND gets here
+if args.backend not in backend.BACKENDS:
+    parser.error("argument --backend: invalid choice: '{}' from IOT_BACKEND (choose from {})".format(
+        args.backend, ', '.join(backend.BACKENDS)))
+if not args.endpoint and not args.local_broker:
+    parser.error("one of --endpoint or --local-broker is required")
+if args.auto_water and args.sample_soil <= 0:
+    parser.error("--auto-water needs --sample-soil")
+if not args.auto_low < args.auto_high:
+    parser.error("--auto-low must be below --auto-high")
+try:
+    ZONES = parseZones(args.zones)
+except ValueError as e:
+    parser.error("argument --zones: {}".format(e))
+try:
+    calibrationStore = calibration.calibrationStore(args.calibration, args.calibration_profile or args.client_id)
+except ValueError as e:
+    parser.error(str(e))
 
 io.init_logging(getattr(io.LogLevel, args.verbosity), 'stderr')
 
 global received_count
 received_count = 0
 received_all_event = threading.Event()
-OUTBOX = deque() # create a linked list to handle messages for sensor readings to send to AWS
-LOOP_TIMEOUT = 5 # Time timeout for the message sending loop, use this or it will never check to see if we have disconnected
 
 global CONNECTED 
 WATERING_TIME_SEC = 8 # the default ammount of time to water
 
-# the list of supported actions our program will response to
-SUPPORTED_ACTIONS = ['get','set', 'setTime', 'deviceState']
-
 # can be set to reboot or halt
 ACTION_ON_TERMINATION = ""
 
+# each subsystem has its own worker lane so slow sensors don't hold up the fast ones, with the
+# number of workers in each. Soil value requests share the reading in flight without taking a worker,
+# see shareSoilReading(), so the soil lane needs one to power the probe and one for the history
+LANES = {'weather': 1, 'soil': 2, 'water': 1, 'led': 1, 'info': 1, 'cmd': 1}
+SOIL_VALUES = ['value', 'status', 'reading'] # the soil "get"s that read the probe
 
-SUB_TOPIC = f"sensors/+/{args.client_id}"
-## main program message event to wake-up and check for messages
-msgEvent = threading.Event()
-
-
-# globals done, start up the sensor subsystems
-logging.info("Starting up sensor subsystems")
-ledEvent = threading.Event()
-waterEvent = threading.Event()
 
-ledObj = led.ledManager(ledEvent)
-waterObj = water.waterManager(waterEvent, WATERING_TIME_SEC)
-soilObj = soil.soilManager()
-
-ledThread = threading.Thread(name='LED subsystem', target=ledObj.start)
-waterThread = threading.Thread(name='Water subsystem', target=waterObj.start)
-
-ledThread.start()
-waterThread.start()
-logging.info("All sensor subsystems started")
+SUB_TOPIC = f"sensors/+/{args.client_id}"
+REPLY_SUFFIX = 'reply' # with --reply-topic split, replies go to sensors/{thing}/{client}/reply
+
+WEATHER_THINGS = ['temp', 'humidity', 'altitude', 'pressure']
+MAX_BATCH_OPS = 16 # operations in one batch request
+BATCH_ACTIONS = ['get', 'set'] # the rest start something that outlives the batch or stops us
+
+
+# called by the publisher with each encoded message or batch of messages. Anything we publish on our
+# own subscription comes back to us, so the echo filter is told about it first
+def sendMessage(topic, payload):
+    if localBroker.topicMatches(SUB_TOPIC, topic):
+        echoes.sent(topic, payload)
+    mqtt_connection.publish(
+            topic=topic,
+            payload=payload,
+            #qos=mqtt.QoS.AT_LEAST_ONCE)
+            qos=mqtt.QoS.AT_MOST_ONCE)
+
+# globals done, set up the request path. The hardware subsystems are brought up by their loaders in
+# the main block, in parallel with each other and the MQTT connection
+timer = startupTimer(START_TIME)
+timer.mark('imports')
+backend.selectBackend(args.backend, latency=args.sim_latency / 1000.0, noise=args.sim_noise)
+
+dispatcher = requestDispatcher(LANES, args.lane_depth)
+echoes = echoFilter()
+splitReplies = 0 # replies sent on the reply topic, each one an echo we never receive
+splitMutex = threading.Lock() # replies are sent from the lanes, the observer and the MQTT thread
+
+# the threads the water subsystem runs on once it's loaded
+subsystemThreads = []
+
+# the actuators report their state here as it changes, so reading it never waits on them
+shadow = deviceShadow()
+if args.publish_shadow:
+    shadow.addListener(lambda document: composeMessage(f"sensors/shadow/{args.client_id}", dict(document)))
+
+# the weather functions are module level, so the weather subsystem is the weatherSensor module
+def startWeather():
+    ws.init()
+    ws.setSnapshotTTL(args.weather_ttl)
+    if calibrationStore.getSeaLevelPressure() is not None:
+        ws.setSeaLevelPressure(calibrationStore.getSeaLevelPressure())
+    return ws
+
+def startWater():
+    waterObj = water.waterManager(WATERING_TIME_SEC, ZONES, args.max_valves, shadow)
+    waterThread = threading.Thread(name='Water subsystem', target=waterObj.start)
+    waterThread.start()
+    subsystemThreads.append(waterThread)
+    return waterObj
+
+weatherLoader = subsystemLoader('weather', startWeather, timer)
+ledLoader = subsystemLoader('led', lambda: led.ledManager(shadow=shadow), timer)
+waterLoader = subsystemLoader('water', startWater, timer)
+soilLoader = subsystemLoader('soil', lambda: soil.soilManager(args.soil_max_age, args.soil_samples, args.soil_reduce,
+                                                              args.soil_trim, calibrationStore.getCurve('soil')), timer)
+LOADERS = [weatherLoader, ledLoader, waterLoader, soilLoader]
+
+# hand calibration changes made over MQTT to the sensor they're for, once it has started
+def applyCalibration(name, value):
+    try:
+        if name == calibration.SEA_LEVEL:
+            weatherLoader.get().setSeaLevelPressure(value)
+        elif name == 'soil':
+            soilLoader.get().setCurve(value)
+    except RuntimeError as e:
+        logging.error("Calibration of {} not applied: {}".format(name, e))
+
+calibrationStore.addListener(applyCalibration)
+
+# sensors with a sampling interval are read in the background and requests are answered from
+# the latest sample, the channel names match the thing names used in the topics
+sampler = sampleManager(args.history_size)
+sampler.addSensor('weather', args.sample_weather, lambda: weatherLoader.get().readSnapshot(),
+                  ['temp', 'humidity', 'pressure', 'altitude'])
+sampler.addSensor('soil', args.sample_soil, lambda: {'soil': soilLoader.get().getSoilHumidity()}, ['soil'])
+
+# automatic watering decides on every soil sample, so it's only there when the soil is sampled. It can
+# be switched on and off over MQTT, --auto-water only sets whether it starts switched on
+irrigationObj = None
+if sampler.isSampled('soil'):
+    irrigationObj = irrigation.irrigationController(waterLoader.get, args.auto_zone, args.auto_low, args.auto_high,
+                                                    args.auto_seconds, args.auto_interval, args.auto_budget,
+                                                    args.auto_water)
+    sampler.addListener('soil', irrigationObj.onSample)
+
+samplerThread = threading.Thread(name='Sampler', target=sampler.start)
+samplerThread.start()
+dispatcher.start()
+
+# pushes observed values when they change instead of having them polled, see observeRequest()
+observers = observeManager()
+observerThread = threading.Thread(name='Observer', target=observers.start)
+observerThread.start()
 
 
 ##################
 
-# return true if the json formatted payload contains a valid 'command' that we support
-def supportedAction(payload):
-    action = list(payload.keys())[0]
-    # Since we only support single key + value commands, just check the first item, if it's a supported command then return true
-    return action in SUPPORTED_ACTIONS
-
 # Callback when the subscribed topic receives a message
 def receive_loop(topic, payload, **kwargs):
     global received_count
+    if echoes.isEcho(topic, payload):
+        return # one of our own replies, dropped before it's decoded
     logging.debug("Received message from topic '{}': {}".format(topic, payload))
     received_count += 1
     topic_parsed = False    
@@ -156,312 +334,603 @@ def receive_loop(topic, payload, **kwargs):
                 if (parsed_topic[0] == 'sensors') and (parsed_topic[2] == args.client_id):
                     # a thing is a sensor,actuator,information or command 
                     thing = parsed_topic[1]
-                    logging.debug('Started parsing thing: {}'.format(thing))
-                    payloadJson = json.loads(payload)
-                    # we can filter out our message responses here and skip processing if the request doesn't contain a supported
-                    # action, because it likely is just our own message response
-                    if supportedAction(payloadJson):
-                        if thing == 'temp' or thing == 'humidity' or thing == 'altitude' or thing == 'pressure':
-                            # all of these sensors are on the same sensor device
-                            logging.debug("Received weather sensor request: {}".format(payload))
-                            parseSensor(topic, payloadJson, thing)
-                            topic_parsed = True
-                        elif thing == 'soil': # soil humidity sensor module
-                            logging.debug("Received soil humidity request: {}".format(payload))
-                            parseSoil(topic, payloadJson)
-                            topic_parsed = True
-                        elif thing == 'water': # watering module
-                            logging.debug("Received watering request: {}".format(payload))
-                            parseWater(topic, payloadJson)
-                            topic_parsed = True
-                        elif thing == 'led': # module to contol LED blinking
-                            logging.debug("Received light request: {}".format(payload))
-                            parseLight(topic, payloadJson)
-                            topic_parsed = True
-                        elif thing == 'info': # requests for data that might be bigger than a single response
-                            logging.debug("Received info request: {}".format(payload))
-                            parseInfo(topic, payloadJson)
-                            topic_parsed = True
-                        elif thing == 'cmd': # the sensor receives system commands here
-                            logging.debug("received command request: {}".format(payload))
-                            parseCommand(topic, payloadJson)
-                            topic_parsed = True
+                    payloadJson, encoding = codec.decode(payload)
+                    # the router only matches payloads with an action we have a route for, so our own
+                    # message responses are filtered out here
+                    match = router.lookup(topic, thing, payloadJson, encoding)
+                    if match:
+                        entry, request = match
+                        logging.debug("Received request for route {}: {}".format(entry.name, payload))
+                        dispatchRequest(entry, request)
+                        topic_parsed = True
     if not topic_parsed:
         logging.debug("Unrecognized message topic or sensor type, or it's my previous msg")
 
-## Command parsing and validating function ##
-#############################################
-
-## because these 4 sensor readings all come from the same device, we will handle them
-## from the same function
-def parseSensor(topic, payload, thing):
-    msg = {}
-    if 'get' in payload:
-        target = payload['get']
-        if target == "status": # we can't start without this sensor being online because of i2c dependencies
-            # so it's pointless to try to turn it off or on
-            msg['status'] = 'on'
-
-        elif target == "value":
-            if thing == 'temp':
-                msg = getTemp()
-            elif thing == 'humidity':
-                msg = getHumidity()
-            elif thing == 'altitude':
-                msg = getAltitude()
-            elif thing == 'pressure':
-                msg = getPressure()
-    if 'set' in payload:
-        action = payload['set']
-        if action == 'off' or action == 'off':
-            # we don't support turning this sensor on/off
-            msg['status'] = 'ActionDenied'
-
+# hand a request to its subsystem's worker lane, we are on the MQTT event-loop thread here
+# so this must never block. If the lane is full tell the requester we are busy instead
+def dispatchRequest(entry, request):
+    if request.thing == 'soil' and request.action == 'get' and request.value in SOIL_VALUES:
+        if shareSoilReading(entry, request):
+            return
+    if not dispatcher.submit(entry.lane, handleRequest, entry, request):
+        msg = {}
+        msg['status'] = 'busy'
+        replyTo(request, msg)
+
+# a soil value request signs up for the reading in flight, or the one about to start, and is answered
+# by the thread that takes it, so every request that arrives during a reading shares it without
+# holding a worker. Only the request that starts a reading puts a job on the soil lane. Returns False
+# if the request has to go to the lane as usual, sampled soil is answered from its latest sample and
+# a probe that is still starting up is waited for there
+def shareSoilReading(entry, request):
+    if sampler.isSampled('soil') or not soilLoader.isReady():
+        return False
+    soilObj = soilLoader.get()
+    start = time.perf_counter()
+    def reply(value, age, failed):
+        if failed:
+            msg = {}
+            msg['status'] = 'soil reading failed'
+        else:
+            msg = soilMessage(value, age)
+        router.record(entry, time.perf_counter() - start)
+        replyTo(request, msg)
+    if soilObj.addWaiter(reply) and not dispatcher.submit('soil', soilObj.readForWaiters):
+        if soilObj.cancelWaiter(reply):
+            msg = {}
+            msg['status'] = 'busy'
+            replyTo(request, msg)
+    return True
+
+# runs the request's handler on the lane's worker thread and sends back what it returns
+def handleRequest(entry, request):
+    msg = router.run(entry, request)
     if msg: # check if the message is not empty
-        composeMessage(topic, msg)
-    else: 
-        logging.debug("ignored request for weather sensor")
-
-# check and see the we have recieved a valid request for the soil humidity sensor
-def parseSoil(topic, payload):
-    msg = {}
-    if 'set' in payload:
-        action = payload['set']
-        if action == 'on' or action == 'off':
-            msg['status'] = 'ActionDenied'
-
-    if 'get' in payload:
-        action = payload['get']
-        if action == 'value' or action == 'status' or action == 'reading':
-            logging.debug("getting soil reading")
-            msg = getSoilHumidity()
-    if msg:
-        composeMessage(topic, msg)
-    else: 
-        logging.debug("ignored request for soil sensor")
-
-# parse the request for the water module
-def parseWater(topic, payload):
-    msg = {}
-    if 'set' in payload:
-        action = payload['set']
-        # this just triggers the system to water for a pre-determined amount of time for now
-        if action == 'on':
-            waterEvent.set()
-            msg['status'] = 'on'
-        
-        elif action == 'off':
-            # interrupt the hose and tell it to shut-off
-            msg = interruptWater()
-
-        ## clear resets the water systems current total counter for seconds watered
-        elif action == 'clear':
-            msg = clearWaterCounter()
-
-    if 'setTime' in payload:
-        time = payload['setTime'] # the sub-functions check and enforce the validity for int/float values
+        replyTo(request, msg)
+    else:
+        logging.debug("ignored request for {}".format(entry.name))
+
+## Request handlers ##
+######################
+## each handler takes the sensorRequest and returns the message to reply with, they are
+## registered with the router at the bottom of the file
+
+## these 4 sensor readings all come from the same device, so they share their handlers
+def getWeatherValue(request):
+    msg = {}
+    msg[request.thing] = getWeatherSnapshot()[request.thing]
+    return msg
+
+# we can't start without this sensor being online because of i2c dependencies
+# so it's pointless to try to turn it off or on
+def getSensorStatus(request):
+    msg = {}
+    msg['status'] = 'on'
+    return msg
+
+# we don't support turning the weather or soil sensors on/off
+def denyAction(request):
+    msg = {}
+    msg['status'] = 'ActionDenied'
+    return msg
+
+def getSensorHistory(request):
+    return getHistory(request.thing, request.payload)
+
+# queue a run of the watering time on the default zone, it starts right away if the valve is free
+def startWatering(request):
+    return queueWateringRun(None, None)
+
+# queue a run on the zone named in the request, for its optional 'seconds' or the watering time
+def runZone(request):
+    seconds = request.payload.get('seconds')
+    try:
+        return queueWateringRun(request.value, None if seconds is None else float(seconds))
+    except (TypeError, ValueError):
+        msg = {}
+        msg['status'] = 'invalid seconds'
+        return msg
+
+def queueWateringRun(zone, seconds):
+    msg = {}
+    try:
+        position = waterLoader.get().queueRun(zone, seconds)
+    except ValueError as e:
+        msg['status'] = str(e)
+        return msg
+    if position is None:
+        msg['status'] = 'queue full'
+    elif position == 0:
+        msg['status'] = 'on'
+    else:
+        msg['status'] = 'queued'
+        msg['position'] = position
+    return msg
+
+# close a zone's valve, or every zone's with 'all', and drop its queued runs
+def stopZone(request):
+    msg = {}
+    waterObj = waterLoader.get()
+    zone = None if request.value == 'all' else request.value
+    if zone is not None and zone not in waterObj.getZoneNames():
+        msg['status'] = 'unknown zone {}'.format(zone)
+        return msg
+    msg['status'] = 'stopped'
+    msg['watered ms'] = waterObj.stop(zone)
+    return msg
+
+# change how many zone valves may be open at once
+def setValveLimit(request):
+    msg = {}
+    try:
+        msg['max valves'] = waterLoader.get().setMaxConcurrent(int(request.value))
+    except (TypeError, ValueError):
+        msg['status'] = 'invalid limit'
+    return msg
+
+# state, seconds remaining, finished runs and totals of every zone
+def getZones():
+    msg = {}
+    waterObj = waterLoader.get()
+    msg['zones'] = waterObj.getZoneStats()
+    msg['max valves'] = waterObj.getMaxConcurrent()
+    return msg
+
+# the runs waiting for a valve, in the order they will start
+def getWaterQueue():
+    msg = {}
+    msg['queue'] = [{'zone': zone, 'seconds': seconds} for zone, seconds in waterLoader.get().getQueue()]
+    return msg
+
+# switch automatic watering on or off, with optional new 'low' and 'high' thresholds
+def setAutoWater(request):
+    msg = {}
+    if irrigationObj is None:
+        msg['status'] = 'soil not sampled'
+        return msg
+    if 'low' in request.payload or 'high' in request.payload:
+        status = irrigationObj.getStatus()
         try:
-            time = int(time)
-            msg = setWateringTime(time)
-        except ValueError:
-            logging.debug("non-integer value for time")
-
-    if 'get' in payload:
-        action = payload['get']
-        if action == 'status' or action == 'state' or action == 'value':
-            msg = getWaterState()
-        elif action == 'cumulative':
-            msg = getWaterCumulativeTotal()
-        elif action == 'total':
-            msg = getWaterCurrentTotal()
-        
-        # get the currently set watering time in seconds
-        elif action == 'time':
-            msg = getWateringTime()
-    
-    if msg:
-        composeMessage(topic, msg)
-    else: 
-        logging.debug("ignored request for water system")
-
-# handles the led and informs LED thread if it should blink or not
-# the current behavior for 'on' means blink. We could add in function to keep
-# led steady and not just blink, optional
-def parseLight(topic, payload):
-    msg = {}
-    if 'set' in payload:
-        action = payload['set']
-        if action == 'on':
-            ledEvent.set()
-            msg['status'] = 'on'
-        elif action == 'off':
-            ledEvent.clear()
-            msg['status'] = 'off'
-
-    if 'get' in payload:
-        action = payload['get']
-        if action == 'status' or action == 'value':
-            msg = getLEDStatus()
-    if msg:
-        composeMessage(topic, msg)
-    else: 
-        logging.debug("ignored request for light/led system")
-
-# the Info topic can multisystem responses, in contrast to the rest of the sensor topics
-# which only return a single status
-def parseInfo(topic, payload):
-    msg = {}
-    if 'get' in payload:
-        if payload['get'] == 'bulk':
-            msg = getBulk(topic)
-    if msg:
-        composeMessage(topic, msg)
-    else:    
-        logging.debug("ignored request for info")
-
-# parse a command request
-def parseCommand(topic, payload):
+            low = float(request.payload.get('low', status['low']))
+            high = float(request.payload.get('high', status['high']))
+        except (TypeError, ValueError):
+            low = high = None
+        if low is None or not irrigationObj.setThresholds(low, high):
+            msg['status'] = 'invalid thresholds'
+            return msg
+    irrigationObj.setEnabled(request.value == 'on')
+    return getAutoWater()
+
+# the automatic watering settings, what it last decided and how much of today's budget it has used
+def getAutoWater():
+    msg = {}
+    if irrigationObj is None:
+        msg['status'] = 'soil not sampled'
+        return msg
+    msg['auto'] = irrigationObj.getStatus()
+    return msg
+
+# this device's calibration profile
+def getCalibration():
+    msg = {}
+    msg['profile'] = calibrationStore.getProfileName()
+    msg['calibration'] = calibrationStore.getProfile()
+    return msg
+
+# {"calibrate": "soil", "type": "table", "points": [[raw, value], ...]} replaces a curve and
+# {"calibrate": "seaLevelPressure", "value": 1013.2} refreshes the sea level pressure in hPa
+def setCalibration(request):
+    msg = {}
+    try:
+        if request.value == calibration.SEA_LEVEL:
+            calibrationStore.setSeaLevelPressure(request.payload.get('value'))
+        else:
+            calibrationStore.setCurve(request.value, request.payload)
+    except ValueError as e:
+        msg['status'] = str(e)
+        return msg
+    except OSError as e:
+        msg['status'] = 'calibration applied but not saved: {}'.format(e)
+        return msg
+    return getCalibration()
+
+# {"batch": [{"thing": "soil", "get": "value"}, {"thing": "water", "get": "total"}, ...]} runs each
+# operation's route right here on the info worker and sends one reply with a result per operation, in
+# order. The operations share one reading of each sensor, see pinnedReading()
+def runBatch(request):
+    msg = {}
+    ops = request.value
+    if not isinstance(ops, list) or not ops:
+        msg['status'] = 'batch must be a list of operations'
+        return msg
+    if len(ops) > MAX_BATCH_OPS:
+        msg['status'] = 'batch is limited to {} operations'.format(MAX_BATCH_OPS)
+        return msg
+    batchReadings.readings = {}
+    try:
+        msg['results'] = [runBatchOperation(op, request.encoding) for op in ops]
+    finally:
+        batchReadings.readings = None
+    return msg
+
+# one operation is a request payload with the 'thing' it's for, its result has "ok" and either the
+# "reply" its route returned or an "error". Only get and set operations can be batched
+def runBatchOperation(op, encoding):
+    result = {}
+    if not isinstance(op, dict) or not isinstance(op.get('thing'), str):
+        result['ok'] = False
+        result['error'] = 'an operation needs a thing'
+        return result
+    thing = op['thing']
+    result['thing'] = thing
+    fields = {key: value for key, value in op.items() if key != 'thing'}
+    match = None
+    if 'batch' not in fields: # no batches inside of batches
+        match = router.lookup(f"sensors/{thing}/{args.client_id}", thing, fields, encoding)
+    if match is None:
+        result['ok'] = False
+        result['error'] = 'unsupported operation'
+        return result
+    entry, opRequest = match
+    if opRequest.action not in BATCH_ACTIONS:
+        result['ok'] = False
+        result['error'] = '{} can not be batched, only {}'.format(opRequest.action, ', '.join(BATCH_ACTIONS))
+        return result
+    try:
+        reply = router.run(entry, opRequest)
+    except Exception as e:
+        logging.error("Batch operation {} failed: {}".format(entry.name, e))
+        result['ok'] = False
+        result['error'] = str(e)
+        return result
+    result['ok'] = True
+    result['reply'] = reply or {}
+    return result
+
+# the value each observable thing reports, sampled sensors are read from their latest sample
+OBSERVABLE = {'temp': lambda: getWeatherSnapshot()['temp'],
+              'humidity': lambda: getWeatherSnapshot()['humidity'],
+              'pressure': lambda: getWeatherSnapshot()['pressure'],
+              'altitude': lambda: getWeatherSnapshot()['altitude'],
+              'soil': lambda: getSoilHumidity()['value'],
+              'water': lambda: getWaterState()['status'],
+              'led': lambda: getLEDStatus()['pattern']}
+
+# {"observe": "on", "deadband": 0.5, "pmin": 10, "pmax": 600} pushes {"value": ..., "observe": n} to the
+# thing's reply topic whenever the value moves by deadband or more (any change for water and led), no
+# more often than every pmin seconds and at least every pmax. Each thing has one observation, a new
+# one replaces it and an "id" in the request is echoed in every notification. "observe": "off" stops it.
+# Soil can only be observed with --sample-soil, the checks then read the latest sample and the probe is
+# only powered by the sampler. Otherwise every check would power it and corrode it
+def observeRequest(request):
     msg = {}
+    if request.value == 'off':
+        msg['status'] = 'cancelled' if observers.cancel(request.thing) else 'not observing'
+        return msg
+    if request.thing == 'soil' and not sampler.isSampled('soil'):
+        msg['status'] = 'soil can only be observed with --sample-soil'
+        return msg
+    def notify(value, sequence):
+        update = {}
+        update['value'] = value
+        update['observe'] = sequence
+        replyTo(request, update)
+    try:
+        deadband = float(request.payload.get('deadband', 0))
+        pmin = float(request.payload.get('pmin', DEFAULT_PMIN))
+        pmax = float(request.payload.get('pmax', DEFAULT_PMAX))
+        observers.observe(request.thing, OBSERVABLE[request.thing], notify, deadband, pmin, pmax)
+    except (TypeError, ValueError) as e:
+        msg['status'] = str(e)
+        return msg
+    msg['status'] = 'observing'
+    return msg
+
+# the things being observed with their attributes, checks and notifications sent
+def getObservations():
+    msg = {}
+    msg['observations'] = observers.getObservations()
+    return msg
+
+def setWateringTimeRequest(request):
+    # the sub-functions check and enforce the validity for int/float values
+    try:
+        return setWateringTime(float(request.value))
+    except (TypeError, ValueError):
+        logging.debug("non-numeric value for time")
+
+# 'on' means the default blink, 'steady' keeps it lit. 'blink' takes an optional 'rate' in Hz and
+# 'duty' cycle, 'pulse' a 'count' of pulses and an optional 'rate' and 'repeat'
+def getLightPattern(request):
+    payload = request.payload
+    if request.value == 'on':
+        return led.blink()
+    elif request.value == 'steady':
+        return led.steady()
+    elif request.value == 'blink':
+        return led.blink(float(payload.get('rate', led.BLINK_RATE)), float(payload.get('duty', 0.5)))
+    elif request.value == 'pulse':
+        repeat = payload.get('repeat', True)
+        if not isinstance(repeat, bool):
+            raise ValueError("repeat must be true or false")
+        return led.pulses(int(payload.get('count', 3)), float(payload.get('rate', led.PULSE_RATE)),
+                          repeat=repeat)
+    return led.steady(False)
+
+# the LED engine applies the new pattern before this returns
+def setLight(request):
+    msg = {}
+    try:
+        pattern = getLightPattern(request)
+    except (TypeError, ValueError) as e:
+        msg['status'] = 'invalid pattern: {}'.format(e)
+        return msg
+    ledLoader.get().setPattern(pattern)
+    msg['status'] = request.value
+    return msg
+
+# disconnect, reboot or halt the gateway
+def setDeviceState(request):
     global ACTION_ON_TERMINATION
-    if 'get' in payload:
-        if payload['get'] == 'uptime':
-            msg = getUptime()
-        if payload['get'] == 'timestamp':
-            msg = getTimeStamp()
-    if 'deviceState' in payload:
-        action = payload['deviceState']
-        if action == 'disconnect':
-            msg['status'] = 'disconnecting'
-            disconnectLoop()
-        elif action == 'reboot':
-            msg['status'] = 'rebooting'
-            ACTION_ON_TERMINATION = 'reboot'
-            disconnectLoop()
-        elif action == 'halt' or action == 'off':
-            msg['status'] = 'halting'
-            ACTION_ON_TERMINATION = 'halt'
-            disconnectLoop()
-    if msg:
-        composeMessage(topic, msg)
-    else:    
-        logging.debug("ignored request for command")
+    msg = {}
+    if request.value == 'disconnect':
+        msg['status'] = 'disconnecting'
+    elif request.value == 'reboot':
+        msg['status'] = 'rebooting'
+        ACTION_ON_TERMINATION = 'reboot'
+    else:
+        msg['status'] = 'halting'
+        ACTION_ON_TERMINATION = 'halt'
+    # queue our status reply first so the publisher sends it before it stops
+    replyTo(request, msg)
+    disconnectLoop()
 
 ## Sensor data retrieval functions ## 
 #####################################
 
 ## this function gathers all availble sensor data and device status information and sends in one
 ## pre-formatted message
-def getBulk(topic):
+## the Info topic can multisystem responses, in contrast to the rest of the sensor topics
+## which only return a single status
+def getBulk():
     msg = {}
-    msg.update(getTemp())
-    msg.update(getHumidity())
-    msg.update(getAltitude())
-    msg.update(getPressure())
+    snapshot = getWeatherSnapshot()
+    msg.update(getTemp(snapshot))
+    msg.update(getHumidity(snapshot))
+    msg.update(getAltitude(snapshot))
+    msg.update(getPressure(snapshot))
     msg.update(getLEDStatus())
     msg.update(getSoilHumidity())
-    if msg:
-        composeMessage(topic, msg)
+    return msg
 
-def getTemp():
+# the weather readings all come from one snapshot of the BME280 so they were measured together,
+# if the sensor is sampled in the background that's the latest sample, otherwise ws.getSnapshot()
+# shares recent snapshots so a burst of requests only reads the sensor once
+def getWeatherSnapshot():
+    return pinnedReading('weather', readWeatherSnapshot)
+
+def readWeatherSnapshot():
+    snapshot = sampler.getLatestGroup('weather')
+    if snapshot is None:
+        snapshot = weatherLoader.get().getSnapshot()
+    return snapshot
+
+# the operations in a batch all see the same reading of each sensor. While a batch runs, its worker
+# thread keeps the readings taken so far, the first operation to need a sensor reads it and the rest
+# reuse that reading
+batchReadings = threading.local()
+
+def pinnedReading(name, read):
+    readings = getattr(batchReadings, 'readings', None)
+    if readings is None:
+        return read()
+    if name not in readings:
+        readings[name] = read()
+    return readings[name]
+
+def getTemp(snapshot=None):
     msg = {}
-    msg['temp'] = ws.bme280.temperature
+    msg['temp'] = (snapshot or getWeatherSnapshot())['temp']
     return msg
 
-def getHumidity():
+def getHumidity(snapshot=None):
     msg = {}
-    msg['humidity'] = ws.bme280.relative_humidity
+    msg['humidity'] = (snapshot or getWeatherSnapshot())['humidity']
     return msg
 
-def getAltitude():
+def getAltitude(snapshot=None):
     msg = {}
-    msg['altitude'] = ws.bme280.altitude
+    msg['altitude'] = (snapshot or getWeatherSnapshot())['altitude']
     return msg
 
-def getPressure():
+def getPressure(snapshot=None):
     msg = {}
-    msg['humidity'] = ws.bme280.pressure
+    msg['pressure'] = (snapshot or getWeatherSnapshot())['pressure']
     return msg
 
 def getLEDStatus():
     msg = {}
-    state = "on" if ledEvent.isSet() else 'off'
-    msg['status'] = state
+    state = getReportedState('led', ledLoader)
+    msg['status'] = state['status']
+    msg['pattern'] = state['pattern']
     return msg
 
-# report the soil humidity reading
-# the soil humidity class and getSoilHumidity() function manages it's own power-state 
+# a subsystem's state from the shadow, it reports as soon as it's created so only a request that
+# arrives while it's still starting up waits for it
+def getReportedState(section, loader):
+    state = shadow.getReported(section)
+    if state is None:
+        loader.get()
+        state = shadow.getReported(section)
+    return state
+
+# the shadow document: the version, the actuators' reported state and any desired changes waiting
+# for a safe point. The version goes up with every change
+def getShadow():
+    return dict(shadow.getDocument())
+
+# report the soil humidity reading and its age in seconds, with a burst its samples' variance too
+# the soil humidity class and getSoilReading() function manages it's own power-state 
 # because leaving it on will damange the sensor, so the state cannot be set by the user
 def getSoilHumidity():
+    return dict(pinnedReading('soil', readSoilHumidity))
+
+def readSoilHumidity():
+    sample = sampler.getLatest('soil')
+    if sample is not None:
+        value, age = sample
+    else:
+        value, age = soilLoader.get().getSoilReading()
+    return soilMessage(value, age)
+
+# the reply for a soil reading, also sent to the requests that shared it
+def soilMessage(value, age):
+    msg = {}
+    msg['value'] = value
+    msg['age'] = round(age, 1)
+    variance, samples = soilLoader.get().getSoilSpread()
+    if samples > 1:
+        msg['variance'] = round(variance, 3)
+        msg['samples'] = samples
+    return msg
+
+# min, max and mean of a sampled sensor over the last 'window' seconds, without touching the hardware
+# the window defaults to everything we have kept
+def getHistory(channel, payload):
     msg = {}
-    msg['value'] = soilObj.getSoilHumidity() 
+    if not sampler.isSampled(channel):
+        msg['status'] = 'not sampled'
+        return msg
+    try:
+        window = float(payload.get('window', 0))
+    except (TypeError, ValueError):
+        window = 0
+    if window <= 0:
+        window = float('inf')
+    history = sampler.getHistory(channel, window)
+    if history is None:
+        msg['count'] = 0
+    else:
+        msg['min'], msg['max'], msg['mean'], msg['count'] = history
     return msg
 
 def clearWaterCounter():
-    waterObj.clearRuntime()
+    waterLoader.get().clearRuntime()
     return getWaterCurrentTotal()
 
 # this returns the number of seconds that the water system has been open since it was last cleared
 def getWaterCurrentTotal():
     msg = {}
-    msg['current total'] = waterObj.getCurrentTotal()
+    msg['current total'] = waterLoader.get().getCurrentTotal()
     return msg
 
 # this return the number of seconds that the water system has been open since the device came online
 def getWaterCumulativeTotal():
     msg = {}
-    msg['cumulative total'] = waterObj.getTotalRuntime() 
+    msg['cumulative total'] = waterLoader.get().getTotalRuntime() 
     return msg
 
 # this can inform the user if the hose is open or closed
 def getWaterState():
     msg = {}
-    state = 'water on' if waterObj.getState() else 'water off'
-    msg['status'] = state
+    msg['status'] = getReportedState('water', waterLoader)['state']
     return msg
 
 # returns the currently set, ammount of time the hose will water for when turned on
 def getWateringTime():
     msg = {}
-    value = waterObj.getWateringTime()
-    msg['watering set for'] = value
+    msg['watering set for'] = getReportedState('water', waterLoader)['watering time']
     return msg
 
 # user can request the hose be turned off
 def interruptWater():
     msg = {}
+    waterObj = waterLoader.get()
     if waterObj.getState():
-        # it's currently on, interrupt it
-        waterObj.interruptHose()
+        # it's currently on, interrupt it, the valve is closed by the time this returns
         msg['status'] = 'water interrupted'
+        msg['watered ms'] = waterObj.interruptHose()
     else:
         # the water hose isn't currently on
         msg['status'] = 'water already off'
     return msg
 
-# request to change the water system's time in seconds that the hose is on for
+# request to change the water system's time in seconds that the hose is on for. While watering the
+# change is queued as desired state and applied once every valve has closed
 def setWateringTime(value):
     msg = {}
-    ## the sub-process which trys to set the watering-time will block, this can hang the MQTT connection
-    ## if we don't send a response soon enough, so report an error if watering is in progress
-    if not waterObj.getState():
-        value = waterObj.changeWateringTime(value)
-        msg['watering time'] = value
-    else:
-        msg['notifyWait'] = 'watering currently in-progress'
+    waterObj = waterLoader.get()
+    try:
+        changed = waterObj.requestWateringTime(value)
+    except ValueError:
+        changed = True # out of range, nothing changes and we return the current value anyways
+    msg['watering time'] = waterObj.getWateringTime()
+    if not changed:
+        msg['status'] = 'pending'
+        msg['desired'] = value
+    return msg
+
+
+# reports each worker lane's queue depth and how many requests it has completed or rejected
+def getLaneStats():
+    msg = {}
+    msg['lanes'] = dispatcher.getStats()
+    return msg
+
+# reports how many times each route has been used and how long its handler took
+def getRouteStats():
+    msg = {}
+    msg['routes'] = router.getStats()
     return msg
 
 
 ## Misc commands section ##
 ###########################
 
-# Appends a message to the outbox queue which will be sent later by the main loop
-def composeMessage(topic, msg):
-    OUTBOX.append(SensorMessage(topic, msg))
-    msgEvent.set() # wake up the send loop
+# Appends a message to the outbox queue which will be sent later by the publisher on the main thread
+def composeMessage(topic, msg, encoding=None):
+    publisher.put(SensorMessage(topic, msg, encoding))
+
+# reply to a request on its topic, or its reply topic, in the encoding it arrived in. An 'id' in the
+# request is echoed in every reply so clients can keep many requests in flight and match them up
+def replyTo(request, msg):
+    global splitReplies
+    if 'id' in request.payload:
+        msg['id'] = request.payload['id']
+    topic = request.topic
+    if args.reply_topic == 'split':
+        topic = '{}/{}'.format(topic, REPLY_SUFFIX)
+        splitMutex.acquire()
+        splitReplies += 1
+        splitMutex.release()
+    composeMessage(topic, msg, request.encoding)
+
+# reports how far behind the publisher is and how fast it is sending
+def getOutboxStats():
+    msg = {}
+    msg['queue depth'] = publisher.getQueueDepth()
+    msg['max depth'] = publisher.getMaxDepth()
+    msg['publish rate'] = round(publisher.getPublishRate(), 2)
+    msg['published'] = publisher.getPublishCount()
+    msg['publishes'] = publisher.getPacketCount()
+    msg['stored'] = publisher.getStoredCount()
+    msg['replayed'] = publisher.getReplayCount()
+    return msg
 
 
+# how many of our own messages we didn't have to decode, dropped by the echo filter or never sent back
+# to us because they went on the reply topic
+def getEchoStats():
+    msg = {}
+    msg['reply topic'] = args.reply_topic
+    msg['echoes dropped'] = echoes.getDropped()
+    msg['replies split'] = splitReplies
+    msg['echoes avoided'] = echoes.getDropped() + splitReplies
+    msg['awaiting echo'] = echoes.getWaiting()
+    return msg
+
 # returns a formatted (system) uptime value for this device
-def getSystemUptime(raw):
+def getSystemUptime():
     return "{:0>8}".format(str(timedelta(seconds=int(uptime()))))
 
 # return the formatted system uptime
@@ -470,47 +939,148 @@ def getUptime():
     msg['uptime'] = getSystemUptime()
     return msg
 
-# useful for latency testing and debugging
-def getTimeStamp():
+# useful for latency testing and debugging, the request's id is echoed back so the benchmark
+# can match replies to requests
+def getTimeStamp(request):
     msg = {}
     msg['ts'] = datetime.utcnow().isoformat()
     ## we can use this to see how fast we are sending these
     logging.debug("Sending TS response at: {}".format(datetime.now()))
     return msg
 
-# function to set the global loop variable to false so we exit out
+# function to set the global loop variable to false and stop the publisher so we exit out
 def disconnectLoop():
     logging.info('entering disconnected state')
     global CONNECTED
     CONNECTED=False
+    observers.terminate() # no more notifications once the publisher is draining
+    publisher.terminate()
+
+## Routes ##
+############
+## every request the gateway answers is registered here as (thing, action, value) -> lane, handler
+## a value of None accepts any value. New subsystems add a register function and call it below
+
+def registerWeatherRoutes(router):
+    router.register(WEATHER_THINGS, 'get', 'status', 'weather', getSensorStatus)
+    router.register(WEATHER_THINGS, 'get', 'value', 'weather', getWeatherValue)
+    router.register(WEATHER_THINGS, 'get', 'history', 'weather', getSensorHistory)
+    router.register(WEATHER_THINGS, 'set', ['on', 'off'], 'weather', denyAction)
+
+def registerSoilRoutes(router):
+    router.register('soil', 'get', SOIL_VALUES, 'soil', lambda request: getSoilHumidity())
+    router.register('soil', 'get', 'history', 'soil', getSensorHistory)
+    router.register('soil', 'set', ['on', 'off'], 'soil', denyAction)
+
+def registerWaterRoutes(router):
+    router.register('water', 'set', 'on', 'water', startWatering)
+    # interrupt the hose and tell it to shut-off
+    router.register('water', 'set', 'off', 'water', lambda request: interruptWater())
+    ## clear resets the water systems current total counter for seconds watered
+    router.register('water', 'set', 'clear', 'water', lambda request: clearWaterCounter())
+    router.register('water', 'setTime', None, 'water', setWateringTimeRequest)
+    router.register('water', 'get', ['status', 'state', 'value'], 'water', lambda request: getWaterState())
+    router.register('water', 'get', 'cumulative', 'water', lambda request: getWaterCumulativeTotal())
+    router.register('water', 'get', 'total', 'water', lambda request: getWaterCurrentTotal())
+    # get the currently set watering time in seconds
+    router.register('water', 'get', 'time', 'water', lambda request: getWateringTime())
+    router.register('water', 'get', 'zones', 'water', lambda request: getZones())
+    router.register('water', 'get', 'queue', 'water', lambda request: getWaterQueue())
+    router.register('water', 'get', 'auto', 'water', lambda request: getAutoWater())
+    router.register('water', 'auto', ['on', 'off'], 'water', setAutoWater)
+    router.register('water', 'run', None, 'water', runZone)
+    router.register('water', 'stop', None, 'water', stopZone)
+    router.register('water', 'setLimit', None, 'water', setValveLimit)
+
+def registerLightRoutes(router):
+    router.register('led', 'set', ['on', 'off', 'steady', 'blink', 'pulse'], 'led', setLight)
+    router.register('led', 'get', ['status', 'value'], 'led', lambda request: getLEDStatus())
+
+def registerInfoRoutes(router):
+    router.register('info', 'get', 'bulk', 'info', lambda request: getBulk())
+    router.register('info', 'get', 'shadow', 'info', lambda request: getShadow())
+    router.register('info', 'batch', None, 'info', runBatch)
+
+# registering is quick so it's on the cmd lane, the checks run on the observer's own thread
+def registerObserveRoutes(router):
+    router.register(list(OBSERVABLE), 'observe', ['on', 'off'], 'cmd', observeRequest)
+
+def registerCommandRoutes(router):
+    router.register('cmd', 'get', 'uptime', 'cmd', lambda request: getUptime())
+    router.register('cmd', 'get', 'timestamp', 'cmd', getTimeStamp)
+    router.register('cmd', 'get', 'outbox', 'cmd', lambda request: getOutboxStats())
+    router.register('cmd', 'get', 'lanes', 'cmd', lambda request: getLaneStats())
+    router.register('cmd', 'get', 'routes', 'cmd', lambda request: getRouteStats())
+    router.register('cmd', 'get', 'echoes', 'cmd', lambda request: getEchoStats())
+    router.register('cmd', 'get', 'observations', 'cmd', lambda request: getObservations())
+    router.register('cmd', 'get', 'calibration', 'cmd', lambda request: getCalibration())
+    router.register('cmd', 'calibrate', None, 'cmd', setCalibration)
+    router.register('cmd', 'deviceState', ['disconnect', 'reboot', 'halt', 'off'], 'cmd', setDeviceState)
+
+router = topicRouter()
+registerWeatherRoutes(router)
+registerSoilRoutes(router)
+registerWaterRoutes(router)
+registerLightRoutes(router)
+registerInfoRoutes(router)
+registerCommandRoutes(router)
+registerObserveRoutes(router)
+
+# log the startup timing once every subsystem has finished starting
+def reportStartup():
+    for loader in LOADERS:
+        loader.ready.wait()
+    timer.report("Startup timing")
+    logging.info("Subsystem start times: {}".format(', '.join("{} {:.3f}s".format(loader.name, loader.getLoadTime())
+                                                             for loader in LOADERS)))
 
 ## Main ##
 ##########
 if __name__ == '__main__':
+    # the publisher is built here, once everything it calls on is defined, and before anything can queue
+    # a message. Nothing at module level touches it
+    outboxStore = None
+    if args.outbox_db:
+        outboxStore = persistentOutbox(args.outbox_db, args.outbox_max, args.outbox_evict)
+    publisher = messagePublisher(sendMessage, args.encoding, batchBytes=args.batch_bytes,
+                                 batchDelay=args.batch_delay, batchTopic=args.batch_topic, store=outboxStore,
+                                 replayRate=args.replay_rate)
+
     # Spin up resources
     event_loop_group = io.EventLoopGroup(1)
     host_resolver = io.DefaultHostResolver(event_loop_group)
     client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
 
-    mqtt_connection = mqtt_connection_builder.mtls_from_path(
-            endpoint=args.endpoint,
-            cert_filepath=args.cert,
-            pri_key_filepath=args.key,
-            client_bootstrap=client_bootstrap,
-            ca_filepath=args.root_ca,
-            on_connection_interrupted=on_connection_interrupted,
-            on_connection_resumed=on_connection_resumed,
-            client_id=args.client_id,
-            clean_session=False,
-            keep_alive_secs=6)
+    if args.local_broker:
+        mqtt_connection = localBroker.buildConnection(args.local_broker, args.client_id,
+                on_connection_interrupted=on_connection_interrupted,
+                on_connection_resumed=on_connection_resumed)
+    else:
+        mqtt_connection = mqtt_connection_builder.mtls_from_path(
+                endpoint=args.endpoint,
+                cert_filepath=args.cert,
+                pri_key_filepath=args.key,
+                client_bootstrap=client_bootstrap,
+                ca_filepath=args.root_ca,
+                on_connection_interrupted=on_connection_interrupted,
+                on_connection_resumed=on_connection_resumed,
+                client_id=args.client_id,
+                clean_session=False,
+                keep_alive_secs=6)
 
     logging.info("Connecting to {} with client ID '{}'...".format(
-        args.endpoint, args.client_id))
+        args.local_broker or args.endpoint, args.client_id))
 
+    # start connecting first, the hardware comes up while we wait for the broker
     connect_future = mqtt_connection.connect()
+    timer.mark('connect started')
+    logging.info("Starting up sensor subsystems on the {} backend".format(args.backend))
+    for loader in LOADERS:
+        loader.start()
 
     # Future.result() waits until a result is available
     connect_future.result()
+    timer.mark('connected')
     logging.info("Connected!")
 
     # Subscribe
@@ -523,38 +1093,39 @@ if __name__ == '__main__':
             callback=receive_loop)
 
     subscribe_result = subscribe_future.result()
+    timer.mark('subscribed')
     logging.info("Subscribed with {}".format(str(subscribe_result['qos'])))
     CONNECTED = True
-    # compose an initial online status message
+    # compose an initial online status message, requests for subsystems still starting wait on their lane
     msg = {}
     msg['status'] = 'online'
     composeMessage(f"sensors/info/{args.client_id}", msg)
-    pub_count = 0
-    # publish a message saying we are online
-    while CONNECTED:
-        msgEvent.wait(LOOP_TIMEOUT)
-        if OUTBOX: # check and see if there are any messages to send
-            msg = OUTBOX.popleft()
-            mqtt_connection.publish(
-                    topic=msg.getTopic(),
-                    payload=json.dumps(msg.getMessage()), # don't forget to convert to binary before sending
-                    #qos=mqtt.QoS.AT_LEAST_ONCE)
-                    qos=mqtt.QoS.AT_MOST_ONCE)
-            pub_count += 1
+    timer.mark('online')
+    threading.Thread(name='Startup report', target=reportStartup, daemon=True).start()
+    # publish messages until disconnectLoop() stops the publisher, it drains the outbox before returning
+    publisher.start()
    
     ## out of loop, disconnect must have been called
     logging.info("Disconnecting...")
     disconnect_future = mqtt_connection.disconnect()
     disconnect_future.result()
     logging.info("Disconnected!")
-    logging.info("Sent '{}' messages".format(pub_count))
+    logging.info("Sent '{}' messages".format(publisher.getPublishCount()))
     ## Clean up area ##
-    ledObj.terminate()
-    waterObj.terminate()
-    soilObj.terminate() 
-
-    ledThread.join() # LED thread finish
-    waterThread.join() # Water thread finish
+    dispatcher.terminate()
+    if outboxStore:
+        outboxStore.close()
+    sampler.terminate()
+    for loader in (ledLoader, waterLoader, soilLoader): # the weather functions have nothing to stop
+        try:
+            loader.get().terminate()
+        except RuntimeError:
+            pass # it never started
+
+    for t in subsystemThreads: # water scheduler thread finish
+        t.join()
+    samplerThread.join() # Sampler thread finish
+    observerThread.join()
 
     ## if a reboot was requested
     if ACTION_ON_TERMINATION == 'reboot':
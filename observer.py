@@ -0,0 +1,131 @@
+import heapq
+import logging
+import threading
+import time
+
+# Author: Peter Van Eenoo
+# CSS 532 IoT - class project
+# March 2021
+
+DEFAULT_PMIN = 1.0   # seconds, the fewest between notifications
+DEFAULT_PMAX = 300.0 # seconds, a notification is sent at least this often even if nothing changed
+MIN_INTERVAL = 0.5   # fastest we check a value, whatever pmin is
+MAX_OBSERVATIONS = 32
+
+# one observed value. It's checked every pmin seconds (MIN_INTERVAL at the fastest) and a notification
+# is sent when a number has moved by at least deadband, or anything else has changed, since the last
+# one, or when pmax seconds have gone by without one
+class observation:
+    def __init__(self, key, read, notify, deadband, pmin, pmax):
+        self.key = key
+        self.read = read     # returns the current value
+        self.notify = notify # called with the value and the notification's sequence number
+        self.deadband = deadband
+        self.pmin = pmin
+        self.pmax = pmax
+        self.generation = 0  # bumped when it's cancelled so its scheduled checks are ignored
+        self.lastValue = None
+        self.lastReport = None
+        self.reports = 0
+        self.checks = 0
+
+    def hasChanged(self, value):
+        if self.lastValue is None:
+            return True
+        if isinstance(value, (int, float)) and isinstance(self.lastValue, (int, float)):
+            return abs(value - self.lastValue) >= self.deadband if self.deadband > 0 else value != self.lastValue
+        return value != self.lastValue
+
+    # returns when it should be checked next
+    def check(self, now):
+        self.checks += 1
+        value = self.read()
+        if self.hasChanged(value) or now - self.lastReport >= self.pmax:
+            self.reports += 1
+            self.lastValue = value
+            self.lastReport = now
+            self.notify(value, self.reports)
+        # every pmin, but in time for the pmax notification
+        return min(now + max(self.pmin, MIN_INTERVAL), self.lastReport + self.pmax)
+
+# this class pushes observed values instead of having them polled, in the style of the LwM2M observe
+# attributes. One thread checks every observation when it's due from a heap of deadlines, the reads
+# happen outside of the lock so a slow sensor only holds up the observer thread
+class observeManager:
+    def __init__(self):
+        self.running = True
+        self.cond = threading.Condition()
+        self.schedule = [] # heap of (due, sequence, generation, observation)
+        self.sequence = 0
+        self.observations = {} # key -> observation
+
+    # start observing, an observation with the same key is replaced. Raises ValueError on bad attributes
+    def observe(self, key, read, notify, deadband=0.0, pmin=DEFAULT_PMIN, pmax=DEFAULT_PMAX):
+        if deadband < 0 or pmin < 0 or pmin > pmax or pmax < MIN_INTERVAL:
+            raise ValueError("deadband and pmin must be 0 or more, pmin no more than pmax and pmax at least {}s"
+                             .format(MIN_INTERVAL))
+        self.cond.acquire()
+        try:
+            if key not in self.observations and len(self.observations) >= MAX_OBSERVATIONS:
+                raise ValueError("already observing {} values".format(MAX_OBSERVATIONS))
+            if key in self.observations:
+                self.observations[key].generation += 1
+            obs = observation(key, read, notify, deadband, pmin, pmax)
+            self.observations[key] = obs
+            self.push(obs, time.monotonic()) # the first notification goes out right away
+            self.cond.notify()
+            return obs
+        finally:
+            self.cond.release()
+
+    # returns False if the key wasn't being observed
+    def cancel(self, key):
+        self.cond.acquire()
+        obs = self.observations.pop(key, None)
+        if obs:
+            obs.generation += 1
+        self.cond.release()
+        return obs is not None
+
+    # called with cond held
+    def push(self, obs, due):
+        self.sequence += 1
+        heapq.heappush(self.schedule, (due, self.sequence, obs.generation, obs))
+
+    def getObservations(self):
+        self.cond.acquire()
+        stats = {}
+        for key, obs in self.observations.items():
+            stats[key] = {'deadband': obs.deadband, 'pmin': obs.pmin, 'pmax': obs.pmax,
+                          'checks': obs.checks, 'notifications': obs.reports}
+        self.cond.release()
+        return stats
+
+    def terminate(self):
+        self.cond.acquire()
+        self.running = False
+        self.cond.notify()
+        self.cond.release()
+
+    def start(self):
+        logging.info("Observer starting")
+        self.cond.acquire()
+        while self.running:
+            now = time.monotonic()
+            if not self.schedule or self.schedule[0][0] > now:
+                self.cond.wait(self.schedule[0][0] - now if self.schedule else None)
+                continue
+            due, sequence, generation, obs = heapq.heappop(self.schedule)
+            if generation != obs.generation:
+                continue # cancelled or replaced
+            self.cond.release()
+            try:
+                nextDue = obs.check(now)
+            except Exception as e:
+                logging.error("Observing {} failed: {}".format(obs.key, e))
+                nextDue = now + max(MIN_INTERVAL, obs.pmin)
+            self.cond.acquire()
+            if generation == obs.generation:
+                self.push(obs, nextDue)
+        self.cond.release()
+        logging.info("Observer terminating")
@@ -0,0 +1,90 @@
+import sqlite3
+import threading
+import logging
+import time
+
+# Author: Peter Van Eenoo
+# CSS 532 IoT - class project
+# March 2021
+
+MAX_MESSAGES = 10000 # default number of messages kept on disk before the eviction policy kicks in
+EVICT_POLICIES = ['oldest', 'priority']
+
+# with the 'priority' policy the lowest priority messages are evicted first, oldest first within a
+# priority. Readings the cloud can't get back later are worth more than status and command replies
+THING_PRIORITY = {'water': 3, 'soil': 2, 'temp': 2, 'humidity': 2, 'pressure': 2, 'altitude': 2,
+                  'led': 1, 'info': 1, 'cmd': 0}
+DEFAULT_PRIORITY = 1
+
+# this class keeps encoded messages on disk while the gateway is offline so they survive a restart
+# it's a single SQLite table in WAL mode, bounded to maxMessages by the eviction policy
+class persistentOutbox:
+    def __init__(self, path, maxMessages=MAX_MESSAGES, evict='oldest'):
+        self.maxMessages = maxMessages
+        self.evict = evict
+        self.evicted = 0
+        self.mutex = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "topic TEXT NOT NULL, payload BLOB NOT NULL, priority INTEGER NOT NULL, ts REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS outbox_priority ON outbox (priority, id)")
+        self.db.commit()
+        # keep the count in memory so the publisher can check it without a query
+        self.count = self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        if self.count:
+            logging.info("Outbox has {} messages from before the last restart".format(self.count))
+
+    def getCount(self):
+        return self.count
+
+    def getEvicted(self):
+        return self.evicted
+
+    def close(self):
+        self.mutex.acquire()
+        self.db.close()
+        self.mutex.release()
+
+    # save an encoded payload, evicting others if that takes us over maxMessages
+    def store(self, topic, payload):
+        parts = topic.split('/')
+        priority = THING_PRIORITY.get(parts[1], DEFAULT_PRIORITY) if len(parts) > 1 else DEFAULT_PRIORITY
+        self.mutex.acquire()
+        try:
+            self.db.execute("INSERT INTO outbox (topic, payload, priority, ts) VALUES (?, ?, ?, ?)",
+                            (topic, payload, priority, time.time()))
+            self.count += 1
+            if self.count > self.maxMessages:
+                extra = self.count - self.maxMessages
+                if self.evict == 'priority':
+                    self.db.execute("DELETE FROM outbox WHERE id IN "
+                                    "(SELECT id FROM outbox ORDER BY priority, id LIMIT ?)", (extra,))
+                else:
+                    self.db.execute("DELETE FROM outbox WHERE id IN "
+                                    "(SELECT id FROM outbox ORDER BY id LIMIT ?)", (extra,))
+                self.count -= extra
+                self.evicted += extra
+            self.db.commit()
+        finally:
+            self.mutex.release()
+
+    # returns up to n of the oldest (id, topic, payload) rows, they stay stored until remove()
+    def take(self, n):
+        self.mutex.acquire()
+        try:
+            return self.db.execute("SELECT id, topic, payload FROM outbox ORDER BY id LIMIT ?", (n,)).fetchall()
+        finally:
+            self.mutex.release()
+
+    def remove(self, ids):
+        if not ids:
+            return
+        self.mutex.acquire()
+        try:
+            self.db.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in ids])
+            self.db.commit()
+            self.count -= len(ids)
+        finally:
+            self.mutex.release()
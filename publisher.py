@@ -0,0 +1,271 @@
+import threading
+import logging
+import time
+from collections import deque
+import codec
+
+# Author: Peter Van Eenoo
+# CSS 532 IoT - class project
+# March 2021
+
+STATS_INTERVAL = 30 # how often in seconds the publisher logs its queue depth and publish rate
+BATCH_DELAY = 0.5   # default longest time in seconds a message waits in a batch before it's sent
+REPLAY_RATE = 5.0   # default messages per second replayed from the persistent outbox after reconnecting
+MAX_REPLAY_BACKOFF = 30.0 # longest wait in seconds before retrying a replay that failed
+
+# this simple class holds a message and a topic string, and optionally the encoding to send it in
+# the publisher holds a deque of SensorMessages
+class SensorMessage:
+    def __init__(self, topic, message, encoding=None):
+        self.topic = topic
+        self.message = message
+        self.encoding = encoding
+    def getTopic(self):
+        return self.topic
+
+    def getMessage(self):
+        return self.message
+
+    def getEncoding(self):
+        return self.encoding
+
+# this class is the publishing stage of the gateway, other threads hand it messages with put() and
+# the thread running start() drains everything that is queued each time it wakes up, encodes the
+# messages and hands them to send(topic, payload), which does the actual MQTT publish. Messages
+# without their own encoding are sent in the publisher's default encoding
+#
+# batching is opt-in by giving a batchBytes budget. Messages for the same topic are then merged
+# into one payload, or every message goes into one payload on batchTopic if that is set. A batch
+# is sent once it reaches batchBytes or its oldest message has waited batchDelay seconds. Only
+# messages with the same encoding can share a batch
+#
+# with a store (a persistentOutbox) payloads are saved to disk instead of sent while the connection
+# is down, or if sending fails. Once we are back online they are replayed at replayRate messages per
+# second alongside the live traffic so a long outage doesn't flood the link when it comes back.
+# A failed replay is retried after a wait that doubles each time, up to MAX_REPLAY_BACKOFF
+class messagePublisher:
+    def __init__(self, send, encoding='json', statsInterval=STATS_INTERVAL,
+                 batchBytes=0, batchDelay=BATCH_DELAY, batchTopic=None,
+                 store=None, replayRate=REPLAY_RATE):
+        self.running = True
+        self.online = True
+        self.send = send
+        self.encoding = encoding
+        self.store = store
+        self.replayRate = replayRate
+        self.nextReplay = 0.0 # monotonic time the next stored message may be replayed
+        self.replayBackoff = 0.0 # seconds to wait after the next failed replay, 0 until one fails
+        self.statsInterval = statsInterval
+        self.batchBytes = batchBytes
+        self.batchDelay = batchDelay
+        self.batchTopic = batchTopic
+
+        # the outbox and the running flag are both guarded by the condition's lock
+        self.cond = threading.Condition()
+        self.outbox = deque()
+
+        # batches waiting to be sent, only touched by the publishing thread
+        # (topic, encoding) -> [encoded parts, total bytes, time the first part was added, message count]
+        self.batches = {}
+
+        ## statistics
+        self.pubCount = 0     # total messages published since start
+        self.packetCount = 0  # total MQTT publishes since start, lower than pubCount when batching
+        self.maxDepth = 0     # deepest the outbox has been since start
+        self.pubRate = 0.0    # messages per second measured over the last stats interval
+        self.replayCount = 0  # stored messages replayed since start
+
+    # add a message to the outbox and wake up the publishing thread
+    def put(self, message):
+        self.cond.acquire()
+        self.outbox.append(message)
+        if len(self.outbox) > self.maxDepth:
+            self.maxDepth = len(self.outbox)
+        self.cond.notify()
+        self.cond.release()
+
+    # called from the connection callbacks, while offline payloads go to the store if we have one
+    def setOnline(self, online):
+        self.cond.acquire()
+        self.online = online
+        if online:
+            self.nextReplay = time.monotonic()
+            self.replayBackoff = 0.0
+        self.cond.notify()
+        self.cond.release()
+
+    # anything still in the outbox or waiting in a batch is sent before start() returns
+    def terminate(self):
+        self.cond.acquire()
+        self.running = False
+        self.cond.notify()
+        self.cond.release()
+
+    def getQueueDepth(self):
+        return len(self.outbox)
+
+    def getMaxDepth(self):
+        return self.maxDepth
+
+    def getPublishCount(self):
+        return self.pubCount
+
+    def getPacketCount(self):
+        return self.packetCount
+
+    def getPublishRate(self):
+        return self.pubRate
+
+    def getStoredCount(self):
+        return self.store.getCount() if self.store else 0
+
+    def getReplayCount(self):
+        return self.replayCount
+
+    # send one encoded payload carrying count messages, returns the number of messages that went out
+    # if we are offline or the send fails the payload is stored for later when we have a store
+    def publish(self, topic, payload, count):
+        if self.store and not self.online:
+            self.store.store(topic, payload)
+            return 0
+        try:
+            self.send(topic, payload)
+            self.packetCount += 1
+            self.pubCount += count
+            return count
+        except Exception as e:
+            logging.error("Failed to publish to {}: {}".format(topic, e))
+            if self.store:
+                self.store.store(topic, payload)
+            return 0
+
+    # replay the stored payloads that are due at replayRate, returns how many went out
+    def replay(self, now):
+        if now < self.nextReplay:
+            return 0
+        interval = 1.0 / self.replayRate
+        # don't let time spent idle or offline build up into a burst
+        self.nextReplay = max(self.nextReplay, now - interval)
+        due = int((now - self.nextReplay) / interval) + 1
+        sent = []
+        for id, topic, payload in self.store.take(due):
+            try:
+                self.send(topic, payload)
+            except Exception as e:
+                # the link is still down, wait before trying the same message again
+                self.replayBackoff = min(MAX_REPLAY_BACKOFF, max(interval, self.replayBackoff * 2))
+                self.nextReplay = now + self.replayBackoff
+                logging.error("Failed to replay to {}, retrying in {:.1f}s: {}".format(topic, self.replayBackoff, e))
+                break
+            self.replayBackoff = 0.0
+            sent.append(id)
+            self.nextReplay += interval
+        self.store.remove(sent)
+        self.packetCount += len(sent)
+        self.replayCount += len(sent)
+        return len(sent)
+
+    # true if there are stored payloads and we are in a state to replay them
+    def replayPending(self):
+        return self.store is not None and self.online and self.running and self.store.getCount() > 0
+
+    def getEncoding(self, msg):
+        return msg.getEncoding() or self.encoding
+
+    # add a message to its batch, sending the batch first if the message would push it over budget
+    def addToBatch(self, msg, now):
+        encoding = self.getEncoding(msg)
+        if self.batchTopic:
+            key = (self.batchTopic, encoding)
+            part = codec.encode({'topic': msg.getTopic(), 'message': msg.getMessage()}, encoding)
+        else:
+            key = (msg.getTopic(), encoding)
+            part = codec.encode(msg.getMessage(), encoding)
+        sent = 0
+        batch = self.batches.get(key)
+        if batch and batch[1] + len(part) > self.batchBytes:
+            sent += self.flushBatch(key)
+            batch = None
+        if not batch:
+            batch = [[], 0, now, 0]
+            self.batches[key] = batch
+        batch[0].append(part)
+        batch[1] += len(part)
+        batch[3] += 1
+        if batch[1] >= self.batchBytes:
+            sent += self.flushBatch(key)
+        return sent
+
+    def flushBatch(self, key):
+        topic, encoding = key
+        parts, size, first, count = self.batches.pop(key)
+        # a lone message on its own topic goes out as it is so it looks like an unbatched reply
+        if count == 1 and not self.batchTopic:
+            return self.publish(topic, parts[0], 1)
+        return self.publish(topic, codec.join(parts, encoding), count)
+
+    # send the batches that have waited long enough, or all of them, returns how many messages went out
+    def flushBatches(self, now, all=False):
+        sent = 0
+        for key in list(self.batches):
+            if all or now - self.batches[key][2] >= self.batchDelay:
+                sent += self.flushBatch(key)
+        return sent
+
+    # how long the publishing thread can sleep before the oldest batch is due
+    def nextBatchDue(self, now):
+        due = None
+        for batch in self.batches.values():
+            wait = batch[2] + self.batchDelay - now
+            if due is None or wait < due:
+                due = wait
+        return due
+
+    # blocks and publishes messages until terminate() is called
+    def start(self):
+        logging.info("Publisher starting")
+        windowStart = time.monotonic()
+        windowCount = 0
+        while True:
+            self.cond.acquire()
+            while self.running and not self.outbox:
+                now = time.monotonic()
+                remaining = self.statsInterval - (now - windowStart)
+                batchDue = self.nextBatchDue(now)
+                if batchDue is not None:
+                    remaining = min(remaining, batchDue)
+                if self.replayPending():
+                    remaining = min(remaining, self.nextReplay - now)
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            # swap out the whole outbox so producers are not blocked while we publish
+            pending = self.outbox
+            self.outbox = deque()
+            running = self.running
+            self.cond.release()
+
+            now = time.monotonic()
+            for msg in pending:
+                if self.batchBytes > 0:
+                    windowCount += self.addToBatch(msg, now)
+                else:
+                    payload = codec.encode(msg.getMessage(), self.getEncoding(msg))
+                    windowCount += self.publish(msg.getTopic(), payload, 1)
+            if self.batches:
+                windowCount += self.flushBatches(time.monotonic(), all=not running)
+            if self.replayPending():
+                self.replay(time.monotonic())
+
+            now = time.monotonic()
+            if now - windowStart >= self.statsInterval:
+                self.pubRate = windowCount / (now - windowStart)
+                logging.info("Publisher: queue depth {} (max {}), {:.2f} msg/s, {} sent in {} publishes, {} stored".format(
+                    self.getQueueDepth(), self.maxDepth, self.pubRate, self.pubCount, self.packetCount,
+                    self.getStoredCount()))
+                windowStart = now
+                windowCount = 0
+
+            if not running:
+                break
+        logging.info("Publisher terminating")
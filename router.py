@@ -0,0 +1,145 @@
+import time
+import threading
+from collections import deque
+
+# Author: Peter Van Eenoo
+# CSS 532 IoT - class project
+# March 2021
+
+MAX_ECHOES = 1024 # published messages remembered while we wait for them to come back to us
+
+# we subscribe to the same topics we reply on, so the broker sends every reply back to us. MQTT 3.1.1
+# has no no-local subscription option, so we remember what we publish and drop it when it comes back,
+# comparing the raw bytes before anything is decoded. Messages that never come back are forgotten
+# once MAX_ECHOES newer ones have been published
+class echoFilter:
+    def __init__(self, size=MAX_ECHOES):
+        self.size = size
+        self.mutex = threading.Lock()
+        self.expected = {} # (topic, payload) -> number of copies still to come back
+        self.order = deque() # the same keys oldest first, to forget the ones that never come back
+        self.dropped = 0
+
+    # call before publishing, the echo can arrive before publish() returns
+    def sent(self, topic, payload):
+        key = (topic, bytes(payload))
+        self.mutex.acquire()
+        self.expected[key] = self.expected.get(key, 0) + 1
+        self.order.append(key)
+        if len(self.order) > self.size:
+            self.forget(self.order.popleft())
+        self.mutex.release()
+
+    # true if the message is one of ours coming back, it's dropped and counted
+    def isEcho(self, topic, payload):
+        key = (topic, bytes(payload))
+        self.mutex.acquire()
+        echo = key in self.expected
+        if echo:
+            self.forget(key)
+            self.order.remove(key) # replies come back in order, so it's near the front
+            self.dropped += 1
+        self.mutex.release()
+        return echo
+
+    # called with mutex held
+    def forget(self, key):
+        count = self.expected.get(key, 0) - 1
+        if count > 0:
+            self.expected[key] = count
+        else:
+            self.expected.pop(key, None)
+
+    def getDropped(self):
+        return self.dropped
+
+    def getWaiting(self):
+        return len(self.order)
+
+# one request taken off the wire, handlers get this and return the message to reply with
+class sensorRequest:
+    def __init__(self, topic, thing, action, value, payload, encoding):
+        self.topic = topic
+        self.thing = thing          # the sensor, actuator or system the topic was for
+        self.action = action        # the payload key that matched a route, 'get', 'set'...
+        self.value = value          # that key's value
+        self.payload = payload      # the whole decoded payload for handlers that take extra fields
+        self.encoding = encoding    # the encoding the request arrived in, replies use it too
+
+# a registered handler along with its statistics
+class routeEntry:
+    def __init__(self, name, lane, handler):
+        self.name = name
+        self.lane = lane
+        self.handler = handler
+        self.count = 0
+        self.totalTime = 0.0
+        self.maxTime = 0.0
+
+# table of handlers keyed by (thing, action, value). Subsystems register their own routes so adding
+# a sensor doesn't mean touching the receive callback. A value of None registers a route for any
+# value of that action, like setTime which takes a number
+class topicRouter:
+    def __init__(self):
+        self.routes = {}
+        self.actions = {}  # thing -> set of actions registered for it, used to pick the payload key
+        self.statsMutex = threading.Lock() # routes run on several lanes at once, it guards their statistics
+
+    # things and values may be a single string or a list of them
+    def register(self, things, action, values, lane, handler):
+        if isinstance(things, str):
+            things = [things]
+        if values is None or isinstance(values, str):
+            values = [values]
+        for thing in things:
+            self.actions.setdefault(thing, set()).add(action)
+            for value in values:
+                name = '{}/{}/{}'.format(thing, action, value if value is not None else '*')
+                self.routes[(thing, action, value)] = routeEntry(name, lane, handler)
+
+    # returns (routeEntry, sensorRequest) for the first key in the payload that has a route, or None
+    # our own replies never have an action key so they are filtered out here too
+    def lookup(self, topic, thing, payload, encoding):
+        actions = self.actions.get(thing)
+        if not actions or not isinstance(payload, dict):
+            return None
+        for action, value in payload.items():
+            if action not in actions:
+                continue
+            entry = None
+            if isinstance(value, str):
+                entry = self.routes.get((thing, action, value))
+            if entry is None:
+                entry = self.routes.get((thing, action, None))
+            if entry is not None:
+                return entry, sensorRequest(topic, thing, action, value, payload, encoding)
+        return None
+
+    # run the route's handler and keep track of how long it took
+    def run(self, entry, request):
+        start = time.perf_counter()
+        try:
+            return entry.handler(request)
+        finally:
+            self.record(entry, time.perf_counter() - start)
+
+    # count a request the route answered in elapsed seconds, for requests answered without run()
+    def record(self, entry, elapsed):
+        self.statsMutex.acquire()
+        entry.count += 1
+        entry.totalTime += elapsed
+        if elapsed > entry.maxTime:
+            entry.maxTime = elapsed
+        self.statsMutex.release()
+
+    # count, mean and max handler time in ms for every route that has been used
+    def getStats(self):
+        stats = {}
+        self.statsMutex.acquire()
+        for entry in self.routes.values():
+            if entry.count:
+                stats[entry.name] = {'count': entry.count,
+                                     'mean ms': round(1000 * entry.totalTime / entry.count, 2),
+                                     'max ms': round(1000 * entry.maxTime, 2)}
+        self.statsMutex.release()
+        return stats
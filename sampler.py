@@ -0,0 +1,149 @@
+import threading
+import logging
+import time
+import heapq
+from array import array
+
+# Author: Peter Van Eenoo
+# CSS 532 IoT - class project
+# March 2021
+
+HISTORY_SIZE = 360 # default number of samples kept for each channel
+
+# fixed size history of timestamped samples, once it's full the oldest sample is overwritten
+# the values and times are kept in flat arrays of doubles so it never allocates after creation
+class ringBuffer:
+    def __init__(self, size):
+        self.size = size
+        self.values = array('d', [0.0] * size)
+        self.times = array('d', [0.0] * size) # monotonic time the sample was taken
+        self.head = 0  # index the next sample is written to
+        self.count = 0
+        self.mutex = threading.Lock()
+
+    def append(self, ts, value):
+        self.mutex.acquire()
+        self.values[self.head] = value
+        self.times[self.head] = ts
+        self.head = (self.head + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+        self.mutex.release()
+
+    # returns (timestamp, value) of the newest sample or None if we don't have one yet
+    def latest(self):
+        self.mutex.acquire()
+        result = None
+        if self.count:
+            i = (self.head - 1) % self.size
+            result = (self.times[i], self.values[i])
+        self.mutex.release()
+        return result
+
+    # returns (min, max, mean, count) of the samples taken in the last window seconds
+    # walks back from the newest sample so it stops as soon as it leaves the window
+    def window(self, seconds, now):
+        self.mutex.acquire()
+        low = high = total = 0.0
+        n = 0
+        i = self.head
+        for _ in range(self.count):
+            i = (i - 1) % self.size
+            if now - self.times[i] > seconds:
+                break
+            value = self.values[i]
+            if n == 0 or value < low:
+                low = value
+            if n == 0 or value > high:
+                high = value
+            total += value
+            n += 1
+        self.mutex.release()
+        if n == 0:
+            return None
+        return (low, high, total / n, n)
+
+# this class samples sensors in the background on its own thread so requests can be answered from
+# the latest sample without waiting on the hardware. Each sensor has its own interval and a read
+# function that returns a dict of channel name -> value, every channel gets its own ringBuffer
+class sampleManager:
+    def __init__(self, historySize=HISTORY_SIZE):
+        self.running = True
+        self.historySize = historySize
+        self.sensors = {}  # sensor name -> (interval, read function, channel names)
+        self.buffers = {}  # channel name -> ringBuffer
+        self.listeners = {} # sensor name -> functions called with each new sample
+        self.wake = threading.Event()
+
+    # register a sensor before start() is called, an interval of 0 or less leaves it unsampled
+    def addSensor(self, name, interval, read, channels):
+        if interval <= 0:
+            return
+        self.sensors[name] = (interval, read, channels)
+        for channel in channels:
+            self.buffers[channel] = ringBuffer(self.historySize)
+
+    # call listener(values, ts) on the sampler thread after every sample of the sensor, so on-device
+    # logic can react to new readings without polling. Listeners must not block
+    def addListener(self, name, listener):
+        self.listeners.setdefault(name, []).append(listener)
+
+    def terminate(self):
+        self.running = False
+        self.wake.set()
+
+    def isSampled(self, channel):
+        return channel in self.buffers
+
+    # returns (value, age in seconds) of the newest sample on the channel or None
+    def getLatest(self, channel):
+        if channel not in self.buffers:
+            return None
+        sample = self.buffers[channel].latest()
+        if sample is None:
+            return None
+        return (sample[1], time.monotonic() - sample[0])
+
+    # returns the newest value of each of the sensor's channels, they were all taken by the same read
+    def getLatestGroup(self, name):
+        if name not in self.sensors:
+            return None
+        group = {}
+        for channel in self.sensors[name][2]:
+            sample = self.buffers[channel].latest()
+            if sample is None:
+                return None
+            group[channel] = sample[1]
+        return group
+
+    # returns (min, max, mean, count) for the channel over the last window seconds or None
+    def getHistory(self, channel, window):
+        if channel not in self.buffers:
+            return None
+        return self.buffers[channel].window(window, time.monotonic())
+
+    def start(self):
+        logging.info("Sampler starting with sensors: {}".format(list(self.sensors.keys())))
+        # heap of (next due time, sensor name)
+        due = [(time.monotonic(), name) for name in self.sensors]
+        heapq.heapify(due)
+        while self.running and due:
+            when, name = due[0]
+            delay = when - time.monotonic()
+            if delay > 0:
+                self.wake.wait(delay)
+                continue
+            heapq.heappop(due)
+            interval, read, channels = self.sensors[name]
+            try:
+                values = read()
+                ts = time.monotonic()
+                for channel in channels:
+                    self.buffers[channel].append(ts, values[channel])
+                for listener in self.listeners.get(name, []):
+                    listener(values, ts)
+            except Exception as e:
+                logging.error("Sampling '{}' failed: {}".format(name, e))
+            # schedule from when it was due so the interval doesn't drift, but never in the past
+            heapq.heappush(due, (max(when + interval, time.monotonic()), name))
+        logging.info("Sampler terminating")
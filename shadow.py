@@ -0,0 +1,75 @@
+import threading
+
+# Author: Peter Van Eenoo
+# CSS 532 IoT - class project
+# March 2021
+
+# a versioned document of the actuators' state, in the spirit of an AWS IoT device shadow:
+#   {"version": 7, "reported": {"water": {...}, "led": {...}}, "desired": {"water": {...}}}
+# the subsystems report their state when it changes, so reading it never waits on an actuator's lock.
+# Every change builds a new document and swaps it in, a document is never changed once it's out, so
+# readers just take the current one without locking. Only writers share the mutex.
+# Desired changes are queued here and taken by the subsystem at its next safe point, when it can
+# apply them without interrupting what it's doing
+class deviceShadow:
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.document = {'version': 0, 'reported': {}, 'desired': {}}
+        self.listeners = []
+
+    # listener(document) is called after every change, outside of the mutex
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    # the current document, don't change it
+    def getDocument(self):
+        return self.document
+
+    # one section of the reported state, or None if that subsystem hasn't reported yet
+    def getReported(self, section):
+        return self.document['reported'].get(section)
+
+    # merge values into a section of the reported state
+    def report(self, section, values):
+        self.update('reported', section, values)
+
+    # queue values for a subsystem to apply at its next safe point
+    def desire(self, section, values):
+        self.update('desired', section, values)
+
+    # remove and return the values queued for a section, called by the subsystem at a safe point
+    def takeDesired(self, section):
+        if section not in self.document['desired']: # nothing queued, the common case doesn't lock
+            return {}
+        self.mutex.acquire()
+        old = self.document
+        values = old['desired'].get(section, {})
+        desired = dict(old['desired'])
+        desired.pop(section, None)
+        document = {'version': old['version'] + 1, 'reported': old['reported'], 'desired': desired}
+        self.document = document
+        self.mutex.release()
+        self.notify(document)
+        return values
+
+    def update(self, kind, section, values):
+        self.mutex.acquire()
+        old = self.document
+        current = old[kind].get(section, {})
+        if all(current.get(key) == value for key, value in values.items()) and section in old[kind]:
+            self.mutex.release()
+            return # nothing changed, keep the version
+        merged = dict(current)
+        merged.update(values)
+        part = dict(old[kind])
+        part[section] = merged
+        document = dict(old)
+        document[kind] = part
+        document['version'] = old['version'] + 1
+        self.document = document
+        self.mutex.release()
+        self.notify(document)
+
+    def notify(self, document):
+        for listener in self.listeners:
+            listener(document)
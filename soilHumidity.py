@@ -1,10 +1,9 @@
 from time import sleep     # Import the sleep function from the time module
+import time
 import threading
-import board
-import busio
-import RPi.GPIO as GPIO    # Import Raspberry Pi GPIO library
-import adafruit_ads1x15.ads1015 as ADS
-from adafruit_ads1x15.analog_in import AnalogIn
+import statistics
+import backend
+import calibration
 
 # Author: Peter Van Eenoo
 # CSS 532 IoT - class project 
@@ -14,66 +13,200 @@ from adafruit_ads1x15.analog_in import AnalogIn
 #CEILING = 14000
 #FLOOR = 25000
 
-# sensor 2's values
+# sensor 2's values, the default curve for a device without one in its calibration profile
 CEILING = 20845
 FLOOR = 22280
+DEFAULT_CURVE = {'type': 'linear', 'points': [[CEILING, 100.0], [FLOOR, 0.0]]}
 
 SOIL_POWER_PIN = 16  # the GPIO pin for controlling power to the soil moisture sensor
-
-GPIO.setwarnings(False)    # Ignore warning for now
-GPIO.setup(SOIL_POWER_PIN, GPIO.OUT, initial=GPIO.LOW)   # Set GPIO PIN 16 to be the output pin and set it LOW by default
+SOIL_CHANNEL = 0 # the ADC channel the probe is wired to
 
 
 TIMEOUT = 3
 WAIT_TIME = 1 # time to wait for soil chip to come online
+MAX_AGE = 0 # seconds a reading is served from cache instead of powering the probe again, 0 always reads
+BURST_SAMPLES = 1 # ADC samples taken in each powered reading, 1 is a single sample
+FAST_DATA_RATE = 3300 # samples/s, the ADS1015's fastest. Bursts use it so the probe isn't on any longer
+REDUCERS = ['median', 'trimmed'] # how a burst is reduced to one reading
+TRIM_FRACTION = 0.2 # fraction of the lowest and of the highest samples the trimmed mean drops
+
+# the median or trimmed mean of a burst of readings, and their variance
+def reduceBurst(values, reducer='median', trim=TRIM_FRACTION):
+    ordered = sorted(values)
+    if reducer == 'median':
+        center = statistics.median(ordered)
+    else:
+        cut = int(len(ordered) * trim)
+        kept = ordered[cut:len(ordered) - cut]
+        center = sum(kept) / len(kept)
+    variance = statistics.variance(ordered) if len(ordered) > 1 else 0.0
+    return center, variance
 
 # this class manages reading values from the soil humidity sensor, it also manages the power to the sensor
-# so that it isn't left on all day
+# so that it isn't left on all day. Each reading can be a burst of samples taken while the probe is
+# powered, the warm-up is what costs us so a burst is nearly free and outliers get thrown out
 class soilManager:
-    def __init__(self):
+    def __init__(self, maxAge=MAX_AGE, samples=BURST_SAMPLES, reducer='median', trim=TRIM_FRACTION, curve=None):
+        if samples < 1:
+            raise ValueError("a soil reading needs at least 1 sample")
+        if reducer not in REDUCERS:
+            raise ValueError("unknown soil reducer {}, choose from {}".format(reducer, ', '.join(REDUCERS)))
+        if not 0 <= trim < 0.5:
+            raise ValueError("trim fraction must be at least 0 and below 0.5")
         self.running = True
         self.soilValue = 0.0
+        self.soilVariance = 0.0 # of the samples in the last reading
+        self.readTime = None # monotonic time the last reading was taken
+        self.maxAge = maxAge
+        self.samples = samples
+        self.reducer = reducer
+        self.trim = trim
+        self.curve = curve or calibration.compileCurve(DEFAULT_CURVE) # raw ADC reading -> % humidity
 
-        # this system is a little more simple so we don't need to use threading events
-        self.mutex = threading.Lock()
-        # Create the I2C bus
-        self.i2c = busio.I2C(board.SCL, board.SDA)
+        # only one reading is powered at a time, anyone who asks while it's in progress waits on
+        # this condition and shares the result instead of powering the probe again
+        self.cond = threading.Condition()
+        self.reading = False
+        self.readCount = 0 # bumped every time a reading finishes so waiters know theirs is done
+        self.readFailed = False
+        # callbacks of the requests sharing the next reading without a thread waiting for it, and
+        # whether a thread has been asked to take that reading yet, see addWaiter()
+        self.waiters = []
+        self.pending = False
 
-        # Create the ADC object using the I2C bus
-        self.ads = ADS.ADS1015(self.i2c)
+        hardware = backend.getBackend()
+        self.gpio = hardware.gpio
+        self.gpio.setwarnings(False)    # Ignore warning for now
+        self.gpio.setup(SOIL_POWER_PIN, self.gpio.OUT, initial=self.gpio.LOW)   # Set GPIO PIN 16 to be the output pin and set it LOW by default
 
-        # Create single-ended input on channel 0
-        self.chan = AnalogIn(self.ads, ADS.P0)
+        # Create single-ended input on the ADC's channel 0, bursts run it at the fast data rate
+        self.chan = hardware.openADC(SOIL_CHANNEL, FAST_DATA_RATE if samples > 1 else None)
 
     def terminate(self):
         self.running = False
     
-    # we have to calibrate these values in the header for each sensor as their default values differ from unit to unit
+    # each probe reads differently so the curve comes from the device's calibration profile, higher
+    # readings mean more resistance which means it's less humid
     def getPercentHumidity(self, reading):
-        ## this is a little confusing because we are using negative numbers because higher values
-        ## means more resistance which means it's less humid so we need to invert our percentage range
-        if reading > FLOOR:
-            # humidity is very low
-            return 0.0
-        elif reading > CEILING:
-            difference = ( -1 * FLOOR) - ( -1 * CEILING)
-            return 100 * (1 - ((-1 *reading) - (-1 * CEILING)) / difference)
-        else:
-            ## reading is less than ceiling, must be very wet and moist
-            return 100.0
+        return self.curve.convert(reading)
+
+    # takes effect from the next reading
+    def setCurve(self, curve):
+        self.curve = curve
 
     # for safty reasons this sensor manages it's own on and off state. The sensor will corrode itself after a few days if left on
+    # returns the humidity and the variance of the burst's samples
+    def readProbe(self):
+        self.gpio.output(SOIL_POWER_PIN, self.gpio.HIGH) # Turn on and wait for sensor
+        try:
+            sleep(WAIT_TIME) 
+            # TODO what happens if the channel reading is bad, catch errors here and provide meaningful response
+            curve = self.curve # one curve for the whole burst even if it's changed part way through
+            values = [curve.convert(self.chan.value) for i in range(self.samples)]
+        finally:
+            self.gpio.output(SOIL_POWER_PIN, self.gpio.LOW) # Turn off
+        value, variance = reduceBurst(values, self.reducer, self.trim)
+        print("debug:{:.2f}".format(round(value, 2)))
+        return value, variance
+
     def getSoilHumidity(self):
-        # just in case we get requests too fast, only perform 1 reading at a time
-        self.mutex.acquire()
-
-        GPIO.output(SOIL_POWER_PIN, GPIO.HIGH) # Turn on and wait for sensor
-        sleep(WAIT_TIME) 
-        # TODO what happens if the channel reading is bad, catch errors here and provide meaningful response
-        self.soilValue = self.getPercentHumidity(self.chan.value) 
-        print("debug:{:.2f}".format(round(self.soilValue, 2)))
-
-        GPIO.output(SOIL_POWER_PIN, GPIO.LOW) # Turn off
-        self.mutex.release()
-        ## test and see if we should return an average reading instead of a single reading?
-        return self.soilValue
+        return self.getSoilReading()[0]
+
+    # the variance of the last reading's samples and how many samples each reading takes
+    def getSoilSpread(self):
+        self.cond.acquire()
+        variance = self.soilVariance
+        self.cond.release()
+        return variance, self.samples
+
+    # ask for a reading without waiting for it, callback(value, age, failed) is called with the next
+    # reading by the thread that takes it, or right away if the last one is younger than maxAge.
+    # Returns True if the caller has to have readForWaiters() run on a thread that can wait, False if
+    # a reading is already in progress or on its way and the callback will share it
+    def addWaiter(self, callback):
+        self.cond.acquire()
+        if self.readTime is not None and time.monotonic() - self.readTime < self.maxAge:
+            value, age = self.soilValue, time.monotonic() - self.readTime
+            self.cond.release()
+            callback(value, age, False)
+            return False
+        self.waiters.append(callback)
+        start = not self.reading and not self.pending
+        self.pending = self.pending or start
+        self.cond.release()
+        return start
+
+    # take back a callback whose reading couldn't be started, returns False if it has already been called
+    def cancelWaiter(self, callback):
+        self.cond.acquire()
+        waiting = callback in self.waiters
+        if waiting:
+            self.waiters.remove(callback)
+            self.pending = False
+        self.cond.release()
+        return waiting
+
+    # take the reading the waiters are sharing, unless another reading has already answered them
+    def readForWaiters(self):
+        self.cond.acquire()
+        self.pending = False
+        waiting = bool(self.waiters)
+        self.cond.release()
+        if waiting:
+            try:
+                self.getSoilReading()
+            except RuntimeError:
+                pass # the waiters were told it failed
+
+    # called with cond held, the callbacks are called once it's released
+    def takeWaiters(self):
+        waiters = self.waiters
+        self.waiters = []
+        return waiters
+
+    # returns the humidity and how many seconds old it is. If the last reading is younger than maxAge
+    # it's returned without touching the probe, if a reading is in progress we wait for it and share it
+    # every reading also answers the waiters added with addWaiter()
+    def getSoilReading(self):
+        self.cond.acquire()
+        if self.readTime is not None and time.monotonic() - self.readTime < self.maxAge:
+            value, age = self.soilValue, time.monotonic() - self.readTime
+            waiters = self.takeWaiters()
+            self.cond.release()
+            for callback in waiters:
+                callback(value, age, False)
+            return value, age
+
+        if self.reading:
+            count = self.readCount
+            while self.readCount == count:
+                self.cond.wait()
+            failed = self.readFailed
+            value = self.soilValue
+            age = time.monotonic() - self.readTime if self.readTime else 0.0
+            self.cond.release()
+            if failed:
+                raise RuntimeError("soil reading failed")
+            return value, age
+
+        # nobody is reading, so it's our turn to power the probe
+        self.reading = True
+        self.cond.release()
+        value = None
+        try:
+            value, variance = self.readProbe()
+        finally:
+            self.cond.acquire()
+            if value is not None:
+                self.soilValue = value
+                self.soilVariance = variance
+                self.readTime = time.monotonic()
+            self.readFailed = value is None
+            self.reading = False
+            self.readCount += 1
+            waiters = self.takeWaiters()
+            self.cond.notify_all()
+            self.cond.release()
+            for callback in waiters:
+                callback(value, 0.0, value is None)
+        return value, 0.0
@@ -0,0 +1,76 @@
+import threading
+import logging
+import time
+
+# Author: Peter Van Eenoo
+# CSS 532 IoT - class project
+# March 2021
+
+# records how long each step of startup took, measured from when the process started so a rebooted
+# gateway's log shows where the time to get back online went
+class startupTimer:
+    def __init__(self, start):
+        self.start = start
+        self.mutex = threading.Lock()
+        self.marks = [] # (step, seconds since start)
+
+    def mark(self, step):
+        elapsed = time.monotonic() - self.start
+        self.mutex.acquire()
+        self.marks.append((step, elapsed))
+        self.mutex.release()
+        return elapsed
+
+    def getMarks(self):
+        self.mutex.acquire()
+        marks = sorted(self.marks, key=lambda m: m[1])
+        self.mutex.release()
+        return marks
+
+    def report(self, title):
+        logging.info("{}: {}".format(title, ', '.join("{} {:.3f}s".format(step, elapsed)
+                                                       for step, elapsed in self.getMarks())))
+
+# brings up one subsystem on its own thread so the hardware drivers initialize in parallel with each
+# other and with the MQTT connection. Handlers call get(), which waits until the subsystem is ready,
+# so a request that shows up early just waits on its lane instead of failing
+class subsystemLoader:
+    def __init__(self, name, factory, timer=None):
+        self.name = name
+        self.factory = factory # called with no arguments, returns the subsystem
+        self.timer = timer
+        self.ready = threading.Event()
+        self.subsystem = None
+        self.error = None
+        self.loadTime = None
+        self.thread = threading.Thread(name='{} startup'.format(name), target=self.load)
+
+    def start(self):
+        self.thread.start()
+
+    def load(self):
+        start = time.monotonic()
+        try:
+            self.subsystem = self.factory()
+        except Exception as e:
+            self.error = e
+            logging.error("{} subsystem failed to start: {}".format(self.name, e))
+        finally:
+            self.loadTime = time.monotonic() - start
+            if self.timer:
+                self.timer.mark('{} ready'.format(self.name))
+            self.ready.set()
+
+    def isReady(self):
+        return self.ready.is_set() and self.error is None
+
+    # wait for the subsystem and return it, raises if it failed to start
+    def get(self):
+        self.ready.wait()
+        if self.error is not None:
+            raise RuntimeError("{} subsystem is unavailable: {}".format(self.name, self.error))
+        return self.subsystem
+
+    # seconds the factory took, None until it finishes
+    def getLoadTime(self):
+        return self.loadTime
@@ -8,4 +8,4 @@ rootCA=AmazonRootCA3.pem
 cert=$prefix-certificate.pem.crt
 key=$prefix-private.pem.key
 
-python3 mainLoop.py --endpoint $endpoint --root-ca $certdir$rootCA --cert $certdir$cert --key $certdir$key --client-id $name
+python3 ../mainLoop.py --backend stub --endpoint $endpoint --root-ca $certdir$rootCA --cert $certdir$cert --key $certdir$key --client-id $name
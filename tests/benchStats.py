@@ -0,0 +1,67 @@
+# Author: Peter Van Eenoo
+# CSS 532 IoT - class project
+# March 2021
+
+# shared latency statistics for the benchmark clients in this directory
+# latencies are in milliseconds
+
+HISTOGRAM_WIDTH = 50 # characters in the longest histogram bar
+
+# nearest-rank percentile of an already sorted list
+def percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    rank = int(round(p / 100.0 * len(ordered) + 0.5)) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+# returns a dict of count, min, mean, p50, p90, p99 and max
+def summarize(latencies):
+    ordered = sorted(latencies)
+    stats = {'count': len(ordered)}
+    if not ordered:
+        return stats
+    stats['min'] = ordered[0]
+    stats['mean'] = sum(ordered) / len(ordered)
+    stats['p50'] = percentile(ordered, 50)
+    stats['p90'] = percentile(ordered, 90)
+    stats['p99'] = percentile(ordered, 99)
+    stats['max'] = ordered[-1]
+    return stats
+
+# buckets double in width so a few slow replies don't squash the rest of the histogram
+# returns a list of (upper bound in ms, count)
+def histogram(latencies, first=1.0):
+    if not latencies:
+        return []
+    buckets = []
+    bound = first
+    top = max(latencies)
+    while True:
+        buckets.append([bound, 0])
+        if bound >= top:
+            break
+        bound *= 2
+    for value in latencies:
+        for bucket in buckets:
+            if value <= bucket[0]:
+                bucket[1] += 1
+                break
+    return [(b, c) for b, c in buckets]
+
+def printReport(title, latencies, timeouts=0, elapsed=None, errors=0):
+    stats = summarize(latencies)
+    print("== {} ==".format(title))
+    line = "replies: {}  timeouts: {}".format(stats['count'], timeouts)
+    if errors:
+        line += "  errors: {}".format(errors)
+    if elapsed:
+        line += "  throughput: {:.1f} replies/s".format(stats['count'] / elapsed)
+    print(line)
+    if not latencies:
+        return
+    print("latency ms  min {min:.2f}  mean {mean:.2f}  p50 {p50:.2f}  p90 {p90:.2f}  p99 {p99:.2f}  max {max:.2f}".format(**stats))
+    buckets = histogram(latencies)
+    most = max(c for b, c in buckets)
+    for bound, count in buckets:
+        bar = '#' * int(round(HISTOGRAM_WIDTH * count / most)) if most else ''
+        print("  <= {:>9.1f} ms {:>6} {}".format(bound, count, bar))
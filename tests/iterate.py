@@ -3,7 +3,11 @@
 
 # major modifications made by Peter Van Eenoo
 # for CSS 532 at UW Bothell
-# testing file use to iterate through a client node's sensors and request data from them in a loop to simulate a high-workload 
+# testing file use to iterate through client nodes' sensors and request data from them to simulate a high-workload
+# it can drive many node IDs with a weighted mix of thing/action requests, either closed-loop (each simulated
+# client waits for its reply before sending again) or open-loop at a target request rate, and reports
+# throughput, errors, timeouts and latency per topic. --sweep steps the open-loop rate up to find the
+# request rate where the gateway's receive_loop saturates
 
 # Author: Peter Van Eenoo
 # CSS 532 IoT - class project
@@ -14,32 +18,43 @@ import argparse
 from awscrt import io, mqtt, auth, http
 from awsiot import mqtt_connection_builder
 import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
 import threading
 import logging
+import random
 import time
-from datetime import datetime
 from collections import deque
-from uptime import uptime
-from datetime import timedelta
-import json
-
-logging.basicConfig(level=logging.DEBUG)
-#logging.basicConfig(level=logging.INFO)
-
+import itertools
+import codec
+import localBroker
+import benchStats
+
+#logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
+
+# the mix the original version of this test walked through, one 'get value' for each sensor system
+DEFAULT_MIX = "temp:get:value,pressure:get:value,humidity:get:value,altitude:get:value," + \
+        "soil:get:value,water:get:value,led:get:value"
+# replies with one of these statuses are counted as errors rather than successful replies
+ERROR_STATUSES = ['busy', 'ActionDenied', 'not sampled']
+# a sweep step is saturated once the gateway answers less than this share of what we offered, or more
+# than ERROR_BUDGET of the requests got an error or timed out
+SATURATION_RATIO = 0.95
+ERROR_BUDGET = 0.01
+REAP_INTERVAL = 0.01 # seconds between checks for timed out requests
 
 # grab and parse the arguments
 parser = argparse.ArgumentParser(description="Send and receive messages through and MQTT connection.")
-parser.add_argument('--endpoint', required=True, help="Your AWS IoT custom endpoint, not including a port. " +
+parser.add_argument('--endpoint', help="Your AWS IoT custom endpoint, not including a port. " +
         "Ex: \"abcd123456wxyz-ats.iot.us-east-1.amazonaws.com\"")
+parser.add_argument('--local-broker', help="Use the local MQTT stand-in instead of AWS IoT, either \"inproc\" " +
+        "or the host:port of a broker started with localBroker.py.")
 parser.add_argument('--cert', help="File path to your client certificate, in PEM format.")
 parser.add_argument('--key', help="File path to your private key, in PEM format.")
 parser.add_argument('--root-ca', help="File path to root certificate authority, in PEM format. " +
         "Necessary if MQTT server uses a certificate that's not already in " +
         "your trust store.")
 parser.add_argument('--client-id', default="test-", help="Client ID for MQTT connection.")
-parser.add_argument('--topic', default="test/topic", help="Topic to subscribe to, and publish messages to.")
-parser.add_argument('--message', default="Hello World!", help="Message to publish. " +
-        "Specify empty string to publish nothing.")
 parser.add_argument('--use-websocket', default=False, action='store_true',
         help="To use a websocket instead of raw mqtt. If you " +
         "specify this option you must specify a region for signing, you can also enable proxy mode.")
@@ -48,6 +63,30 @@ parser.add_argument('--signing-region', default='us-east-1', help="If you specif
 parser.add_argument('--proxy-host', help="Hostname for proxy to connect to. Note: if you use this feature, " +
         "you will likely need to set --root-ca to the ca for your proxy.")
 parser.add_argument('--proxy-port', type=int, default=8080, help="Port for proxy to connect to.")
+parser.add_argument('--encoding', choices=codec.ENCODINGS, default='json', help="Payload encoding to send " +
+        "requests in, the gateway replies in the same encoding.")
+parser.add_argument('--nodes', default='node2', help="Comma separated node IDs to send requests to.")
+parser.add_argument('--node-count', type=int, default=0, help="Send to this many node IDs named " +
+        "{--node-prefix}0, {--node-prefix}1... instead of --nodes.")
+parser.add_argument('--node-prefix', default='node', help="Prefix of the node IDs made by --node-count.")
+parser.add_argument('--mix', default=DEFAULT_MIX, help="Comma separated thing:action:value requests to pick " +
+        "from, add *weight to make one more likely, ex: \"temp:get:value*4,water:setTime:5\".")
+parser.add_argument('--mode', choices=['closed', 'open'], default='closed', help="closed: each client waits " +
+        "for its reply before sending again. open: send at --rate no matter how the gateway keeps up.")
+parser.add_argument('--clients', type=int, default=1, help="Number of simulated clients in closed-loop mode.")
+parser.add_argument('--think', type=float, default=0.0, help="Seconds each closed-loop client waits " +
+        "after a reply before its next request.")
+parser.add_argument('--rate', type=float, default=50.0, help="Requests per second in open-loop mode.")
+parser.add_argument('--arrivals', choices=['uniform', 'poisson'], default='uniform', help="Space open-loop " +
+        "requests evenly, or with exponential gaps like independent clients would.")
+parser.add_argument('--sweep', help="start:stop:step open-loop rates to run one after the other, " +
+        "reports the rate where the gateway stops keeping up.")
+parser.add_argument('--duration', type=float, default=10.0, help="Seconds to send for, per sweep step.")
+parser.add_argument('--timeout', type=float, default=5.0, help="Seconds to wait for a reply before " +
+        "counting a timeout.")
+parser.add_argument('--group', choices=['topic', 'route'], default='topic', help="Report per topic, or per " +
+        "thing/action/value across all nodes.")
+parser.add_argument('--seed', type=int, help="Random seed so a run's request mix can be repeated.")
 parser.add_argument('--verbosity', choices=[x.name for x in io.LogLevel], default=io.LogLevel.NoLogs.name,
         help='Logging level')
 
@@ -81,77 +120,294 @@ def on_resubscribe_complete(resubscribe_future):
 
 ###### Gloabls area for main program and setup #########
 args = parser.parse_args()
+if not args.endpoint and not args.local_broker:
+    parser.error("one of --endpoint or --local-broker is required")
 
 io.init_logging(getattr(io.LogLevel, args.verbosity), 'stderr')
 
-global received_count
-global WAIT
-received_count = 0
-
-global CONNECTED 
-#SUB_TOPIC = f"sensors/+/node2"
-## main program message event to wake-up and check for messages
-msgEvent = threading.Event()
-
-
-# the list of supported actions our device will response to
+# the list of supported actions our devices will response to, a payload with one of these keys is a
+# request (maybe our own coming back to us) rather than a reply
 SUPPORTED_ACTIONS = ['get','set', 'setTime', 'deviceState']
 
+# returns a list of (thing, action, value) and a matching list of weights from --mix
+def parseMix(mix):
+    requests = []
+    weights = []
+    for item in mix.split(','):
+        item, _, weight = item.strip().partition('*')
+        thing, action, value = item.split(':', 2)
+        try:
+            value = int(value) # setTime takes a number
+        except ValueError:
+            pass
+        requests.append((thing, action, value))
+        weights.append(float(weight) if weight else 1.0)
+    return requests, weights
+
+# one request we are waiting on a reply for
+class loadRequest:
+    def __init__(self, id, topic, group):
+        self.id = id
+        self.topic = topic
+        self.group = group
+        self.sendTime = time.perf_counter_ns()
+        self.done = False
+        self.event = threading.Event() # set once it has a reply or has timed out
+
+# the counts and latencies for one topic or route
+class groupStats:
+    def __init__(self):
+        self.sent = 0
+        self.replies = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.latencies = [] # ms
+
+# request ids are unique for the whole process, not just one run, so a late reply to an earlier
+# sweep step can't be taken for a request in the current one
+requestIds = itertools.count()
+
+# keeps track of every request in flight and the stats for one run (one sweep step)
+# replies are matched by the 'id' we put in each request when the gateway echoes it, otherwise to the
+# oldest request waiting on that topic, the gateway answers a topic's requests in order
+class loadRun:
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.pending = {}   # id -> loadRequest
+        self.waiting = {}   # topic -> deque of loadRequest, oldest first
+        self.stats = {}     # group -> groupStats
+        self.unmatched = 0  # replies we had nothing waiting for, late replies after a timeout
+        self.startTime = time.perf_counter_ns()
+
+    def getGroup(self, group):
+        stats = self.stats.get(group)
+        if stats is None:
+            stats = self.stats[group] = groupStats()
+        return stats
+
+    def getOutstanding(self):
+        return len(self.pending)
+
+    # record a request about to be published and return its id
+    def add(self, topic, group):
+        self.mutex.acquire()
+        id = next(requestIds)
+        request = loadRequest(id, topic, group)
+        self.pending[id] = request
+        self.waiting.setdefault(topic, deque()).append(request)
+        self.getGroup(group).sent += 1
+        self.mutex.release()
+        return request
+
+    # called with the mutex held
+    def finish(self, request):
+        request.done = True
+        del self.pending[request.id]
+        request.event.set()
+
+    def replyReceived(self, topic, reply, recvTime):
+        self.mutex.acquire()
+        request = None
+        if 'id' in reply:
+            request = self.pending.get(reply['id'])
+        else:
+            queue = self.waiting.get(topic)
+            while queue:
+                oldest = queue.popleft()
+                if not oldest.done:
+                    request = oldest
+                    break
+        if request is None or request.done:
+            self.unmatched += 1
+        else:
+            stats = self.getGroup(request.group)
+            if reply.get('status') in ERROR_STATUSES:
+                stats.errors += 1
+            else:
+                stats.replies += 1
+                stats.latencies.append((recvTime - request.sendTime) / 1e6)
+            self.finish(request)
+        self.mutex.release()
+
+    # count every request older than the timeout as timed out, they are queued oldest first
+    def reap(self):
+        limit = time.perf_counter_ns() - int(args.timeout * 1e9)
+        self.mutex.acquire()
+        for queue in self.waiting.values():
+            while queue and (queue[0].done or queue[0].sendTime < limit):
+                request = queue.popleft()
+                if not request.done:
+                    self.getGroup(request.group).timeouts += 1
+                    self.finish(request)
+        self.mutex.release()
+
+    # wait for the replies still in flight, requests that don't get one are reaped as timeouts
+    def drain(self):
+        while self.getOutstanding():
+            time.sleep(REAP_INTERVAL)
+        self.endTime = time.perf_counter_ns()
+
+    def getElapsed(self):
+        return (self.endTime - self.startTime) / 1e9
+
+    # totals across every group
+    def getTotals(self):
+        totals = groupStats()
+        for stats in self.stats.values():
+            totals.sent += stats.sent
+            totals.replies += stats.replies
+            totals.errors += stats.errors
+            totals.timeouts += stats.timeouts
+            totals.latencies.extend(stats.latencies)
+        return totals
+
+global run
+run = None
 
-# return true if the json formatted payload contains a valid 'command' that the
-# device supports
-def supportedAction(payload):
-    action = list(payload.keys())[0]
-    return action in SUPPORTED_ACTIONS
-
-
-global coll # our list for collecting the latency value
 # Callback when the subscribed topic receives a message
 def receive_loop(topic, payload, **kwargs):
-    payload=json.loads(payload)
-    global sent_ts
-    global WAIT
-    global coll
-    if not supportedAction(payload): # the message should be a response from the
-        # device and not our reqest
-        recv_ts = datetime.now()
-        diff = recv_ts - sent_ts
-        print(diff.microseconds / 1000) 
-        x = diff.microseconds / 1000
-        coll.append(x)
-        WAIT = False
-
-## Sensor data retrieval functions ## 
-#####################################
-
-
-# Appends a message to the outbox queue which will be sent later by the main loop
-def composeMessage(topic, msg):
-    OUTBOX.append(SensorMessage(topic, msg))
-    msgEvent.set() # wake up the send loop
-
-## system functions
-
-
-# function to set the global loop variable to false so we exit out
-def disconnectLoop():
-    logging.info('entering disconnected state')
-    global CONNECTED
-    CONNECTED=False
+    recvTime = time.perf_counter_ns()
+    payload, encoding = codec.decode(payload)
+    # the gateway might batch its replies into a list
+    replies = payload if isinstance(payload, list) else [payload]
+    current = run
+    for reply in replies:
+        if not isinstance(reply, dict) or any(action in reply for action in SUPPORTED_ACTIONS):
+            continue # a request, most likely our own coming back to us
+        if current is not None:
+            # match replies on the gateway's split reply topic against their request's topic
+            current.replyReceived(topic[:-len('/reply')] if topic.endswith('/reply') else topic, reply, recvTime)
+
+# runs for the life of the program and times out requests that went unanswered
+def reaper():
+    while True:
+        current = run
+        if current is not None:
+            current.reap()
+        time.sleep(REAP_INTERVAL)
+
+# pick a random request from the mix, send it to a random node and return its loadRequest
+def sendRequest(rng):
+    thing, action, value = rng.choices(MIX, weights=WEIGHTS)[0]
+    node = rng.choice(NODES)
+    topic = f"sensors/{thing}/{node}"
+    group = topic if args.group == 'topic' else f"{thing} {action}:{value}"
+    request = run.add(topic, group)
+    msg = {}
+    msg[action] = value
+    msg['id'] = request.id
+    mqtt_connection.publish(
+                topic=topic,
+                payload=codec.encode(msg, args.encoding),
+                qos=mqtt.QoS.AT_MOST_ONCE)
+    return request
+
+# one simulated client, it waits for each reply (or its timeout) before sending again
+def closedLoopClient(seed, stopTime):
+    rng = random.Random(seed)
+    while time.perf_counter() < stopTime:
+        request = sendRequest(rng)
+        request.event.wait()
+        if args.think:
+            time.sleep(args.think)
+
+# send at a fixed offered rate for duration seconds. Send times are scheduled ahead of time so a slow
+# publish or a coarse sleep doesn't lower the rate, we catch up instead
+def openLoop(rate, duration, rng):
+    start = time.perf_counter()
+    nextSend = start
+    while nextSend < start + duration:
+        delay = nextSend - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        sendRequest(rng)
+        if args.arrivals == 'poisson':
+            nextSend += rng.expovariate(rate)
+        else:
+            nextSend += 1.0 / rate
+
+# start a new run, drive it with the chosen mode and wait for it to finish
+def runLoad(rate, rng):
+    global run
+    run = loadRun()
+    if args.mode == 'open' or args.sweep: # a sweep varies the offered rate, so its steps are open-loop
+        openLoop(rate, args.duration, rng)
+    else:
+        stopTime = time.perf_counter() + args.duration
+        clients = [threading.Thread(name='Client {}'.format(n), target=closedLoopClient,
+                                    args=(rng.random(), stopTime)) for n in range(args.clients)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+    run.drain()
+    return run
+
+def formatRow(name, stats, elapsed):
+    summary = benchStats.summarize(stats.latencies)
+    row = "{:<28} {:>7} {:>7} {:>8.1f} {:>6} {:>8}".format(name, stats.sent, stats.replies,
+            stats.replies / elapsed, stats.errors, stats.timeouts)
+    if stats.latencies:
+        row += " {p50:>8.2f} {p90:>8.2f} {p99:>8.2f} {max:>8.2f}".format(**summary)
+    return row
+
+def printGroups(loadRun):
+    elapsed = loadRun.getElapsed()
+    print("{:<28} {:>7} {:>7} {:>8} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8}".format(args.group, 'sent', 'replies',
+            'replies/s', 'errors', 'timeouts', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for group in sorted(loadRun.stats):
+        print(formatRow(group, loadRun.stats[group], elapsed))
+    if loadRun.unmatched:
+        print("{} replies arrived after their request timed out".format(loadRun.unmatched))
+
+# run each sweep rate in turn and report where the gateway falls behind what we offer
+def sweep(rng):
+    start, stop, step = [float(x) for x in args.sweep.split(':')]
+    print("{:>9} {:>9} {:>7} {:>8} {:>8} {:>8}".format('offered/s', 'replies/s', 'errors',
+            'timeouts', 'p50 ms', 'p99 ms'))
+    saturation = None
+    keptUp = None
+    rate = start
+    while rate <= stop:
+        totals = runLoad(rate, rng).getTotals()
+        achieved = totals.replies / args.duration
+        summary = benchStats.summarize(totals.latencies)
+        print("{:>9.1f} {:>9.1f} {:>7} {:>8} {:>8.2f} {:>8.2f}".format(rate, achieved, totals.errors,
+                totals.timeouts, summary.get('p50', 0.0), summary.get('p99', 0.0)))
+        failed = totals.errors + totals.timeouts
+        if achieved < SATURATION_RATIO * rate or failed > ERROR_BUDGET * max(totals.sent, 1):
+            saturation = rate
+            break
+        keptUp = rate
+        rate += step
+    if saturation is None:
+        print("gateway kept up with every rate up to {:.1f} requests/s".format(keptUp or 0.0))
+    elif keptUp is None:
+        print("gateway saturated at the first rate, {:.1f} requests/s offered".format(saturation))
+    else:
+        print("gateway saturated between {:.1f} and {:.1f} requests/s offered".format(keptUp, saturation))
 
 ## Main ##
 ##########
 if __name__ == '__main__':
-    global WAIT
-    global sent_ts
-    global coll
-    coll = []
+    MIX, WEIGHTS = parseMix(args.mix)
+    if args.node_count:
+        NODES = ["{}{}".format(args.node_prefix, n) for n in range(args.node_count)]
+    else:
+        NODES = args.nodes.split(',')
+    rng = random.Random(args.seed)
+
     # Spin up resources
     event_loop_group = io.EventLoopGroup(1)
     host_resolver = io.DefaultHostResolver(event_loop_group)
     client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
 
-    if args.use_websocket == True:
+    if args.local_broker:
+        mqtt_connection = localBroker.buildConnection(args.local_broker, args.client_id,
+                on_connection_interrupted=on_connection_interrupted,
+                on_connection_resumed=on_connection_resumed)
+
+    elif args.use_websocket == True:
         proxy_options = None
         if (args.proxy_host):
             proxy_options = http.HttpProxyOptions(host_name=args.proxy_host, port=args.proxy_port)
@@ -183,70 +439,45 @@ if __name__ == '__main__':
                 clean_session=False,
                 keep_alive_secs=6)
 
-        logging.info("Connecting to {} with client ID '{}'...".format(
-            args.endpoint, args.client_id))
+    logging.info("Connecting to {} with client ID '{}'...".format(
+        args.local_broker or args.endpoint, args.client_id))
 
-        connect_future = mqtt_connection.connect()
+    connect_future = mqtt_connection.connect()
 
     # Future.result() waits until a result is available
     connect_future.result()
     logging.info("Connected!")
 
-    # Subscribe
-    logging.info("Subscribing to topic '{}'...".format("sensors/+/node2"))
-    subscribe_future, packet_id = mqtt_connection.subscribe(
-            topic="sensors/+/node2",
-            #qos=mqtt.QoS.AT_LEAST_ONCE,
-            qos=mqtt.QoS.AT_MOST_ONCE,
-            callback=receive_loop)
-
-    subscribe_result = subscribe_future.result()
-    logging.info("Subscribed with {}".format(str(subscribe_result['qos'])))
-    CONNECTED = True
-    # compose an initial online status message
-    pub_count = 0
-    # publish a message saying we are online
-    qos=mqtt.QoS.AT_MOST_ONCE
-    
-    msg = {}
-    msg['get'] = 'value'
-    pp = json.dumps(msg)
-    i = 0
-    # the supported topics for each device we are testing
-    devices=['temp','pressure','humidity', 'altitude', 'soil', 'water', 'led']
-    
-
-    while pub_count < 100:
-        if i > len(devices):
-            i = 0
-        
-        target_sensor = devices[i] # iterate through the device system
-        target_client = 'node2'
-        target_topic = f"sensors/{target_sensor}/{target_client}"
-        WAIT = True
-        mqtt_connection.publish(
-                    topic=target_topic,
-                    payload=pp,
-                    qos=mqtt.QoS.AT_MOST_ONCE)
-
-        sent_ts = datetime.now()
-        logging.debug("Sent message to topic'{}':{}".format(target_topic, pp))
-        pub_count += 1
-        i += 1
-        while WAIT: # wait until we recived a response before we loop again
-            time.sleep(.5)
-
-	time.sleep(5) # wait 5 seconds before we send another request
-
-    
-    time.sleep(1)
-    avg = sum(coll)/len(coll)
-    print("averge latency in ms:", avg)
-    
+    # Subscribe to every node's topics, replies come back on the topic of their request or with the
+    # gateway's --reply-topic split on its reply topic
+    logging.info("Subscribing to {} nodes...".format(len(NODES)))
+    for node in NODES:
+        for topic in [f"sensors/+/{node}", f"sensors/+/{node}/reply"]:
+            subscribe_future, packet_id = mqtt_connection.subscribe(
+                    topic=topic,
+                    #qos=mqtt.QoS.AT_LEAST_ONCE,
+                    qos=mqtt.QoS.AT_MOST_ONCE,
+                    callback=receive_loop)
+            subscribe_future.result()
+    logging.info("Subscribed!")
+
+    threading.Thread(name='Reaper', target=reaper, daemon=True).start()
+
+    if args.sweep:
+        sweep(rng)
+    else:
+        result = runLoad(args.rate, rng)
+        if args.mode == 'open':
+            mode = "open-loop, {:.1f} requests/s {}".format(args.rate, args.arrivals)
+        else:
+            mode = "closed-loop, {} clients".format(args.clients)
+        printGroups(result)
+        totals = result.getTotals()
+        benchStats.printReport("{} {} requests to {} nodes ({})".format(totals.sent, args.encoding, len(NODES), mode),
+                               totals.latencies, totals.timeouts, result.getElapsed(), totals.errors)
+
     ## out of loop, disconnect must have been called
     logging.info("Disconnecting...")
     disconnect_future = mqtt_connection.disconnect()
     disconnect_future.result()
     logging.info("Disconnected!")
-    logging.info("Sent '{}' messages".format(pub_count))
-
@@ -3,7 +3,9 @@
 
 # major modifications made by Peter Van Eenoo
 # for CSS 532 at UW Bothell
-# testing file use to measure the averge latency from time sent to time received
+# testing file use to measure the request latency from time sent to time received
+# every request carries an id that the gateway echoes back, so replies are matched to their request
+# even with several requests in flight (--inflight), and we report percentiles and a histogram
 
 # Author: Peter Van Eenoo
 # CSS 532 IoT - class project
@@ -14,14 +16,13 @@ import argparse
 from awscrt import io, mqtt, auth, http
 from awsiot import mqtt_connection_builder
 import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
 import threading
 import logging
 import time
-from datetime import datetime
-from collections import deque
-from uptime import uptime
-from datetime import timedelta
-import json
+import codec
+import localBroker
+import benchStats
 
 logging.basicConfig(level=logging.DEBUG)
 #logging.basicConfig(level=logging.INFO)
@@ -29,8 +30,10 @@ logging.basicConfig(level=logging.DEBUG)
 
 # grab and parse the arguments
 parser = argparse.ArgumentParser(description="Send and receive messages through and MQTT connection.")
-parser.add_argument('--endpoint', required=True, help="Your AWS IoT custom endpoint, not including a port. " +
+parser.add_argument('--endpoint', help="Your AWS IoT custom endpoint, not including a port. " +
         "Ex: \"abcd123456wxyz-ats.iot.us-east-1.amazonaws.com\"")
+parser.add_argument('--local-broker', help="Use the local MQTT stand-in instead of AWS IoT, either \"inproc\" " +
+        "or the host:port of a broker started with localBroker.py.")
 parser.add_argument('--cert', help="File path to your client certificate, in PEM format.")
 parser.add_argument('--key', help="File path to your private key, in PEM format.")
 parser.add_argument('--root-ca', help="File path to root certificate authority, in PEM format. " +
@@ -48,6 +51,14 @@ parser.add_argument('--signing-region', default='us-east-1', help="If you specif
 parser.add_argument('--proxy-host', help="Hostname for proxy to connect to. Note: if you use this feature, " +
         "you will likely need to set --root-ca to the ca for your proxy.")
 parser.add_argument('--proxy-port', type=int, default=8080, help="Port for proxy to connect to.")
+parser.add_argument('--encoding', choices=codec.ENCODINGS, default='json', help="Payload encoding to send " +
+        "requests in, the gateway replies in the same encoding.")
+parser.add_argument('--target', default='node2', help="Client ID of the gateway to measure.")
+parser.add_argument('--count', type=int, default=100, help="Number of requests to send.")
+parser.add_argument('--inflight', type=int, default=1, help="Requests kept in flight at once, 1 is ping-pong " +
+        "and anything higher pipelines the requests.")
+parser.add_argument('--timeout', type=float, default=5.0, help="Seconds to wait for a reply before counting " +
+        "the request as timed out.")
 parser.add_argument('--verbosity', choices=[x.name for x in io.LogLevel], default=io.LogLevel.NoLogs.name,
         help='Logging level')
 
@@ -81,79 +92,86 @@ def on_resubscribe_complete(resubscribe_future):
 
 ###### Gloabls area for main program and setup #########
 args = parser.parse_args()
+if not args.endpoint and not args.local_broker:
+    parser.error("one of --endpoint or --local-broker is required")
 
 io.init_logging(getattr(io.LogLevel, args.verbosity), 'stderr')
 
-global received_count
-global WAIT
-received_count = 0
-
-global CONNECTED 
-#SUB_TOPIC = f"sensors/+/node2"
-## main program message event to wake-up and check for messages
-msgEvent = threading.Event()
-target_client = 'node2'
+target_client = args.target
 target_sensor = 'cmd'
 target_topic = f"sensors/{target_sensor}/{target_client}"
-global coll
+
+# requests waiting for a reply, id -> [send time in ns, reply time in ns, threading.Event, rejected]
+# guarded by mutex, the reply callback runs on the connection's event-loop thread
+pending = {}
+mutex = threading.Lock()
+# each request in flight holds one slot, ping-pong mode is just one slot
+slots = threading.Semaphore(args.inflight)
+latencies = [] # ms
+
+# record the reply time of the request with this id and wake up whoever is waiting on it
+def replyReceived(reply, recv_ns):
+    if not isinstance(reply, dict) or 'id' not in reply:
+        return # our own request or some other reply
+    if 'get' in reply:
+        return # our own request coming back on the same topic
+    busy = reply.get('status') == 'busy'
+    mutex.acquire()
+    request = pending.get(reply['id'])
+    if request is not None and request[1] is None:
+        request[1] = recv_ns
+        request[3] = busy
+        request[2].set()
+    mutex.release()
+
 # Callback when the subscribed topic receives a message
 def receive_loop(topic, payload, **kwargs):
-    payload=json.loads(payload)
-    global sent_ts
-    global WAIT
-    global coll
-    if 'ts' in payload:
-        recv_ts = datetime.now()
-        diff = recv_ts - sent_ts
-        print(diff.microseconds / 1000) 
-        x = diff.microseconds / 1000
-        coll.append(x)
-        WAIT = False
-
-## Sensor data retrieval functions ## 
-#####################################
-
-## this function gathers all availble sensor data and device status information and sends in one
-## pre-formatted message
-def getBulk(topic):
-    msg = {}
-    msg.update(getTemp())
-    msg.update(getHumidity())
-    msg.update(getAltitude())
-    msg.update(getPressure())
-    msg.update(getLEDStatus())
-    msg.update(getSoilHumidity())
-    if msg:
-        composeMessage(topic, msg)
-
-
-# Appends a message to the outbox queue which will be sent later by the main loop
-def composeMessage(topic, msg):
-    OUTBOX.append(SensorMessage(topic, msg))
-    msgEvent.set() # wake up the send loop
-
-## system functions
-
-
-# function to set the global loop variable to false so we exit out
-def disconnectLoop():
-    logging.info('entering disconnected state')
-    global CONNECTED
-    CONNECTED=False
+    recv_ns = time.perf_counter_ns()
+    payload, encoding = codec.decode(payload)
+    # the gateway might batch its replies into a list
+    replies = payload if isinstance(payload, list) else [payload]
+    for reply in replies:
+        replyReceived(reply, recv_ns)
+
+# waits for each request in order and frees its slot once it has a reply or times out
+def collector(count):
+    timeouts = 0
+    rejected = 0
+    for i in range(count):
+        while True:
+            mutex.acquire()
+            request = pending.get(i)
+            mutex.release()
+            if request is not None:
+                break
+            time.sleep(0.001) # the sender hasn't got to it yet
+        if request[2].wait(max(0.0, args.timeout - (time.perf_counter_ns() - request[0]) / 1e9)):
+            if request[3]:
+                rejected += 1 # the gateway's lane was full
+            else:
+                latencies.append((request[1] - request[0]) / 1e6)
+        else:
+            timeouts += 1
+        mutex.acquire()
+        del pending[i]
+        mutex.release()
+        slots.release()
+    return timeouts, rejected
 
 ## Main ##
 ##########
 if __name__ == '__main__':
-    global WAIT
-    global sent_ts
-    global coll
-    coll = []
     # Spin up resources
     event_loop_group = io.EventLoopGroup(1)
     host_resolver = io.DefaultHostResolver(event_loop_group)
     client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
 
-    if args.use_websocket == True:
+    if args.local_broker:
+        mqtt_connection = localBroker.buildConnection(args.local_broker, args.client_id,
+                on_connection_interrupted=on_connection_interrupted,
+                on_connection_resumed=on_connection_resumed)
+
+    elif args.use_websocket == True:
         proxy_options = None
         if (args.proxy_host):
             proxy_options = http.HttpProxyOptions(host_name=args.proxy_host, port=args.proxy_port)
@@ -185,58 +203,54 @@ if __name__ == '__main__':
                 clean_session=False,
                 keep_alive_secs=6)
 
-        logging.info("Connecting to {} with client ID '{}'...".format(
-            args.endpoint, args.client_id))
+    logging.info("Connecting to {} with client ID '{}'...".format(
+        args.local_broker or args.endpoint, args.client_id))
 
-        connect_future = mqtt_connection.connect()
+    connect_future = mqtt_connection.connect()
 
     # Future.result() waits until a result is available
     connect_future.result()
     logging.info("Connected!")
 
-    # Subscribe
-    logging.info("Subscribing to topic '{}'...".format(target_topic))
-    subscribe_future, packet_id = mqtt_connection.subscribe(
-            topic=target_topic,
-            #qos=mqtt.QoS.AT_LEAST_ONCE,
-            qos=mqtt.QoS.AT_MOST_ONCE,
-            callback=receive_loop)
-
-    subscribe_result = subscribe_future.result()
-    logging.info("Subscribed with {}".format(str(subscribe_result['qos'])))
-    CONNECTED = True
-    # compose an initial online status message
-    pub_count = 0
-    # publish a message saying we are online
-    msg = {}
-    msg['get'] = 'timestamp'
-    qos=mqtt.QoS.AT_MOST_ONCE
-    pp = json.dumps(msg)
-    while pub_count < 100:
-        WAIT = True
+    # Subscribe, the gateway replies on the request's topic or with --reply-topic split on its reply topic
+    for topic in [target_topic, target_topic + '/reply']:
+        logging.info("Subscribing to topic '{}'...".format(topic))
+        subscribe_future, packet_id = mqtt_connection.subscribe(
+                topic=topic,
+                #qos=mqtt.QoS.AT_LEAST_ONCE,
+                qos=mqtt.QoS.AT_MOST_ONCE,
+                callback=receive_loop)
+
+        subscribe_result = subscribe_future.result()
+        logging.info("Subscribed with {}".format(str(subscribe_result['qos'])))
+
+    results = []
+    collect = threading.Thread(name='Collector', target=lambda: results.append(collector(args.count)))
+    collect.start()
+
+    start_ns = time.perf_counter_ns()
+    for i in range(args.count):
+        slots.acquire() # blocks while --inflight requests are waiting for replies
+        msg = {}
+        msg['get'] = 'timestamp'
+        msg['id'] = i
+        pp = codec.encode(msg, args.encoding)
+        mutex.acquire()
+        pending[i] = [time.perf_counter_ns(), None, threading.Event(), False]
+        mutex.release()
         mqtt_connection.publish(
                     topic=target_topic,
                     payload=pp,
                     qos=mqtt.QoS.AT_MOST_ONCE)
 
-        sent_ts = datetime.now()
-        #logging.debug("Sent message at {} to topic'{}':{}".format(ts,target_topic, pp))
-        pub_count += 1
-        while WAIT: # wait until we recived a response before we loop again
-            time.sleep(.5)
-
-
-    
-    time.sleep(1)
-    #recvQueue.update(payload)
-    #dict(sorted(recvQueue.items(), key=lambda item: item[1]))
-    avg = sum(coll)/len(coll)
-    print("averge latency in ms:", avg)
-    
-    ## out of loop, disconnect must have been called
+    collect.join()
+    elapsed = (time.perf_counter_ns() - start_ns) / 1e9
+    mode = "ping-pong" if args.inflight == 1 else "pipelined, {} in flight".format(args.inflight)
+    benchStats.printReport("{} {} requests to {} ({})".format(args.count, args.encoding, target_topic, mode),
+                           latencies, results[0][0], elapsed, results[0][1])
+
     logging.info("Disconnecting...")
     disconnect_future = mqtt_connection.disconnect()
     disconnect_future.result()
     logging.info("Disconnected!")
-    logging.info("Sent '{}' messages".format(pub_count))
-
+    logging.info("Sent '{}' messages".format(args.count))
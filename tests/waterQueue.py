@@ -0,0 +1,76 @@
+# Author: Peter Van Eenoo
+# CSS 532 IoT - class project
+# March 2021
+
+# checks the places the water scheduler reports for queued runs, on the stub backend so it runs anywhere
+# run it with pytest or on its own: python3 waterQueue.py
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import backend
+import waterController as water
+
+ZONES = [('a', 20), ('b', 19)]
+
+# the scheduler thread isn't started, so every valve that opens stays open until terminate()
+def makeManager(maxConcurrent):
+    backend.selectBackend('stub')
+    return water.waterManager(water.DEFAULT_WATERING_TIME_SEC, ZONES, maxConcurrent)
+
+# a run queued while a valve slot is free starts right away, it isn't reported as queued behind
+# a run that is waiting for another zone
+def test_free_slot_starts_right_away():
+    waterObj = makeManager(2)
+    try:
+        assert waterObj.queueRun('a', 5) == 0
+        assert waterObj.queueRun('a', 5) == 1
+        assert waterObj.queueRun('b', 5) == 0
+        assert waterObj.isBusy('b')
+    finally:
+        waterObj.terminate()
+
+# runs that have to wait get their own place in the queue, counting from 1
+def test_waiting_runs_get_their_place():
+    waterObj = makeManager(2)
+    try:
+        assert waterObj.queueRun('a', 5) == 0
+        assert waterObj.queueRun('a', 5) == 1 # zone a is busy, zone b is still free
+        assert waterObj.queueRun('b', 5) == 0
+        assert waterObj.queueRun('b', 5) == 2
+    finally:
+        waterObj.terminate()
+
+def test_one_valve_at_a_time():
+    waterObj = makeManager(1)
+    try:
+        assert waterObj.queueRun('a', 5) == 0
+        assert waterObj.queueRun('b', 5) == 1
+        assert waterObj.queueRun('a', 5) == 2
+    finally:
+        waterObj.terminate()
+
+# an interrupt leaves the default zone's valve shut, its queued runs don't reopen it
+def test_interrupt_leaves_the_water_off():
+    waterObj = makeManager(1)
+    try:
+        assert waterObj.queueRun('a', 5) == 0
+        assert waterObj.queueRun('a', 5) == 1
+        assert waterObj.queueRun('b', 5) == 2
+        waterObj.interruptHose()
+        assert not waterObj.getState()
+        assert backend.getBackend().gpio.input(20) == backend.stubGPIO.LOW
+        assert waterObj.queueRun('b', 5) == 1 # zone b's first run starts now, zone a's second is gone
+        assert not waterObj.getState()
+    finally:
+        waterObj.terminate()
+
+def test_refused_after_terminate():
+    waterObj = makeManager(1)
+    waterObj.terminate()
+    assert waterObj.queueRun('a', 5) is None
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print("{} passed".format(name))
@@ -1,6 +1,7 @@
-from time import sleep     # Import the sleep function from the time module
 import threading
-import RPi.GPIO as GPIO    # Import Raspberry Pi GPIO library
+import time
+from collections import deque
+import backend
 
 # Author: Peter Van Eenoo
 # CSS 532 IoT - class project
@@ -8,29 +9,138 @@ import RPi.GPIO as GPIO    # Import Raspberry Pi GPIO library
 
 WATER_PIN = 20  # the choses GPIO pin for controlling the water valve
 
-GPIO.setwarnings(False)    # Ignore warning for now
-GPIO.setup(WATER_PIN, GPIO.OUT, initial=GPIO.LOW)   # Set GPIO PIN 20 to be the output pin and set it LOW by default
-
 DEFAULT_WATERING_TIME_SEC = 8
-TIMEOUT = 3
 MAX_WATERING_TIME_SEC = 121 # this seems long enough for a single watering
+DEFAULT_ZONES = [('main', WATER_PIN)] # (name, GPIO pin) of each valve, the first is the default zone
+MAX_CONCURRENT = 1 # valves open at once, more than one can drop the pressure or overload the supply
+MAX_QUEUED = 32 # runs waiting for a valve before new ones are refused
 
-class waterManager:
-    def __init__(self, e, wateringTime):
-        self.running = True
+# this class opens and closes one valve. It has a monotonic-clock deadline to be closed at by the
+# water scheduler, close() shuts it right away from any thread, and it keeps the time it has actually
+# been open in milliseconds
+class valveController:
+    def __init__(self, pin, gpio):
+        self.pin = pin
+        self.gpio = gpio
+        self.gpio.setwarnings(False)    # Ignore warning for now
+        self.gpio.setup(pin, self.gpio.OUT, initial=self.gpio.LOW)   # Set the pin to be an output and set it LOW by default
+
+        # everything below is guarded by mutex
+        self.mutex = threading.Lock()
+        self.isOpen = False
+        self.disabled = False # set on shutdown, the valve won't open again
+        self.openedAt = None
+        self.deadline = None
+        self.totalMs = 0      # ms open since the last clear
+        self.cumulativeMs = 0 # ms open since the device came on
+        self.lastRunMs = 0    # how long the last run was actually open
+
+    # open the valve for seconds, returns False if it's already open or disabled
+    def open(self, seconds):
+        self.mutex.acquire()
+        try:
+            if self.isOpen or self.disabled:
+                return False
+            self.gpio.output(self.pin, self.gpio.HIGH)
+            self.isOpen = True
+            self.openedAt = time.monotonic()
+            self.deadline = self.openedAt + seconds
+            return True
+        finally:
+            self.mutex.release()
 
-        # mutexA is the outer watering loop mutex
-        self.mutexA = threading.Lock()
+    # close the valve now, returns how many ms this run was open or None if it wasn't open
+    def close(self):
+        self.mutex.acquire()
+        try:
+            return self.closeLocked()
+        finally:
+            self.mutex.release()
+
+    def closeLocked(self):
+        if not self.isOpen:
+            return None
+        self.gpio.output(self.pin, self.gpio.LOW) # turn off the hose
+        self.isOpen = False
+        elapsedMs = int(round((time.monotonic() - self.openedAt) * 1000))
+        self.totalMs += elapsedMs
+        self.cumulativeMs += elapsedMs
+        self.lastRunMs = elapsedMs
+        return elapsedMs
+
+    # close the valve and keep it closed, used when shutting down
+    def disable(self):
+        self.mutex.acquire()
+        self.disabled = True
+        self.closeLocked()
+        self.mutex.release()
+
+    def getState(self):
+        return self.isOpen
 
-        #mutexB is the inner loop mutex used to interrupt and stop the watering process if requested
-        self.mutexB = threading.Lock()
+    # seconds left before the valve closes on its own, 0 if it's closed
+    def getRemaining(self):
+        self.mutex.acquire()
+        remaining = max(0.0, self.deadline - time.monotonic()) if self.isOpen else 0.0
+        self.mutex.release()
+        return remaining
 
-        self.event = e
-        self.isWatering = False
+    # the totals include the run in progress
+    def getTotalMs(self):
+        self.mutex.acquire()
+        total = self.totalMs + self.runningMs()
+        self.mutex.release()
+        return total
+
+    def getCumulativeMs(self):
+        self.mutex.acquire()
+        total = self.cumulativeMs + self.runningMs()
+        self.mutex.release()
+        return total
+
+    def runningMs(self):
+        return int(round((time.monotonic() - self.openedAt) * 1000)) if self.isOpen else 0
+
+    def clearTotal(self):
+        self.mutex.acquire()
+        self.totalMs = -self.runningMs() # a run in progress only counts from now on
+        self.mutex.release()
+
+# one valve and its run statistics
+class waterZone:
+    def __init__(self, name, pin, gpio):
+        self.name = name
+        self.valve = valveController(pin, gpio)
+        self.runs = 0 # runs finished on this zone
+
+# a run waiting for, or using, its zone's valve
+class wateringRun:
+    def __init__(self, zone, seconds):
+        self.zone = zone
+        self.seconds = seconds # None is the watering time when the run starts
+        self.queuedAt = time.monotonic()
+
+# this class schedules watering runs on one or more zones, each with its own valve. Runs are queued
+# and started in order as soon as their zone is free and fewer than maxConcurrent valves are open,
+# so one zone at a time waters the zones one after the other. A run for a zone that's already
+# watering waits its turn rather than being folded into the current run
+class waterManager:
+    def __init__(self, wateringTime, zones=DEFAULT_ZONES, maxConcurrent=MAX_CONCURRENT, shadow=None):
+        self.running = True
+        self.shadow = shadow # the device shadow we report our state to and take desired changes from
+        gpio = backend.getBackend().gpio
+        self.zones = {}
+        self.zoneNames = [] # in the order they were given, the first is the default zone
+        for name, pin in zones:
+            self.zones[name] = waterZone(name, pin, gpio)
+            self.zoneNames.append(name)
+        self.defaultZone = self.zoneNames[0]
+        self.maxConcurrent = max(1, maxConcurrent)
 
-        # this is used to interrupt to hose by a user
-        # guarged by mutexB
-        self.emergencyStop = False
+        # the queue and active runs are guarded by cond, start() waits on it for the next deadline
+        self.cond = threading.Condition()
+        self.queue = deque()
+        self.active = {} # zone name -> the run using its valve
 
         ## set the default and then check to see if reasonable values for watering time were passed in
         self.wateringTime = DEFAULT_WATERING_TIME_SEC
@@ -39,88 +149,226 @@ class waterManager:
             self.wateringTime = wateringTime
         else:
             print('Error: value for watering time was too high or too low, using default time in seconds')
+        self.cond.acquire()
+        self.reportState()
+        self.cond.release()
 
-        ## number of seconds this unit has watered since being cleared
-        self.wateringTotal = 0
-        ## track how many seconds this system has had the water valve open since being on
-        self.wateringCumulative = 0
-
-    # since the start thread blocks, we have to trigger an event after setting runnning to false
+    # since the start thread blocks, we have to wake it after setting runnning to false
     def terminate(self):
+        self.cond.acquire()
         self.running = False
-        self.event.set()
+        self.queue.clear()
+        for zone in self.zones.values():
+            zone.valve.disable()
+        self.reportState()
+        self.cond.notify_all()
+        self.cond.release()
+
+    def getZoneNames(self):
+        return list(self.zoneNames)
+
+    # queue a run on a zone for seconds, or the watering time when it starts if seconds is None
+    # returns the run's place in the queue, 0 if its valve opened right away, or None if it was refused
+    def queueRun(self, zone=None, seconds=None):
+        zone = zone or self.defaultZone
+        if zone not in self.zones:
+            raise ValueError("unknown zone {}".format(zone))
+        if seconds is not None and not (seconds > 0 and seconds < MAX_WATERING_TIME_SEC):
+            raise ValueError("watering time must be above 0 and below {} seconds".format(MAX_WATERING_TIME_SEC))
+        self.cond.acquire()
+        try:
+            if not self.running or len(self.queue) >= MAX_QUEUED:
+                return None
+            run = wateringRun(zone, seconds)
+            self.queue.append(run)
+            self.startRuns()
+            self.cond.notify_all()
+            if self.active.get(zone) is run:
+                return 0
+            return self.queue.index(run) + 1
+        finally:
+            self.cond.release()
+
+    # close a zone's valve now and drop its queued runs, every zone if zone is None
+    # returns how many ms the stopped runs had been open
+    def stop(self, zone=None):
+        self.cond.acquire()
+        try:
+            names = self.zoneNames if zone is None else [zone]
+            stoppedMs = 0
+            for name in names:
+                stoppedMs += self.zones[name].valve.close() or 0
+            self.queue = deque(run for run in self.queue if run.zone not in names)
+            self.finishRuns()
+            self.startRuns()
+            self.cond.notify_all()
+            return stoppedMs
+        finally:
+            self.cond.release()
+
+    # change how many valves may be open at once, it applies as runs finish
+    def setMaxConcurrent(self, value):
+        self.cond.acquire()
+        if value >= 1:
+            self.maxConcurrent = int(value)
+            self.startRuns()
+            self.cond.notify_all()
+        self.cond.release()
+        return self.maxConcurrent
+
+    def getMaxConcurrent(self):
+        return self.maxConcurrent
+
+    # forget the runs whose valves have closed, called with cond held
+    def finishRuns(self):
+        for name in list(self.active):
+            if not self.zones[name].valve.getState():
+                del self.active[name]
+                self.zones[name].runs += 1
+
+    # open valves for queued runs in order while we are under the limit, called with cond held
+    # with every valve closed it's a safe point to apply the desired changes queued in the shadow
+    def startRuns(self):
+        if not self.active and self.shadow:
+            desired = self.shadow.takeDesired('water')
+            if 'watering time' in desired:
+                self.changeWateringTimeLocked(desired['watering time'])
+        for run in list(self.queue):
+            if len(self.active) >= self.maxConcurrent:
+                break
+            if run.zone in self.active:
+                continue # its zone is busy, later runs for other zones can go first
+            self.queue.remove(run)
+            if run.seconds is None:
+                run.seconds = self.wateringTime
+            if self.zones[run.zone].valve.open(run.seconds):
+                self.active[run.zone] = run
+        self.reportState()
 
-    # returns true if the system is currently dispensing water
+    # report our state to the shadow when it changes, called with cond held
+    def reportState(self):
+        if not self.shadow:
+            return
+        zones = {}
+        for name in self.zoneNames:
+            zones[name] = 'on' if self.zones[name].valve.getState() else 'off'
+        self.shadow.report('water', {'state': 'water on' if zones[self.defaultZone] == 'on' else 'water off',
+                                     'zones': zones,
+                                     'watering time': self.wateringTime,
+                                     'queued': len(self.queue)})
+
+    # per-zone state, remaining seconds and totals in seconds to the millisecond
+    def getZoneStats(self):
+        stats = {}
+        for name in self.zoneNames:
+            zone = self.zones[name]
+            stats[name] = {'state': 'on' if zone.valve.getState() else 'off',
+                           'remaining': round(zone.valve.getRemaining(), 3),
+                           'runs': zone.runs,
+                           'total': zone.valve.getTotalMs() / 1000.0,
+                           'cumulative': zone.valve.getCumulativeMs() / 1000.0}
+        return stats
+
+    # true if the zone, or the default zone, is watering or has a run waiting for its valve
+    def isBusy(self, zone=None):
+        zone = zone or self.defaultZone
+        self.cond.acquire()
+        busy = self.zones[zone].valve.getState() or any(run.zone == zone for run in self.queue)
+        self.cond.release()
+        return busy
+
+    # the queued runs in order as (zone, seconds)
+    def getQueue(self):
+        self.cond.acquire()
+        queued = [(run.zone, run.seconds or self.wateringTime) for run in self.queue]
+        self.cond.release()
+        return queued
+
+    ## the single-valve interface, these act on the default zone ##
+
+    # returns true if the default zone is currently dispensing water
     def getState(self):
-        return self.isWatering
+        return self.zones[self.defaultZone].valve.getState()
 
+    # seconds this unit has watered since being cleared, to the millisecond
     def getCurrentTotal(self):
-        return self.wateringTotal
+        return self.zones[self.defaultZone].valve.getTotalMs() / 1000.0
 
+    # seconds this system has had the water valve open since being on, to the millisecond
     def getTotalRuntime(self):
-        return self.wateringCumulative
+        return self.zones[self.defaultZone].valve.getCumulativeMs() / 1000.0
 
     def getWateringTime(self):
         return self.wateringTime
 
     # reset the watering total, useful if upstream is tracking this total
-    def clearRuntime(self):
-        self.wateringTotal = 0
+    def clearRuntime(self, zone=None):
+        self.zones[zone or self.defaultZone].valve.clearTotal()
 
-    # the user can request the system to change the amount of time this device waters for
+    # the user can request the system to change the amount of time this device waters for, fractions
+    # of a second are fine. It takes effect from the next watering
     def changeWateringTime(self, value):
+        self.cond.acquire()
+        value = self.changeWateringTimeLocked(value)
+        self.cond.release()
+        return value
+
+    def changeWateringTimeLocked(self, value):
         if value > 0 and value < MAX_WATERING_TIME_SEC:
-            # the user has requested a reasonable time change
-            # but don't change the watering time if watering is in progress
-            self.mutexA.acquire()
             self.wateringTime = value
-            self.mutexA.release()
+            self.reportState()
 
-        # else: nothing changes and we return the current value anyways 
+        # else: nothing changes and we return the current value anyways
         return self.wateringTime
 
-    # stop the hose if it's currently watering
+    # change the watering time now if no valve is open, otherwise queue it in the shadow for when they
+    # have all closed. Returns True if it was changed now
+    def requestWateringTime(self, value):
+        if not (value > 0 and value < MAX_WATERING_TIME_SEC):
+            raise ValueError("watering time must be above 0 and below {} seconds".format(MAX_WATERING_TIME_SEC))
+        self.cond.acquire()
+        try:
+            if self.active and self.shadow:
+                self.shadow.desire('water', {'watering time': value})
+                return False
+            self.changeWateringTimeLocked(value)
+            return True
+        finally:
+            self.cond.release()
+
+    # stop the default zone's hose if it's currently watering, the valve is closed before this returns
+    # it's an emergency stop, so the zone's queued runs are dropped and nothing is started from here,
+    # the scheduler thread only starts runs for the other zones
     def interruptHose(self):
-        self.mutexB.acquire()
-        self.emergencyStop = True
-        self.mutexB.release()
+        self.cond.acquire()
+        try:
+            ms = self.zones[self.defaultZone].valve.close()
+            self.queue = deque(run for run in self.queue if run.zone != self.defaultZone)
+            self.finishRuns()
+            self.reportState()
+            self.cond.notify_all()
+            return ms
+        finally:
+            self.cond.release()
 
 
-# For safty reasons, this function will only water for the pre-determined set to time and then it will unset the event
-# This is helpful if changes to the calling code forget to clear the state and we could continuously water which might
-# cause physical damage to property by flooding
+# For safty reasons, every run waters only for its set time and then its valve is closed. This is
+# helpful if changes to the calling code forget to stop a zone and we could continuously water which
+# might cause physical damage to property by flooding
     def start(self):
         print("Watering system starting")
+        self.cond.acquire()
         while self.running:
-            self.event.wait() # block until we are ready
-            # check both or else we can't exit properly since we need to trigger an event to terminate
-            if self.event.isSet() and self.running:
-                self.mutexA.acquire()
-                self.isWatering = True
-
-                ## turn hose on
-                GPIO.output(WATER_PIN, GPIO.HIGH)
-                counter = 0
-                while counter < self.wateringTime:
-                    self.mutexB.acquire()
-                    if not self.emergencyStop:
-                        self.mutexB.release()
-                        counter += 1    
-                        sleep(1)
-                    else: # emergency stop
-                        self.emergencyStop = False
-                        self.mutexB.release()
-                        break
-                    ## release and loop again
-
-                GPIO.output(WATER_PIN, GPIO.LOW) # turn off the hose
-
-                self.isWatering = False
-                ## increment statistics
-                self.wateringTotal += counter
-                self.wateringCumulative += counter
-                self.event.clear() # only water once
-                self.mutexA.release()
+            now = time.monotonic()
+            for name in self.active:
+                valve = self.zones[name].valve
+                if valve.deadline <= now:
+                    valve.close()
+            self.finishRuns()
+            self.startRuns()
+            # sleep until the next valve is due to close, or something queues or stops a run
+            deadlines = [self.zones[name].valve.deadline for name in self.active]
+            self.cond.wait(max(0.0, min(deadlines) - time.monotonic()) if deadlines else None)
+        self.cond.release()
 
         print("Watering system terminating")
-
@@ -2,11 +2,134 @@
 # All of the functions are simple enough to not wrap in a class
 
 
-import board
-import busio
-import adafruit_bme280
-i2c = busio.I2C(board.SCL, board.SDA)
-bme280 = adafruit_bme280.Adafruit_BME280_I2C(i2c)
-
-# this value changes overtime by the hour
-bme280.sea_level_pressure = 1016.7
+import threading
+import time
+import math
+import backend
+
+# the sensor from the hardware backend, created by init()
+bme280 = None
+registerRead = False # true if readSnapshot() can read the data registers itself, set by init()
+
+# this value changes overtime by the hour, the calibration store refreshes it with setSeaLevelPressure()
+SEA_LEVEL_PRESSURE = 1016.7
+
+SNAPSHOT_TTL = 1.0 # seconds a snapshot is reused before the sensor is read again
+DATA_REGISTER = 0xF7 # pressure, temperature and humidity data registers are contiguous from here, 8 bytes
+MODE_FORCE = 0x01
+MODE_NORMAL = 0x03
+# the one-transaction read uses these private members of the Adafruit driver, it's only used with that
+# driver and only if they are all there, anything else reads the driver's public properties
+REGISTER_DRIVER = 'adafruit_bme280'
+DRIVER_MEMBERS = ['_read_register', '_get_status', '_temp_calib', '_pressure_calib', '_humidity_calib']
+
+# the latest snapshot and the time it was taken, guarded by mutex
+mutex = threading.Lock()
+snapshot = None
+snapshotTime = None
+
+# open the sensor on the selected hardware backend, call this before reading anything
+def init():
+    global bme280, registerRead
+    bme280 = backend.getBackend().openBME280()
+    bme280.sea_level_pressure = SEA_LEVEL_PRESSURE
+    registerRead = (type(bme280).__module__.split('.')[0] == REGISTER_DRIVER and
+                    all(hasattr(bme280, name) for name in DRIVER_MEMBERS))
+
+# hPa, altitudes from now on use it so the cached snapshot is dropped
+def setSeaLevelPressure(value):
+    global SEA_LEVEL_PRESSURE, snapshot
+    mutex.acquire()
+    SEA_LEVEL_PRESSURE = value
+    if bme280 is not None:
+        bme280.sea_level_pressure = value
+    snapshot = None
+    mutex.release()
+
+def setSnapshotTTL(ttl):
+    global SNAPSHOT_TTL
+    SNAPSHOT_TTL = ttl
+
+# return a dict with temp, humidity, pressure and altitude that were all measured at the same instant
+# readings younger than SNAPSHOT_TTL are shared instead of going back out on the i2c bus
+def getSnapshot():
+    global snapshot, snapshotTime
+    mutex.acquire()
+    try:
+        if snapshot is None or time.monotonic() - snapshotTime >= SNAPSHOT_TTL:
+            snapshot = readSnapshotLocked()
+            snapshotTime = time.monotonic()
+        return snapshot
+    finally:
+        mutex.release()
+
+# a fresh snapshot that skips the cache, for the sampler. It holds the mutex so it never shares
+# the bus with a getSnapshot() read
+def readSnapshot():
+    mutex.acquire()
+    try:
+        return readSnapshotLocked()
+    finally:
+        mutex.release()
+
+# called with mutex held
+def readSnapshotLocked():
+    if not registerRead:
+        pressure = bme280.pressure
+        return {'temp': bme280.temperature, 'humidity': bme280.relative_humidity,
+                'pressure': pressure, 'altitude': getAltitude(pressure)}
+    return readRegisters()
+
+# reading each property from the driver costs a temperature read plus its own register read, so
+# with the Adafruit driver read all of the data registers in one transaction and run the
+# compensation from the datasheet on them ourselves, with the driver's calibration tables
+def readRegisters():
+    if bme280.mode != MODE_NORMAL:
+        # trigger a single measurement and wait for it to finish
+        bme280.mode = MODE_FORCE
+        while bme280._get_status() & 0x08:
+            time.sleep(0.002)
+    data = bme280._read_register(DATA_REGISTER, 8)
+    tempCalib = bme280._temp_calib
+    pressCalib = bme280._pressure_calib
+    humCalib = bme280._humidity_calib
+
+    # the lowest 4 bits of the 20 bit values get dropped
+    rawPressure = ((data[0] << 16) | (data[1] << 8) | data[2]) / 16
+    rawTemp = ((data[3] << 16) | (data[4] << 8) | data[5]) / 16
+    rawHumidity = float((data[6] << 8) | data[7])
+
+    var1 = (rawTemp / 16384.0 - tempCalib[0] / 1024.0) * tempCalib[1]
+    var2 = ((rawTemp / 131072.0 - tempCalib[0] / 8192.0) * (rawTemp / 131072.0 - tempCalib[0] / 8192.0)) * tempCalib[2]
+    tFine = int(var1 + var2)
+    temp = tFine / 5120.0
+
+    var1 = float(tFine) / 2.0 - 64000.0
+    var2 = var1 * var1 * pressCalib[5] / 32768.0
+    var2 = var2 + var1 * pressCalib[4] * 2.0
+    var2 = var2 / 4.0 + pressCalib[3] * 65536.0
+    var3 = pressCalib[2] * var1 * var1 / 524288.0
+    var1 = (var3 + pressCalib[1] * var1) / 524288.0
+    var1 = (1.0 + var1 / 32768.0) * pressCalib[0]
+    if not var1:
+        raise ArithmeticError("Invalid pressure calibration, check the sensor")
+    pressure = 1048576.0 - rawPressure
+    pressure = ((pressure - var2 / 4096.0) * 6250.0) / var1
+    var1 = pressCalib[8] * pressure * pressure / 2147483648.0
+    var2 = pressure * pressCalib[7] / 32768.0
+    pressure = (pressure + (var1 + var2 + pressCalib[6]) / 16.0) / 100
+
+    var1 = float(tFine) - 76800.0
+    var2 = humCalib[3] * 64.0 + (humCalib[4] / 16384.0) * var1
+    var3 = rawHumidity - var2
+    var4 = humCalib[1] / 65536.0
+    var5 = 1.0 + (humCalib[2] / 67108864.0) * var1
+    var6 = 1.0 + (humCalib[5] / 67108864.0) * var1 * var5
+    var6 = var3 * var4 * (var5 * var6)
+    humidity = min(100.0, max(0.0, var6 * (1.0 - humCalib[0] * var6 / 524288.0)))
+
+    return {'temp': temp, 'humidity': humidity, 'pressure': pressure, 'altitude': getAltitude(pressure)}
+
+# altitude in meters from the pressure in hPa, same formula the driver uses
+def getAltitude(pressure):
+    return 44330 * (1.0 - math.pow(pressure / bme280.sea_level_pressure, 0.1903))